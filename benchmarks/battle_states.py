@@ -0,0 +1,36 @@
+import random
+
+# random gameObjects payloads in the format client/game.js sends (see getGameObjectsForServer)
+# usage:
+# game_objects_data = make_game_objects_data(1000, seed=0)
+# game_objects = [create_game_object(o) for o in game_objects_data]
+
+NAMES = ['Roland', 'Owen', 'Jake', 'Anton', 'Mira', 'Edric', 'Talia', 'Bran', 'Isolde', 'Gareth']
+
+
+def make_game_objects_data(n_objects, seed=0, map_size=None):
+    rng = random.Random(seed)
+    # keep density roughly constant as maps grow
+    map_size = map_size or max(10, int((n_objects * 4) ** 0.5))
+    objects = [
+        {'id': 'Castle1', 'type': 'structure', 'position': [map_size // 2, 0], 'ally': True},
+        {'id': 'Castle2', 'type': 'structure', 'position': [map_size // 2, map_size], 'ally': False},
+    ]
+    counts = {'Wall': 0, 'Knight': 0, 'Archer': 0}
+    while len(objects) < n_objects:
+        kind = rng.choice(['Wall', 'Knight', 'Knight', 'Archer', 'Archer'])
+        counts[kind] += 1
+        position = [rng.randint(0, map_size), rng.randint(0, map_size)]
+        if kind == 'Wall':
+            objects.append({'id': f'Wall{counts[kind]}', 'type': 'structure', 'position': position})
+        else:
+            objects.append({
+                'id': f'{kind}{counts[kind]}',
+                'type': 'unit',
+                'position': position,
+                'ally': rng.random() < 0.5,
+                'name': rng.choice(NAMES),
+                'isRanged': kind == 'Archer',
+                'fighterType': kind.lower(),
+            })
+    return objects[:n_objects]
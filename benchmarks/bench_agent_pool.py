@@ -0,0 +1,72 @@
+import argparse
+import json
+import time
+
+from custom_agent.agent_pool import AgentPool
+from custom_agent.castle_agent import CastleAgent, render_system_prompt
+from custom_agent.py_agent import load_templates
+
+# per-request agent setup: a new CastleAgent per request (yaml parse, template render, interpreter, memory)
+# vs taking a pre-built agent from an AgentPool and resetting it afterwards
+# no model is called, this is only the fixed cost around each run
+# usage:
+# python -m benchmarks.bench_agent_pool
+# python -m benchmarks.bench_agent_pool --requests 500 --json
+
+
+class NoModel:
+    # agents only keep a reference to the model until they run
+    pass
+
+
+def fresh_agent_per_request(requests):
+    ts = time.perf_counter()
+    for _ in range(requests):
+        # what every request paid before templates were cached
+        load_templates.cache_clear()
+        render_system_prompt.cache_clear()
+        CastleAgent(NoModel(), debug_mode=False)
+    return time.perf_counter() - ts
+
+
+def fresh_agent_cached_templates(requests):
+    ts = time.perf_counter()
+    for _ in range(requests):
+        CastleAgent(NoModel(), debug_mode=False)
+    return time.perf_counter() - ts
+
+
+def pooled_agent(requests):
+    pool = AgentPool(lambda: CastleAgent(NoModel(), debug_mode=False), size=4)
+    ts = time.perf_counter()
+    for _ in range(requests):
+        with pool.agent() as agent:
+            agent.code_state = {'battle_state': []}
+    return time.perf_counter() - ts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    results = {'requests': args.requests}
+    for name, fn in [
+        ('fresh_agent', fresh_agent_per_request),
+        ('fresh_agent_cached_templates', fresh_agent_cached_templates),
+        ('pooled_agent', pooled_agent),
+    ]:
+        results[f'{name}_us'] = round(fn(args.requests) / args.requests * 1e6, 2)
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print(f"setup per request, {args.requests} requests")
+        print(f"  new CastleAgent:                    {results['fresh_agent_us']}us")
+        print(f"  new CastleAgent, cached templates:  {results['fresh_agent_cached_templates_us']}us")
+        print(f"  AgentPool acquire + reset:          {results['pooled_agent_us']}us")
+
+
+if __name__ == '__main__':
+    main()
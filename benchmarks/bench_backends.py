@@ -0,0 +1,151 @@
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+# model backends (custom_agent/backends.py) compared on load time, weight memory, process memory and tokens/sec
+# every backend runs in a fresh interpreter so their memory does not add up
+# by default a tiny random Qwen2 model (benchmarks/tiny_model.py) is quantised in place, so this runs offline;
+# --model-id loads a real checkpoint through the backend (downloads it); 'unsloth' only runs with --model-id on a GPU
+# agreement: how many greedy tokens of each backend match the first one before the outputs diverge
+# weights_mb is the exact weight size; load_rss_mb also counts float32 weights the allocator keeps after quantising
+# usage:
+# python -m benchmarks.bench_backends
+# python -m benchmarks.bench_backends --hidden-size 1024 --layers 8 --threads 4 --json
+# python -m benchmarks.bench_backends --model-id unsloth/Qwen2.5-Coder-1.5B-Instruct-bnb-4bit --backends cpu-fp32 cpu-int8 unsloth
+
+CONFIGS = {
+    'cpu-fp32': ('cpu', {'quantize': None}),
+    'cpu-int8': ('cpu', {'quantize': 'int8'}),
+    'unsloth': ('unsloth', {}),
+}
+
+STOP_SEQUENCES = ["<end_code>", "Observation:"]
+
+
+def make_messages(i):
+    # the same prompt shape as benchmarks/bench_batching.py
+    system = "You are a coding assistant for a strategy game. " * 20
+    task = f"New task:\nKnight{i} move up {i % 5} tiles"
+    return [
+        {"role": "system", "content": [{"type": "text", "text": system}]},
+        {"role": "user", "content": [{"type": "text", "text": task}]},
+    ]
+
+
+def rss_bytes():
+    # current resident memory, linux only
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def run_backend(args):
+    # runs in the child process, prints one json line
+    import torch
+    from custom_agent.backends import BACKENDS, model_bytes
+    from custom_agent.model_wrapper import ModelWrapper
+
+    name, options = CONFIGS[args.backend]
+    backend = BACKENDS[name](threads=args.threads, **options) if name == 'cpu' else BACKENDS[name](**options)
+    rss_before = rss_bytes()
+    ts = time.perf_counter()
+    if args.model_id:
+        model, tokenizer = backend.load(args.model_id, max_seq_length=4096)
+    else:
+        from benchmarks.tiny_model import make_tiny_model
+        model, tokenizer = backend.prepare(*make_tiny_model(hidden_size=args.hidden_size, num_layers=args.layers))
+    load_seconds = time.perf_counter() - ts
+    rss_loaded = rss_bytes()
+    wrapper = ModelWrapper.from_model(model, tokenizer, model_id=args.model_id, max_new_tokens=args.max_new_tokens,
+                                      prefix_cache_tokens=0, stop_on_final_answer=False)
+
+    def generate(batch_size, i):
+        prompts = [wrapper.prepare_prompt(make_messages(i + row), stop_sequences=STOP_SEQUENCES)
+                   for row in range(batch_size)]
+        ts = time.perf_counter()
+        results = wrapper.generate_batch(prompts)
+        return results, time.perf_counter() - ts
+
+    generate(1, 0)  # warm up
+    result = {'backend': args.backend, 'threads': torch.get_num_threads(), 'load_seconds': round(load_seconds, 2),
+              'weights_mb': round(model_bytes(model) / 2 ** 20, 1)}
+    for batch_size in args.batch_sizes:
+        tokens = seconds = 0
+        for i in range(args.repeats):
+            results, elapsed = generate(batch_size, i)
+            tokens += sum(row['output_token_count'] for row in results)
+            seconds += elapsed
+        result[f'tokens_per_second_b{batch_size}'] = round(tokens / seconds, 1)
+    results, _ = generate(1, 0)
+    result['tokens'] = results[0]['out'][0, results[0]['input_token_count']:].tolist()
+    if rss_before is not None:
+        result['load_rss_mb'] = round((rss_loaded - rss_before) / 2 ** 20, 1)
+    result['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    if name == 'unsloth':
+        result['max_gpu_mb'] = round(torch.cuda.max_memory_allocated() / 2 ** 20, 1)
+    print(json.dumps(result))
+
+
+def agreement(tokens, reference):
+    same = 0
+    for token, expected in zip(tokens, reference):
+        if token != expected:
+            break
+        same += 1
+    return round(same / max(len(reference), 1), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backends', nargs='+', default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument('--model-id', default=None, help='load this checkpoint instead of the tiny random model')
+    parser.add_argument('--hidden-size', type=int, default=512)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--max-new-tokens', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--backend', default=None, help=argparse.SUPPRESS)  # set in the child process
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    if args.backend:
+        run_backend(args)
+        return
+
+    import torch
+    # unsloth loads its own checkpoints, so it needs --model-id as well as a GPU
+    backends = [backend for backend in args.backends
+                if backend != 'unsloth' or (torch.cuda.is_available() and args.model_id)]
+    results = []
+    for backend in backends:
+        command = [sys.executable, '-m', 'benchmarks.bench_backends', '--backend', backend,
+                   '--hidden-size', str(args.hidden_size), '--layers', str(args.layers),
+                   '--max-new-tokens', str(args.max_new_tokens), '--repeats', str(args.repeats),
+                   '--batch-sizes', *map(str, args.batch_sizes)]
+        if args.model_id:
+            command += ['--model-id', args.model_id]
+        if args.threads:
+            command += ['--threads', str(args.threads)]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    reference = results[0]['tokens'] if results else []
+    for result in results:
+        result['agreement'] = agreement(result.pop('tokens'), reference)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import json
+import threading
+import time
+
+from benchmarks.tiny_model import make_tiny_model
+from custom_agent.batching import BatchScheduler
+from custom_agent.model_wrapper import ModelWrapper
+
+# throughput of sequential ModelWrapper calls vs. concurrent calls through BatchScheduler
+# runs on CPU with a tiny random model, so absolute numbers are small; compare the ratio
+# the prefix cache is off, since BatchScheduler skips it for batches of more than one and it would only
+# speed up the sequential side (benchmarks/bench_prefix_cache.py measures it)
+# usage:
+# python -m benchmarks.bench_batching --requests 16 --batch-size 8
+
+STOP_SEQUENCES = ["<end_code>", "Observation:"]
+
+
+def make_messages(i):
+    # roughly the shape of a CastleAgent step: a long shared system prompt + a short task
+    system = "You are a coding assistant for a strategy game. " * 20
+    task = f"New task:\nKnight{i} move up {i % 5} tiles"
+    return [
+        {"role": "system", "content": [{"type": "text", "text": system}]},
+        {"role": "user", "content": [{"type": "text", "text": task}]},
+    ]
+
+
+def run_sequential(model, n_requests):
+    latencies = []
+    start = time.perf_counter()
+    for i in range(n_requests):
+        ts = time.perf_counter()
+        model(make_messages(i), stop_sequences=STOP_SEQUENCES)
+        latencies.append(time.perf_counter() - ts)
+    return time.perf_counter() - start, latencies
+
+
+def run_concurrent(model, n_requests):
+    latencies = [None] * n_requests
+
+    def worker(i):
+        ts = time.perf_counter()
+        model(make_messages(i), stop_sequences=STOP_SEQUENCES)
+        latencies[i] = time.perf_counter() - ts
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_requests)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, latencies
+
+
+def summarize(name, total, latencies):
+    latencies = sorted(latencies)
+    return {
+        "mode": name,
+        "requests": len(latencies),
+        "total_s": round(total, 4),
+        "throughput_rps": round(len(latencies) / total, 3),
+        "mean_latency_s": round(sum(latencies) / len(latencies), 4),
+        "max_latency_s": round(latencies[-1], 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--batch-window", type=float, default=0.02)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results only")
+    args = parser.parse_args()
+
+    model, tokenizer = make_tiny_model(max_new_tokens=args.max_new_tokens)
+    wrapper = ModelWrapper.from_model(model, tokenizer, model_id="tiny-random-qwen2", max_new_tokens=args.max_new_tokens,
+                                      prefix_cache_tokens=0)
+    wrapper(make_messages(0), stop_sequences=STOP_SEQUENCES)  # warm up
+
+    results = [summarize("sequential", *run_sequential(wrapper, args.requests))]
+    scheduler = BatchScheduler(wrapper, max_batch_size=args.batch_size, batch_window=args.batch_window)
+    results.append(summarize("batched", *run_concurrent(scheduler, args.requests)))
+    results[-1]["mean_batch_size"] = round(sum(scheduler.batch_sizes) / len(scheduler.batch_sizes), 2)
+    scheduler.close()
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print(result)
+        print(f"speedup: {results[0]['total_s'] / results[1]['total_s']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
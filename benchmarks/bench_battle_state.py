@@ -0,0 +1,91 @@
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from benchmarks.battle_states import make_game_objects_data
+from castle.battle_state import BattleState
+from castle.client_adapter import create_game_object
+
+# parse time and memory of one GameObject per entity (create_game_object) vs the array-backed BattleState
+# parse = json text of the gameObjects payload -> container; to_dicts = container -> battle_state list of dicts
+# memory is what the container keeps alive once the parsed json payload is dropped, measured with tracemalloc
+# usage:
+# python -m benchmarks.bench_battle_state
+# python -m benchmarks.bench_battle_state --objects 10000 100000 --json
+
+
+def parse_objects(text):
+    return [create_game_object(o) for o in json.loads(text)]
+
+
+def parse_state(text):
+    return BattleState.from_json(text)
+
+
+def objects_to_dicts(game_objects):
+    return [i.__dict__ for i in game_objects]
+
+
+def state_to_dicts(state):
+    return state.to_dicts()
+
+
+def best_time(fn, arg, repeat):
+    times = []
+    for _ in range(repeat):
+        ts = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - ts)
+    return min(times)
+
+
+def retained_bytes(parse, text):
+    gc.collect()
+    tracemalloc.start()
+    container = parse(text)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del container
+    return size
+
+
+def bench(n_objects, repeat):
+    text = json.dumps(make_game_objects_data(n_objects))
+    objects, state = parse_objects(text), parse_state(text)
+    return {
+        'objects': n_objects,
+        'game_objects_parse_ms': round(best_time(parse_objects, text, repeat) * 1000, 2),
+        'battle_state_parse_ms': round(best_time(parse_state, text, repeat) * 1000, 2),
+        'json_loads_ms': round(best_time(json.loads, text, repeat) * 1000, 2),
+        'game_objects_to_dicts_ms': round(best_time(objects_to_dicts, objects, repeat) * 1000, 2),
+        'battle_state_to_dicts_ms': round(best_time(state_to_dicts, state, repeat) * 1000, 2),
+        'game_objects_bytes': retained_bytes(parse_objects, text),
+        'battle_state_bytes': retained_bytes(parse_state, text),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    results = [bench(n, args.repeat) for n in args.objects]
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for r in results:
+            print(f"{r['objects']} objects")
+            print(f"  parse     GameObjects {r['game_objects_parse_ms']:>9}ms   BattleState {r['battle_state_parse_ms']:>9}ms"
+                  f"   (json.loads alone {r['json_loads_ms']}ms)")
+            print(f"  to_dicts  GameObjects {r['game_objects_to_dicts_ms']:>9}ms   BattleState {r['battle_state_to_dicts_ms']:>9}ms")
+            print(f"  memory    GameObjects {r['game_objects_bytes'] / 1e6:>8.2f}MB   BattleState {r['battle_state_bytes'] / 1e6:>8.2f}MB"
+                  f"   ({r['game_objects_bytes'] / r['battle_state_bytes']:.1f}x smaller)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import json
+import time
+
+from smolagents.local_python_executor import LocalPythonInterpreter
+
+from benchmarks.battle_states import make_game_objects_data
+from benchmarks.bench_spatial import TASKS
+from castle.battle_state import BattleState
+from castle.spatial import spatial_helpers
+from custom_agent.compiled_executor import CompiledCodeCache, CompiledPythonExecutor
+
+# execution time of generated code in smolagents' LocalPythonInterpreter vs CompiledPythonExecutor
+# runs the comprehension and helper variants of the bench_spatial tasks on growing battle states, checks that
+# both executors leave the same commands behind, and reports the compiled time with a cold and a warm code cache
+# usage:
+# python -m benchmarks.bench_executor
+# python -m benchmarks.bench_executor --objects 200 1000 5000 --json
+
+
+def run_code(executor, battle_state, code):
+    code_state = {'battle_state': battle_state, **spatial_helpers(battle_state)}
+    ts = time.perf_counter()
+    executor(code, code_state)
+    return time.perf_counter() - ts, executor.state['commands']
+
+
+def run(n_objects, skip_interpreter_over):
+    battle_state = BattleState.from_payload(make_game_objects_data(n_objects)).to_dicts()
+    rows = []
+    for task, variants in TASKS.items():
+        for variant, code in variants.items():
+            code_cache = CompiledCodeCache()
+            cold_s, compiled_commands = run_code(CompiledPythonExecutor([], {}, code_cache=code_cache), battle_state, code)
+            warm_s, _ = run_code(CompiledPythonExecutor([], {}, code_cache=code_cache), battle_state, code)
+            row = {
+                'objects': n_objects,
+                'task': task,
+                'variant': variant,
+                'compiled_cold_ms': round(cold_s * 1000, 3),
+                'compiled_warm_ms': round(warm_s * 1000, 3),
+            }
+            # the interpreter needs minutes for the quadratic comprehension on large maps
+            if n_objects <= skip_interpreter_over or variant == 'helpers':
+                interpreter = LocalPythonInterpreter([], {}, max_print_outputs_length=None)
+                interpreter_s, interpreter_commands = run_code(interpreter, battle_state, code)
+                row['interpreter_ms'] = round(interpreter_s * 1000, 3)
+                row['speedup'] = round(interpreter_s / warm_s, 1)
+                row['same_commands'] = interpreter_commands == compiled_commands
+            rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, nargs='+', default=[100, 1000, 2000])
+    parser.add_argument('--skip-interpreter-over', type=int, default=2000,
+                        help='only run the helper variants through the interpreter above this many objects')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    results = [row for n in args.objects for row in run(n, args.skip_interpreter_over)]
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for row in results:
+            print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import argparse
+import json
+import statistics
+import time
+
+from benchmarks.battle_states import make_game_objects_data
+from castle.client_adapter import create_game_object
+from custom_agent.fast_path import resolve_command
+
+# coverage, correctness and latency of the rule-based fast path on a corpus of player commands
+# every corpus entry has the expected command list, or None when the command should go to the model
+# usage:
+# python -m benchmarks.bench_fast_path
+# python -m benchmarks.bench_fast_path --objects 500 --json
+
+BATTLE = [
+    {'id': 'Castle1', 'type': 'structure', 'position': [5, 0], 'ally': True},
+    {'id': 'Castle2', 'type': 'structure', 'position': [5, 12], 'ally': False},
+    {'id': 'Wall1', 'type': 'structure', 'position': [3, 5]},
+    {'id': 'Wall2', 'type': 'structure', 'position': [7, 5]},
+    {'id': 'Knight1', 'type': 'unit', 'position': [4, 1], 'ally': True, 'name': 'Roland', 'isRanged': False, 'fighterType': 'knight'},
+    {'id': 'Knight2', 'type': 'unit', 'position': [6, 10], 'ally': False, 'name': 'Anton', 'isRanged': False, 'fighterType': 'knight'},
+    {'id': 'Archer1', 'type': 'unit', 'position': [3, 1], 'ally': True, 'name': 'Owen', 'isRanged': True, 'fighterType': 'archer'},
+    {'id': 'Archer2', 'type': 'unit', 'position': [7, 1], 'ally': True, 'name': 'Mira', 'isRanged': True, 'fighterType': 'archer'},
+    {'id': 'Archer3', 'type': 'unit', 'position': [5, 11], 'ally': False, 'name': 'Bran', 'isRanged': True, 'fighterType': 'archer'},
+]
+
+
+def move(unit_ids, x_delta, y_delta):
+    return [{'args': {'unit_ids': unit_ids, 'x_delta': x_delta, 'y_delta': y_delta}, 'name': 'move_in_direction'}]
+
+
+def move_to(unit_ids, target_id):
+    return [{'args': {'unit_ids': unit_ids, 'target_id': target_id}, 'name': 'move_to_target'}]
+
+
+ARCHERS = ['Archer1', 'Archer2']
+EVERYONE = ['Knight1', 'Archer1', 'Archer2']
+CORPUS = [
+    ('Knight move left 2', move(['Knight1'], -2, 0)),
+    ('knight, move LEFT two tiles!', move(['Knight1'], -2, 0)),
+    ('Archers move up 3 tiles', move(ARCHERS, 0, 3)),
+    ('all archers move forward', move(ARCHERS, 0, 1)),
+    ('Owen move 2 tiles right', move(['Archer1'], 2, 0)),
+    ('Mira go back 1', move(['Archer2'], 0, -1)),
+    ('Roland and Owen move up 4', move(['Knight1', 'Archer1'], 0, 4)),
+    ('all units advance', move(EVERYONE, 0, 1)),
+    ('everyone retreat', move(EVERYONE, 0, -1)),
+    ('ranged units move up 2 and left 1', move(ARCHERS, -1, 2)),
+    ('melee units move to the first wall', move_to(['Knight1'], 'Wall1')),
+    ('Melee units move to the second wall', move_to(['Knight1'], 'Wall2')),
+    ('archers go to the last wall', move_to(ARCHERS, 'Wall2')),
+    ('Knight attack the enemy knight', move_to(['Knight1'], 'Knight2')),
+    ('knight attack the enemy castle', move_to(['Knight1'], 'Castle2')),
+    ('all units charge the enemy castle', move_to(EVERYONE, 'Castle2')),
+    ('Roland move to our castle', move_to(['Knight1'], 'Castle1')),
+    ('Archer1 move to Wall2', move_to(['Archer1'], 'Wall2')),
+    ('Owen attack Bran', move_to(['Archer1'], 'Archer3')),
+    ('archers attack the enemy archer', move_to(ARCHERS, 'Archer3')),
+    # need the model: ambiguous, relational or multi-part orders
+    ('archer move up 3', None),
+    ('Roland move to the castle', None),
+    ('archers move towards the nearest enemy', None),
+    ('knight move up then right', None),
+    ('knight move up 2 and archers move left 1', None),
+    ('units closest to the wall move forward', None),
+    ('spread out the archers', None),
+    ('knight protect the archers', None),
+    ('enemy knight move up', None),
+    ('move halfway to the enemy castle', None),
+]
+
+
+def bench_corpus(game_objects, repeat):
+    resolved, correct, wrong, latencies = 0, 0, [], []
+    for command, expected in CORPUS:
+        result = resolve_command(game_objects, command)
+        ts = time.perf_counter()
+        for _ in range(repeat):
+            resolve_command(game_objects, command)
+        latencies.append((time.perf_counter() - ts) / repeat * 1e6)
+        resolved += result is not None
+        if result == expected:
+            correct += 1
+        else:
+            wrong.append({'command': command, 'expected': expected, 'got': result})
+    simple = sum(expected is not None for _, expected in CORPUS)
+    return {
+        'commands': len(CORPUS),
+        'resolved': resolved,
+        'coverage': round(resolved / len(CORPUS), 3),
+        'simple_coverage': round(sum(1 for c, e in CORPUS if e is not None and resolve_command(game_objects, c) == e) / simple, 3),
+        'correct': correct,
+        'wrong': wrong,
+        'latency_us_p50': round(statistics.median(latencies), 2),
+        'latency_us_max': round(max(latencies), 2),
+    }
+
+
+def bench_large_state(n_objects, repeat):
+    # latency grows with the number of objects, since every lookup scans the state
+    game_objects = [create_game_object(o) for o in make_game_objects_data(n_objects)]
+    ts = time.perf_counter()
+    for _ in range(repeat):
+        for command, _ in CORPUS:
+            resolve_command(game_objects, command)
+    return {'objects': n_objects, 'latency_us_mean': round((time.perf_counter() - ts) / (repeat * len(CORPUS)) * 1e6, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=200, help='size of the random state for the latency run')
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    results = {
+        'corpus': bench_corpus([create_game_object(o) for o in BATTLE], args.repeat),
+        'large_state': bench_large_state(args.objects, max(1, args.repeat // 10)),
+    }
+    if args.json:
+        print(json.dumps(results))
+    else:
+        corpus = results['corpus']
+        print(f"coverage: {corpus['resolved']}/{corpus['commands']} resolved ({corpus['coverage']}), "
+              f"simple commands resolved correctly: {corpus['simple_coverage']}")
+        print(f"correct: {corpus['correct']}/{corpus['commands']}")
+        for miss in corpus['wrong']:
+            print(f"  wrong: {miss['command']!r} -> {miss['got']} (expected {miss['expected']})")
+        print(f"latency: p50 {corpus['latency_us_p50']}us, max {corpus['latency_us_max']}us")
+        large = results['large_state']
+        print(f"latency with {large['objects']} objects: {large['latency_us_mean']}us per command")
+
+
+if __name__ == '__main__':
+    main()
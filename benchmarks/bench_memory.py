@@ -0,0 +1,109 @@
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+import torch
+from smolagents import ChatMessage
+
+from benchmarks.battle_states import make_game_objects_data
+from benchmarks.stub_model import DEFAULT_SCRIPT, StubModel
+from castle.battle_state import BattleState
+from custom_agent.castle_agent import CastleAgent
+from custom_agent.retention import FULL_RETENTION, RetentionPolicy
+
+# memory an agent run leaves in AgentMemory, per retention policy, over long multi-step runs
+# every step but the last prints the units (a big observation, like an agent exploring), the last one answers
+# the stub model attaches raw['out'] the way ModelWrapper does: a view of a whole (batch, prompt + output) token
+# tensor, so keeping it keeps the batch; here the tensors are on the cpu, on a gpu they would hold device memory
+# retained = python memory (tracemalloc) and tensor storage still referenced by the agent after the run;
+# input_tokens shows what summarize_after saves in prompt length
+# usage:
+# python -m benchmarks.bench_memory
+# python -m benchmarks.bench_memory --steps 5 20 --objects 300 --json
+
+POLICIES = {
+    'full': FULL_RETENTION,
+    'bounded': RetentionPolicy(),
+    'bounded_cpu_raw': RetentionPolicy(raw_output='cpu'),
+    'bounded_summary': RetentionPolicy(summarize_after=2),
+}
+
+LOOK_STEP = '''Thought: I need to look at the units first.
+Code:
+```py
+print(filter_objects(object_type='unit'))
+```<end_code>'''
+
+
+class DeviceStubModel(StubModel):
+    # raw['out'] is a row view of a batch token tensor, like ModelWrapper.generate_batch
+    def __init__(self, batch_size=8, **kwargs):
+        super().__init__(**kwargs)
+        self.batch_size = batch_size
+
+    def make_chat_message(self, prompt, result):
+        length = result['input_token_count'] + result['output_token_count']
+        batch = torch.zeros(self.batch_size, length, dtype=torch.long)
+        return ChatMessage(role='assistant', content=result['output'], raw={'out': batch[0:1, :], 'completion_kwargs': {}})
+
+
+def retained_tensor_bytes(agent):
+    storages = {}
+    for step in agent.memory.steps:
+        message = getattr(step, 'model_output_message', None)
+        raw = message.raw if message is not None else None
+        if isinstance(raw, dict):
+            for value in raw.values():
+                if isinstance(value, torch.Tensor):
+                    storage = value.untyped_storage()
+                    storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+def run(policy_name, steps, game_objects_data):
+    model = DeviceStubModel(script=[LOOK_STEP] * (steps - 1) + DEFAULT_SCRIPT)
+    agent = CastleAgent(model, debug_mode=False, retention=POLICIES[policy_name])
+    agent.logger.level = -1  # LogLevel.OFF
+    game_objects = BattleState.from_payload(game_objects_data)
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    ts = time.perf_counter()
+    result = agent.run_battle_command(game_objects, 'Scout the battlefield, then move everyone up', step_max=steps + 1)
+    elapsed = time.perf_counter() - ts
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'policy': policy_name,
+        'steps': steps,
+        'answered': result is not None,
+        'retained_python_kb': round((current - baseline) / 1024, 1),
+        'peak_python_kb': round((peak - baseline) / 1024, 1),
+        'retained_tensor_kb': round(retained_tensor_bytes(agent) / 1024, 1),
+        'input_tokens': agent.input_tokens,
+        'seconds': round(elapsed, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, nargs='+', default=[5, 10, 20])
+    parser.add_argument('--objects', type=int, default=200)
+    parser.add_argument('--policies', nargs='+', default=list(POLICIES), choices=list(POLICIES))
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    game_objects_data = make_game_objects_data(args.objects)
+    results = [run(policy, steps, game_objects_data) for steps in args.steps for policy in args.policies]
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for row in results:
+            print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+from smolagents.local_python_executor import LocalPythonInterpreter, fix_final_answer_code
+from smolagents.utils import parse_code_blobs
+from starlette.testclient import TestClient
+
+from benchmarks.battle_states import make_game_objects_data
+from benchmarks.stub_model import DEFAULT_SCRIPT, StubModel
+from castle.battle_state import BattleState, as_battle_state
+from castle.client_adapter import create_game_object
+from castle.spatial import spatial_helpers
+from castle.utils import pretty_list
+from custom_agent.castle_agent import CastleAgent
+from custom_agent.result_cache import CommandResultCache
+from serving.inference import InferenceService
+
+# microbenchmarks of the request path outside the model, all on CPU with a zero-latency StubModel
+# results are per call in microseconds (best of --repeat rounds); --output writes them as json and
+# --baseline compares against an earlier --output file and exits with 1 if anything got slower than --tolerance
+# usage:
+# python -m benchmarks.bench_micro --output micro.json
+# python -m benchmarks.bench_micro --baseline micro.json --tolerance 0.25
+
+
+def measure(fn, number, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        ts = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - ts) / number)
+    return round(best * 1e6, 2)
+
+
+def make_service():
+    # the model path on every request: no fast path, and a cache that keeps nothing
+    return InferenceService(
+        model_factory=StubModel,
+        batch_window=0,
+        debug_mode=False,
+        warm_up=False,
+        fast_path=False,
+        result_cache=CommandResultCache(max_size=0),
+    )
+
+
+def bench_handler(game_objects_data, number, repeat, command):
+    import server
+    server.service = make_service()
+    body = {'command': command, 'gameObjects': game_objects_data}
+    with TestClient(server.app) as client:
+        while not server.service.is_ready():
+            time.sleep(0.01)
+        return measure(lambda: client.post('/api/command', json=body), number, repeat)
+
+
+def run(n_objects, number, repeat):
+    game_objects_data = make_game_objects_data(n_objects)
+    game_objects = [create_game_object(o) for o in game_objects_data]
+    state = BattleState.from_payload(game_objects_data)
+    agent = CastleAgent(StubModel(), debug_mode=False)
+    code = DEFAULT_SCRIPT[0]
+
+    def prompt_construction():
+        battle_state = as_battle_state(state)
+        spatial_helpers(battle_state)
+        agent.build_battle_prompt(state, 'Archers move to the nearest wall', battle_state=battle_state)
+
+    def parse_and_execute():
+        code_action = fix_final_answer_code(parse_code_blobs(code))
+        interpreter = LocalPythonInterpreter([], {}, max_print_outputs_length=None)
+        battle_state = state.to_dicts()
+        interpreter(code_action, {'battle_state': battle_state, **spatial_helpers(battle_state)})
+
+    # silence the per-request prints of the service and agent while timing
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return {
+            'create_game_object_us': measure(lambda: [create_game_object(o) for o in game_objects_data], number, repeat),
+            'battle_state_from_payload_us': measure(lambda: BattleState.from_payload(game_objects_data), number, repeat),
+            'pretty_list_us': measure(lambda: pretty_list(game_objects), number, repeat),
+            'prompt_construction_us': measure(prompt_construction, number, repeat),
+            'parse_code_and_execute_us': measure(parse_and_execute, number, repeat),
+            'submit_command_model_path_us': bench_handler(game_objects_data, max(1, number // 10), repeat, 'Archers hold the line'),
+        }
+
+
+def compare(results, baseline, tolerance):
+    regressions = {}
+    for name, value in results.items():
+        before = baseline.get(name)
+        if isinstance(value, (int, float)) and isinstance(before, (int, float)) and before > 0:
+            if value > before * (1 + tolerance):
+                regressions[name] = {'baseline': before, 'now': value, 'ratio': round(value / before, 2)}
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=200)
+    parser.add_argument('--number', type=int, default=50, help='calls per timing round')
+    parser.add_argument('--repeat', type=int, default=5, help='timing rounds, the best one is reported')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--baseline', help='json file from an earlier --output run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown vs the baseline (0.25 = 25%%)')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    results = {'objects': args.objects, **run(args.objects, args.number, args.repeat)}
+    regressions = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results['regressions'] = regressions
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for name, value in results.items():
+            if name != 'regressions':
+                print(f'{name}: {value}')
+        for name, regression in regressions.items():
+            print(f"REGRESSION {name}: {regression['baseline']} -> {regression['now']} ({regression['ratio']}x)")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import json
+import time
+
+from smolagents.memory import TaskStep
+
+from benchmarks.tiny_model import make_tiny_model
+from castle.client_adapter import create_game_object
+from custom_agent.castle_agent import CastleAgent
+from custom_agent.model_wrapper import ModelWrapper
+
+# time to first token for CastleAgent prompts, with and without the prefix kv cache
+# each request shares the castle_agent.yaml system prompt; tokens are generated one at a time
+# so the measured time is (almost) all prefill
+# usage:
+# python -m benchmarks.bench_prefix_cache --requests 8
+
+SAMPLE_OBJECTS = [
+    {'id': 'Castle1', 'type': 'structure', 'position': [2, 0], 'ally': True},
+    {'id': 'Castle2', 'type': 'structure', 'position': [2, 10], 'ally': False},
+    {'id': 'Wall1', 'type': 'structure', 'position': [4, 5]},
+    {'id': 'Knight1', 'type': 'unit', 'position': [0, 1], 'ally': True, 'name': 'Roland', 'isRanged': False, 'fighterType': 'knight'},
+    {'id': 'Archer1', 'type': 'unit', 'position': [3, 1], 'ally': True, 'name': 'Owen', 'isRanged': True, 'fighterType': 'archer'},
+]
+COMMANDS = ['Archer move up 3 tiles', 'Knight attack the enemy castle', 'All units move left 2', 'Melee units move to the first wall']
+
+
+def make_prompt_messages(agent, command):
+    # same messages as the first step of CastleAgent.run_battle_command, without running the agent
+    agent.memory.steps = [TaskStep(task=f'Please provide the command(s) for my request:\n{command}')]
+    return agent.get_messages()
+
+
+def time_requests(wrapper, n_requests, game_objects):
+    agent = CastleAgent(wrapper, debug_mode=False)
+    agent.code_state = {'battle_state': [i.__dict__ for i in game_objects]}
+    timings = []
+    for i in range(n_requests):
+        messages = make_prompt_messages(agent, COMMANDS[i % len(COMMANDS)])
+        ts = time.perf_counter()
+        wrapper(messages)
+        timings.append(time.perf_counter() - ts)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=8)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    model, tokenizer = make_tiny_model(max_new_tokens=1)
+    game_objects = [create_game_object(o) for o in SAMPLE_OBJECTS]
+
+    results = []
+    for name, cache_tokens in [('no_cache', 0), ('prefix_cache', 16384)]:
+        wrapper = ModelWrapper.from_model(model, tokenizer, model_id='tiny-random-qwen2', prefix_cache_tokens=cache_tokens, max_new_tokens=1)
+        timings = time_requests(wrapper, args.requests, game_objects)
+        result = {
+            'mode': name,
+            'prompt_tokens': wrapper.last_input_token_count,
+            'first_request_s': round(timings[0], 4),
+            'mean_later_requests_s': round(sum(timings[1:]) / max(len(timings) - 1, 1), 4),
+        }
+        if wrapper.prefix_cache is not None:
+            result.update(wrapper.prefix_cache.stats())
+        results.append(result)
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print(result)
+        print(f"ttft speedup after warm up: {results[0]['mean_later_requests_s'] / results[1]['mean_later_requests_s']:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
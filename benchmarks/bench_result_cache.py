@@ -0,0 +1,61 @@
+import argparse
+import json
+import time
+
+from benchmarks.battle_states import make_game_objects_data
+from castle.client_adapter import create_game_object
+from custom_agent.result_cache import CommandResultCache
+
+# lookup cost of the command result cache, which sits in front of the multi-second agent loop
+# miss = fingerprint + failed lookup, hit = fingerprint + lookup + copy of the stored command list,
+# relational hit = same command after every unit has moved (only move_in_direction answers can hit)
+# usage:
+# python -m benchmarks.bench_result_cache
+# python -m benchmarks.bench_result_cache --objects 20 100 500 --json
+
+COMMAND = 'Archer move up 3 tiles'
+RESULT = [{'name': 'move_in_direction', 'args': {'unit_ids': ['Archer1'], 'x_delta': 0, 'y_delta': 3}}]
+
+
+def time_lookups(cache, battle_state, command, repeat):
+    ts = time.perf_counter()
+    for _ in range(repeat):
+        cache.get(battle_state, command)
+    return (time.perf_counter() - ts) / repeat * 1000
+
+
+def bench(n_objects, repeat):
+    battle_state = [create_game_object(o).__dict__ for o in make_game_objects_data(n_objects)]
+    moved = [dict(o, position=[o['position'][0] + 1, o['position'][1]]) for o in battle_state]
+    cache = CommandResultCache(relational=True)
+    miss_ms = time_lookups(cache, battle_state, COMMAND, repeat)
+    cache.put(battle_state, COMMAND, RESULT)
+    hit_ms = time_lookups(cache, battle_state, '  archer MOVE up three tiles!', repeat)
+    relational_ms = time_lookups(cache, moved, COMMAND, repeat)
+    return {
+        'objects': n_objects,
+        'miss_ms': round(miss_ms, 4),
+        'hit_ms': round(hit_ms, 4),
+        'relational_hit_ms': round(relational_ms, 4),
+        'stats': cache.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    results = [bench(n, args.repeat) for n in args.objects]
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for r in results:
+            print(f"{r['objects']:>5} objects: miss {r['miss_ms']}ms, hit {r['hit_ms']}ms, "
+                  f"relational hit {r['relational_hit_ms']}ms, hit rate {r['stats']['hit_rate']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import json
+import random
+import time
+
+from benchmarks.battle_states import make_game_objects_data
+from castle.battle_session import BattleSessionStore
+from castle.battle_state import BattleState
+from custom_agent.result_cache import fingerprint_battle_state
+from custom_agent.state_encoding import encode_battle_state
+
+# per-command state cost with the whole gameObjects list vs a battle session delta, on growing maps
+# full: json body -> parse -> battle_state dicts -> prompt encoding -> result cache fingerprint
+# delta: json body -> apply (parses only added objects) -> incremental prompt encoding -> (kept) fingerprint
+# each command moves --moved random units, like a battle between two orders
+# usage:
+# python -m benchmarks.bench_sessions
+# python -m benchmarks.bench_sessions --objects 1000 5000 --moved 5 --json
+
+
+def full_request(game_objects_data, encoder):
+    body = json.dumps({'command': 'Knights flank the enemy archers', 'gameObjects': game_objects_data})
+    ts = time.perf_counter()
+    data = json.loads(body)
+    battle_state = BattleState.from_payload(data['gameObjects']).to_dicts()
+    encode_battle_state(battle_state, encoder)
+    fingerprint_battle_state(battle_state)
+    return len(body), time.perf_counter() - ts
+
+
+def delta_request(store, session_id, version, delta, encoder):
+    body = json.dumps({'command': 'Knights flank the enemy archers', 'sessionId': session_id,
+                       'baseVersion': version, 'delta': delta})
+    ts = time.perf_counter()
+    data = json.loads(body)
+    snapshot = store.update(data['sessionId'], data['baseVersion'], data['delta'])
+    snapshot.encode(encoder)
+    return len(body), time.perf_counter() - ts, snapshot
+
+
+def run(n_objects, n_moved, commands, encoder, seed=0):
+    rng = random.Random(seed)
+    game_objects_data = make_game_objects_data(n_objects, seed=seed)
+    units = [obj for obj in game_objects_data if obj['type'] == 'unit']
+    store = BattleSessionStore()
+    snapshot = store.start('bench', game_objects_data)
+    snapshot.encode(encoder)
+
+    full_bytes = full_seconds = delta_bytes = delta_seconds = 0
+    for _ in range(commands):
+        moved = rng.sample(units, min(n_moved, len(units)))
+        for unit in moved:
+            unit['position'] = [unit['position'][0] + rng.choice([-1, 1]), unit['position'][1]]
+        delta = {'moved': [{'id': unit['id'], 'position': list(unit['position'])} for unit in moved]}
+        size, seconds = full_request(game_objects_data, encoder)
+        full_bytes += size
+        full_seconds += seconds
+        size, seconds, snapshot = delta_request(store, 'bench', snapshot.version, delta, encoder)
+        delta_bytes += size
+        delta_seconds += seconds
+
+    # both roads end at the same state
+    same_state = sorted(map(str, snapshot.to_dicts())) == sorted(map(str, BattleState.from_payload(game_objects_data).to_dicts()))
+    return {
+        'objects': n_objects,
+        'moved_per_command': n_moved,
+        'encoder': encoder,
+        'full_bytes': full_bytes // commands,
+        'delta_bytes': delta_bytes // commands,
+        'full_ms': round(full_seconds / commands * 1000, 3),
+        'delta_ms': round(delta_seconds / commands * 1000, 3),
+        'speedup': round(full_seconds / delta_seconds, 1),
+        'same_state': same_state,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--moved', type=int, default=5, help='units moved between two commands')
+    parser.add_argument('--commands', type=int, default=20)
+    parser.add_argument('--encoder', default='compact', choices=['compact', 'json'])
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    results = [run(n, args.moved, args.commands, args.encoder) for n in args.objects]
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for row in results:
+            print(row)
+
+
+if __name__ == '__main__':
+    main()
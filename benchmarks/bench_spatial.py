@@ -0,0 +1,125 @@
+import argparse
+import json
+import time
+
+from smolagents.local_python_executor import LocalPythonInterpreter
+
+from benchmarks.battle_states import make_game_objects_data
+from castle.client_adapter import create_game_object
+from castle.spatial import spatial_helpers
+
+# interpreter time of the code the agent writes, with list comprehensions vs the spatial helpers
+# every task is run through LocalPythonInterpreter exactly like a generated code action, index build included
+# usage:
+# python -m benchmarks.bench_spatial
+# python -m benchmarks.bench_spatial --objects 1000 5000 --json   # comprehensions take about a minute at 5000
+
+TASKS = {
+    'nearest_wall': {
+        'comprehension': '''
+unit = [i for i in battle_state if i['object_id'] == 'Knight1'][0]
+walls = [i for i in battle_state if i['object_type'] == 'structure' and i['object_id'].startswith('Wall')]
+wall = min(walls, key=lambda w: (w['position'][0] - unit['position'][0]) ** 2 + (w['position'][1] - unit['position'][1]) ** 2)
+commands = [{'args': {'unit_ids': [unit['object_id']], 'target_id': wall['object_id']}, 'name': 'move_to_target'}]
+''',
+        'helpers': '''
+unit = get_object('Knight1')
+wall = nearest(unit, object_type='structure', ally=None)
+commands = [{'args': {'unit_ids': [unit['object_id']], 'target_id': wall['object_id']}, 'name': 'move_to_target'}]
+''',
+    },
+    # every allied archer targets its own nearest enemy: O(n^2) with comprehensions
+    'archers_attack_nearest_enemy': {
+        'comprehension': '''
+archers = [i for i in battle_state if i['object_type'] == 'unit' and i['ally'] is True and i['fighter_type'] == 'archer']
+enemies = [i for i in battle_state if i['object_type'] == 'unit' and i['ally'] is False]
+commands = []
+for archer in archers:
+    enemy = min(enemies, key=lambda e: (e['position'][0] - archer['position'][0]) ** 2 + (e['position'][1] - archer['position'][1]) ** 2)
+    commands.append({'args': {'unit_ids': [archer['object_id']], 'target_id': enemy['object_id']}, 'name': 'move_to_target'})
+''',
+        'helpers': '''
+commands = []
+for archer in filter_objects(object_type='unit', ally=True, fighter_type='archer'):
+    enemy = nearest(archer, object_type='unit', ally=False)
+    commands.append({'args': {'unit_ids': [archer['object_id']], 'target_id': enemy['object_id']}, 'name': 'move_to_target'})
+''',
+    },
+    'units_near_castle': {
+        'comprehension': '''
+castle = [i for i in battle_state if i['object_id'] == 'Castle1'][0]
+units = [i for i in battle_state if i['object_type'] == 'unit' and i['ally'] is True and ((i['position'][0] - castle['position'][0]) ** 2 + (i['position'][1] - castle['position'][1]) ** 2) ** 0.5 <= 5]
+commands = [{'args': {'unit_ids': [u['object_id'] for u in units], 'x_delta': 0, 'y_delta': 2}, 'name': 'move_in_direction'}]
+''',
+        'helpers': '''
+units = within_radius(get_object('Castle1'), 5, object_type='unit', ally=True)
+commands = [{'args': {'unit_ids': [u['object_id'] for u in units], 'x_delta': 0, 'y_delta': 2}, 'name': 'move_in_direction'}]
+''',
+    },
+}
+
+
+def run_code(battle_state, code, with_helpers):
+    code_state = {'battle_state': battle_state}
+    ts = time.perf_counter()
+    if with_helpers:
+        code_state.update(spatial_helpers(battle_state))
+    interpreter = LocalPythonInterpreter([], {}, max_print_outputs_length=None)
+    interpreter(code, code_state)
+    return time.perf_counter() - ts, interpreter.state['commands']
+
+
+def canonical(commands, battle_state):
+    # within_radius returns objects closest first, and equally distant targets can be picked either way,
+    # so compare unit sets and target distances instead of the exact lists
+    by_id = {obj['object_id']: obj for obj in battle_state}
+    rows = []
+    for command in commands:
+        args = dict(command['args'])
+        args['unit_ids'] = sorted(args['unit_ids'])
+        if 'target_id' in args:
+            unit, target = by_id[args['unit_ids'][0]], by_id[args.pop('target_id')]
+            args['target_distance'] = round(((unit['position'][0] - target['position'][0]) ** 2 + (unit['position'][1] - target['position'][1]) ** 2) ** 0.5, 6)
+        rows.append(json.dumps(args, sort_keys=True))
+    return sorted(rows)
+
+
+def bench(n_objects, repeat):
+    battle_state = [create_game_object(o).__dict__ for o in make_game_objects_data(n_objects)]
+    results = {}
+    for name, task in TASKS.items():
+        row = {}
+        answers = {}
+        for variant, code in task.items():
+            times = []
+            for _ in range(repeat):
+                seconds, commands = run_code(battle_state, code, variant == 'helpers')
+                answers[variant] = canonical(commands, battle_state)
+                times.append(seconds)
+            row[f'{variant}_ms'] = round(min(times) * 1000, 3)
+            row[f'{variant}_chars'] = len(code.strip())
+        row['same_answer'] = answers['comprehension'] == answers['helpers']
+        results[name] = row
+    return {'objects': n_objects, 'tasks': results}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, nargs='+', default=[100, 1000, 2000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    results = [bench(n, args.repeat) for n in args.objects]
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print(f"{result['objects']} objects")
+            for name, row in result['tasks'].items():
+                print(f"  {name:<30} comprehension {row['comprehension_ms']:>10}ms ({row['comprehension_chars']} chars)"
+                      f"  helpers {row['helpers_ms']:>8}ms ({row['helpers_chars']} chars)  same answer: {row['same_answer']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import json
+import time
+
+from benchmarks.tiny_model import make_tiny_model
+from custom_agent.model_wrapper import ModelWrapper
+
+# greedy decoding vs prompt-lookup speculative decoding through ModelWrapper, on CPU with a tiny random model
+# checks that both produce the same text for every prompt and reports the draft acceptance rate,
+# tokens per forward pass and the wall clock speedup. random weights make acceptance depend on the seed,
+# so treat the speedup as a measurement of the loop, not of a real model's acceptance
+# usage:
+# python -m benchmarks.bench_speculative --requests 8 --max-new-tokens 128
+# python -m benchmarks.bench_speculative --hidden-size 256 --layers 4 --json
+
+STOP_SEQUENCES = ["<end_code>", "Observation:"]
+
+
+def make_messages(i):
+    # a CastleAgent-like step: the answer mostly repeats ids and calls that are already in the prompt
+    objects = "\n".join(f"{{'object_id': 'Archer{j}', 'x': {j}, 'y': {i % 7}, 'ally': True}}" for j in range(12))
+    task = f"New task:\nArcher{i % 12} move to the first wall"
+    code = "final_answer([{'args': {'unit_ids': ['Archer1'], 'x': 3, 'y': 4}, 'name': 'move_to_target'}])"
+    return [
+        {"role": "system", "content": [{"type": "text", "text": f"Example:\nCode:\n```py\n{code}\n```<end_code>"}]},
+        {"role": "user", "content": [{"type": "text", "text": f"{objects}\n{task}"}]},
+    ]
+
+
+def run(wrapper, n_requests):
+    outputs = []
+    start = time.perf_counter()
+    for i in range(n_requests):
+        outputs.append(wrapper(make_messages(i), stop_sequences=STOP_SEQUENCES).content)
+    return time.perf_counter() - start, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--num-draft-tokens", type=int, default=10)
+    parser.add_argument("--max-ngram-size", type=int, default=3)
+    parser.add_argument("--hidden-size", type=int, default=128)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results only")
+    args = parser.parse_args()
+
+    model, tokenizer = make_tiny_model(hidden_size=args.hidden_size, num_layers=args.layers, max_new_tokens=args.max_new_tokens)
+    common = dict(model_id="tiny-random-qwen2", max_new_tokens=args.max_new_tokens, prefix_cache_tokens=0)
+    greedy = ModelWrapper.from_model(model, tokenizer, **common)
+    speculative = ModelWrapper.from_model(
+        model, tokenizer, speculative=True,
+        num_draft_tokens=args.num_draft_tokens, max_ngram_size=args.max_ngram_size, **common,
+    )
+    # warm up both paths
+    greedy(make_messages(0), stop_sequences=STOP_SEQUENCES)
+    speculative(make_messages(0), stop_sequences=STOP_SEQUENCES)
+    speculative.speculative_stats.__init__()
+
+    greedy_s, greedy_outputs = run(greedy, args.requests)
+    speculative_s, speculative_outputs = run(speculative, args.requests)
+    results = {
+        "requests": args.requests,
+        "max_new_tokens": args.max_new_tokens,
+        "greedy_s": round(greedy_s, 4),
+        "speculative_s": round(speculative_s, 4),
+        "speedup": round(greedy_s / speculative_s, 2),
+        "identical_outputs": greedy_outputs == speculative_outputs,
+        **speculative.speculative_stats.as_dict(),
+    }
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for name, value in results.items():
+            print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import json
+import subprocess
+import sys
+
+# cold start cost of the server, split into import time and model load time
+# every measurement runs in a fresh interpreter so nothing is already imported or cached
+# usage:
+# python -m benchmarks.bench_startup            # tiny CPU model
+# python -m benchmarks.bench_startup --real     # the unsloth model from get_model (needs a GPU)
+
+IMPORT_SERVER = '''
+import time
+ts = time.perf_counter()
+import server
+print(time.perf_counter() - ts)
+'''
+
+IMPORT_HEAVY = '''
+import importlib, time
+from serving.inference import HEAVY_MODULES
+ts = time.perf_counter()
+for module in HEAVY_MODULES:
+    importlib.import_module(module)
+print(time.perf_counter() - ts)
+'''
+
+LOAD_MODEL = '''
+import importlib, time
+from serving.inference import HEAVY_MODULES
+for module in HEAVY_MODULES:
+    importlib.import_module(module)
+ts = time.perf_counter()
+if {real}:
+    from custom_agent.castle_agent import get_model
+    get_model()
+else:
+    from benchmarks.tiny_model import make_tiny_model
+    from custom_agent.model_wrapper import ModelWrapper
+    ModelWrapper.from_model(*make_tiny_model())
+print(time.perf_counter() - ts)
+'''
+
+
+def time_snippet(code):
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--real', action='store_true', help='load the real model instead of the tiny CPU model')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    snippets = {
+        'import_server_s': IMPORT_SERVER,
+        'import_heavy_modules_s': IMPORT_HEAVY,
+        'model_load_s': LOAD_MODEL.format(real=args.real),
+    }
+    results = {'model': 'real' if args.real else 'tiny'}
+    for name, code in snippets.items():
+        # best of N, since the first run also warms the OS file cache
+        results[name] = round(min(time_snippet(code) for _ in range(args.repeat)), 4)
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for name, value in results.items():
+            print(f'{name}: {value}')
+
+
+if __name__ == '__main__':
+    main()
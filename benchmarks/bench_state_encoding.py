@@ -0,0 +1,77 @@
+import argparse
+import json
+import time
+
+import torch
+
+from benchmarks.battle_states import make_game_objects_data
+from benchmarks.tiny_model import make_tiny_model
+from castle.client_adapter import create_game_object
+from custom_agent.castle_agent import CastleAgent
+from custom_agent.state_encoding import STATE_ENCODERS, token_count_report
+
+# prompt tokens and prefill time of the battle_state encoders as the object count grows
+# token counts use the tiny byte-level tokenizer unless --tokenizer points at a real one (e.g. a local qwen dir)
+# usage:
+# python -m benchmarks.bench_state_encoding --objects 10 100 500
+# python -m benchmarks.bench_state_encoding --tokenizer /path/to/Qwen2.5-3B-Instruct --no-prefill
+
+
+def time_prefill(model, input_ids, repeat=3):
+    with torch.no_grad():
+        best = None
+        for _ in range(repeat):
+            ts = time.perf_counter()
+            model(input_ids=input_ids)
+            elapsed = time.perf_counter() - ts
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, nargs='+', default=[10, 50, 100, 250])
+    parser.add_argument('--tokenizer', default=None, help='path or hub id of a real tokenizer for token counts')
+    parser.add_argument('--no-prefill', action='store_true', help='only count tokens')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    model, tokenizer = make_tiny_model()
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    results = []
+    for n_objects in args.objects:
+        game_objects = [create_game_object(o) for o in make_game_objects_data(n_objects)]
+        battle_state = [i.__dict__ for i in game_objects]
+        report = token_count_report(tokenizer, battle_state)
+        for encoder in STATE_ENCODERS:
+            # full first-step prompt, as PyAgent.step would send it
+            agent = CastleAgent(None, debug_mode=False, state_encoder=encoder, include_tool_text=(encoder == 'json'))
+            task = agent.build_battle_prompt(game_objects, 'Archer move up 3 tiles')
+            messages = [
+                {'role': 'system', 'content': agent.system_prompt},
+                {'role': 'user', 'content': f'New task:\n{task}'},
+            ]
+            input_ids = tokenizer.apply_chat_template(messages, return_tensors='pt')
+            result = {
+                'objects': n_objects,
+                'encoder': encoder,
+                'state_tokens': report[encoder]['tokens'],
+                'state_tokens_per_object': report[encoder]['tokens_per_object'],
+                'prompt_tokens': input_ids.shape[1],
+            }
+            if not args.no_prefill and not args.tokenizer:
+                result['prefill_s'] = round(time_prefill(model, input_ids), 4)
+            results.append(result)
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print(result)
+
+
+if __name__ == '__main__':
+    main()
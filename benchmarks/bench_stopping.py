@@ -0,0 +1,89 @@
+import argparse
+import json
+import time
+from typing import List
+
+import torch
+from transformers import StoppingCriteria
+
+from benchmarks.tiny_model import make_tiny_tokenizer
+from custom_agent.stopping import CODE_FENCE, FINAL_ANSWER_CALL, StopAutomaton, StopSequenceCriteria
+
+# per-token overhead of the stop engine vs. the StopOnStrings criterion it replaced
+# each criterion is called once per generated token with the growing input_ids, like generate does
+# usage:
+# python -m benchmarks.bench_stopping --tokens 1024 --batch-size 8
+
+STOP_SEQUENCES = ["<end_code>", "Observation:"]
+SAMPLE_OUTPUT = (
+    "Knight2 has ally False, so it is the enemy. We will move Knight1 to Knight2 using move_to_target.\n"
+    "Code:\n```py\nmove_command = {'args': {'unit_ids': ['Knight1'], 'target_id': 'Knight2'}, 'name': 'move_to_target'}\n"
+    "commands = [move_command]\n"
+)
+
+
+class LegacyStopOnStrings(StoppingCriteria):
+    # the previous ModelWrapper.make_stopping_criteria implementation, batch of one only
+    def __init__(self, stop_strings: List[str], tokenizer):
+        self.stop_strings = stop_strings
+        self.tokenizer = tokenizer
+        self.stream = ""
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = self.tokenizer.decode(input_ids[0][-1], skip_special_tokens=True)
+        self.stream += generated
+        if any([self.stream.endswith(stop_string) for stop_string in self.stop_strings]):
+            return True
+        return False
+
+
+def make_token_stream(tokenizer, n_tokens):
+    # repeated model-like text that never contains a stop string, so every token is checked
+    ids = tokenizer(SAMPLE_OUTPUT, add_special_tokens=False)["input_ids"]
+    return (ids * (n_tokens // len(ids) + 1))[:n_tokens]
+
+
+def time_criterion(criterion, tokens, batch_size):
+    input_ids = torch.tensor([tokens] * batch_size)
+    start = time.perf_counter()
+    for n in range(1, len(tokens) + 1):
+        criterion(input_ids[:, :n], None)
+    return (time.perf_counter() - start) / len(tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results only")
+    args = parser.parse_args()
+
+    tokenizer = make_tiny_tokenizer()
+    tokens = make_token_stream(tokenizer, args.tokens)
+    automaton = StopAutomaton(STOP_SEQUENCES + [CODE_FENCE, FINAL_ANSWER_CALL], tokenizer)
+
+    results = [
+        {"criterion": "legacy_stop_on_strings", "batch_size": 1,
+         "us_per_token": time_criterion(LegacyStopOnStrings(STOP_SEQUENCES, tokenizer), tokens, 1) * 1e6},
+        {"criterion": "stop_sequence_automaton_cold", "batch_size": 1,
+         "us_per_token": time_criterion(StopSequenceCriteria(StopAutomaton(STOP_SEQUENCES, tokenizer), [STOP_SEQUENCES], 0), tokens, 1) * 1e6},
+    ]
+    for batch_size in sorted({1, args.batch_size}):
+        # a fresh criterion per run, sharing the warm automaton like ModelWrapper does
+        criterion = StopSequenceCriteria(automaton, [STOP_SEQUENCES] * batch_size, 0, stop_on_final_answer=True)
+        time_criterion(criterion, tokens, batch_size)
+        criterion = StopSequenceCriteria(automaton, [STOP_SEQUENCES] * batch_size, 0, stop_on_final_answer=True)
+        results.append({"criterion": "stop_sequence_automaton_warm", "batch_size": batch_size,
+                        "us_per_token": time_criterion(criterion, tokens, batch_size) * 1e6})
+    for result in results:
+        result["us_per_token"] = round(result["us_per_token"], 2)
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print(result)
+
+
+if __name__ == "__main__":
+    main()
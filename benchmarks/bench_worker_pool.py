@@ -0,0 +1,93 @@
+import argparse
+import contextlib
+import functools
+import itertools
+import json
+import os
+import time
+from concurrent.futures import wait
+
+from benchmarks.battle_states import make_game_objects_data
+from benchmarks.bench_spatial import TASKS
+from benchmarks.stub_model import StubModel
+from serving.inference import InferenceService
+from serving.worker_pool import WorkerPool
+
+# command throughput of one in-process InferenceService vs WorkerPools of growing size, with stub models
+# two workloads: 'model' sleeps in the stub like a busy GPU (each worker stands for one device), 'cpu' has the
+# stub answer with the O(n^2) comprehension code of bench_spatial, so the time goes to the python interpreter
+# and only more processes (and cores) help. the cpu workload cannot scale past os.cpu_count()
+# usage:
+# python -m benchmarks.bench_worker_pool
+# python -m benchmarks.bench_worker_pool --workers 1 2 4 --workload cpu --requests 40 --json
+
+
+def cpu_script():
+    # a valid CastleAgent answer whose code is slow to interpret
+    code = TASKS['archers_attack_nearest_enemy']['comprehension']
+    return [f'Thought: every archer attacks its nearest enemy.\nCode:\n```py\n{code}\nfinal_answer(commands)\n```<end_code>']
+
+
+def service_kwargs(args):
+    if args.workload == 'cpu':
+        model_factory = functools.partial(StubModel, script=cpu_script())
+    else:
+        model_factory = functools.partial(StubModel, fixed_latency=args.model_ms / 1000)
+    # no fast path or result cache: every command reaches the model
+    return dict(model_factory=model_factory, agent_workers=args.agent_workers, max_queue_size=args.requests,
+                debug_mode=False, warm_up=False, fast_path=False)
+
+
+def run(service, n_requests, game_objects_data):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        service.start()
+        while not service.is_ready():
+            time.sleep(0.05)
+        if isinstance(service, WorkerPool):
+            # all workers up, not just the first
+            while not all(worker['ready'] for worker in service.worker_health()):
+                time.sleep(0.05)
+        # distinct commands, so nothing could be cached
+        commands = (f'Archers attack the nearest enemy #{i}' for i in itertools.count())
+        ts = time.perf_counter()
+        futures = [service.submit(game_objects_data, next(commands)) for _ in range(n_requests)]
+        wait(futures)
+        elapsed = time.perf_counter() - ts
+        service.stop()
+    return {
+        'ok': sum(1 for future in futures if future.exception() is None),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(n_requests / elapsed, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--workload', choices=['model', 'cpu'], default='model')
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--objects', type=int, default=300, help='game objects per request')
+    parser.add_argument('--model-ms', type=float, default=200.0, help="'model' workload: stub latency per generate")
+    parser.add_argument('--agent-workers', type=int, default=1, help='agent threads per process')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    game_objects_data = make_game_objects_data(args.objects)
+    results = [{'setup': 'in_process', 'workers': 0, **run(InferenceService(**service_kwargs(args)), args.requests, game_objects_data)}]
+    for workers in args.workers:
+        pool = WorkerPool(workers=workers, max_in_flight=args.requests, log_path=os.devnull, **service_kwargs(args))
+        results.append({'setup': 'worker_pool', 'workers': workers, **run(pool, args.requests, game_objects_data)})
+    for row in results:
+        row['speedup'] = round(row['throughput_rps'] / results[0]['throughput_rps'], 2)
+        row['workload'] = args.workload
+        row['cpus'] = os.cpu_count()
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for row in results:
+            print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.battle_states import make_game_objects_data
+
+# concurrent load generator for POST /api/command; reports latency percentiles and throughput as json
+# without --url it starts the real server app in-process (uvicorn on a free port) with a StubModel
+# behind it, so the whole http -> queue -> agent -> interpreter path runs without a GPU
+# usage:
+# python -m benchmarks.load_test --requests 200 --concurrency 16
+# python -m benchmarks.load_test --decode-ms 20 --output load.json
+# python -m benchmarks.load_test --url http://127.0.0.1:5000 --requests 50    # a running server
+
+# mix of orders: the first two are answered by the fast path, the others need the agent
+COMMANDS = [
+    'Archers move up 3 tiles',
+    'Melee units move to the first wall',
+    'Archers hold the line near the castle',
+    'Knights flank the enemy archers',
+]
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def local_server(args):
+    # the real app with a stub model, served by uvicorn in a background thread
+    import uvicorn
+    import server
+    from benchmarks.stub_model import StubModel
+    from serving.inference import InferenceService
+
+    server.service = InferenceService(
+        model_factory=lambda: StubModel(
+            fixed_latency=args.prefill_ms / 1000,
+            decode_seconds_per_token=args.decode_ms / 1000,
+        ),
+        max_queue_size=args.queue_size,
+        agent_workers=args.agent_workers,
+        debug_mode=False,
+        warm_up=False,
+    )
+    port = free_port()
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=uvicorn_server.run, daemon=True)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        thread.start()
+        while not server.service.is_ready():
+            time.sleep(0.05)
+        try:
+            yield f'http://127.0.0.1:{port}'
+        finally:
+            uvicorn_server.should_exit = True
+            thread.join()
+
+
+def run_load(url, n_requests, concurrency, game_objects_data):
+    commands = itertools.cycle(COMMANDS)
+    bodies = [{'command': next(commands), 'gameObjects': game_objects_data} for _ in range(n_requests)]
+    session_local = threading.local()
+
+    def send(body):
+        session = getattr(session_local, 'session', None)
+        if session is None:
+            session = session_local.session = requests.Session()
+        ts = time.perf_counter()
+        try:
+            status = session.post(f'{url}/api/command', json=body, timeout=120).status_code
+        except requests.RequestException:
+            status = None
+        return status, time.perf_counter() - ts
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        responses = list(pool.map(send, bodies))
+    elapsed = time.perf_counter() - started
+
+    ok_latencies = sorted(latency for status, latency in responses if status == 200)
+    return {
+        'requests': n_requests,
+        'concurrency': concurrency,
+        'ok': len(ok_latencies),
+        'busy_503': sum(1 for status, _ in responses if status == 503),
+        'errors': sum(1 for status, _ in responses if status not in (200, 503)),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(ok_latencies) / elapsed, 2),
+        **{
+            f'latency_{name}_ms': round(value * 1000, 2) if value is not None else None
+            for name, value in [
+                ('p50', percentile(ok_latencies, 50)),
+                ('p95', percentile(ok_latencies, 95)),
+                ('p99', percentile(ok_latencies, 99)),
+                ('max', ok_latencies[-1] if ok_latencies else None),
+            ]
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', help='base url of a running server; default starts one with a stub model')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--objects', type=int, default=50, help='game objects per request')
+    parser.add_argument('--prefill-ms', type=float, default=0.0, help='stub model: fixed latency per generate call')
+    parser.add_argument('--decode-ms', type=float, default=0.0, help='stub model: latency per generated token')
+    parser.add_argument('--agent-workers', type=int, default=4, help='local server: agent threads')
+    parser.add_argument('--queue-size', type=int, default=64, help='local server: job queue capacity')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results only')
+    args = parser.parse_args()
+
+    game_objects_data = make_game_objects_data(args.objects)
+    server_context = contextlib.nullcontext(args.url) if args.url else local_server(args)
+    with server_context as url:
+        results = run_load(url, args.requests, args.concurrency, game_objects_data)
+    results['target'] = args.url or 'local stub server'
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for name, value in results.items():
+            print(f'{name}: {value}')
+
+
+if __name__ == '__main__':
+    main()
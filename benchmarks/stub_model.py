@@ -0,0 +1,107 @@
+import itertools
+import time
+from typing import Callable, Dict, List, Optional, Union
+
+from smolagents import ChatMessage, Model
+
+# deterministic stand-in for ModelWrapper, for measuring everything around the model without a GPU
+# replays scripted outputs in order (cycling), or asks a function for each output, and sleeps to simulate
+# prefill (per prompt token) and decode (per output token). token counts are len(text) // 4
+# it has the prepare_prompt / generate_batch / make_chat_message interface, so it works under BatchScheduler,
+# the InferenceService and PyAgent alike
+# usage:
+# model = StubModel(prefill_seconds_per_token=0.00005, decode_seconds_per_token=0.02)
+# agent = CastleAgent(model)
+# service = InferenceService(model_factory=lambda: StubModel(), warm_up=False)
+
+# a CastleAgent answer that works on any battle state
+DEFAULT_SCRIPT = [
+    '''Thought: I will move every allied unit up one tile.
+Code:
+```py
+units = filter_objects(object_type='unit', ally=True)
+final_answer([{'args': {'unit_ids': [u['object_id'] for u in units], 'x_delta': 0, 'y_delta': 1}, 'name': 'move_in_direction'}])
+```<end_code>''',
+]
+
+# first step fails to parse, second step answers: exercises the retry path
+RETRY_SCRIPT = [
+    'Thought: I should move the units, but I forgot the code block.',
+] + DEFAULT_SCRIPT
+
+
+def count_tokens(text):
+    return max(1, len(text) // 4)
+
+
+class StubModel(Model):
+    def __init__(
+        self,
+        script: Union[List[str], Callable[[List[Dict]], str]] = None,
+        prefill_seconds_per_token=0.0,
+        decode_seconds_per_token=0.0,
+        fixed_latency=0.0,
+        model_id='stub-model',
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.model_id = model_id
+        script = script if script is not None else DEFAULT_SCRIPT
+        self.script_fn = script if callable(script) else None
+        self.script = None if callable(script) else itertools.cycle(script)
+        self.prefill_seconds_per_token = prefill_seconds_per_token
+        self.decode_seconds_per_token = decode_seconds_per_token
+        self.fixed_latency = fixed_latency
+        self.calls = 0
+
+    def prepare_prompt(self, messages, stop_sequences=None, token_callback=None, **kwargs) -> Dict:
+        text = ''
+        for message in messages:
+            content = message['content']
+            if isinstance(content, list):
+                content = ''.join(part.get('text', '') for part in content)
+            text += content
+        return {
+            'messages': messages,
+            'input_token_count': count_tokens(text),
+            'stop_sequences': stop_sequences,
+            'token_callback': token_callback,
+            'deadline': kwargs.get('deadline'),
+        }
+
+    def next_output(self, messages):
+        self.calls += 1
+        if self.script_fn is not None:
+            return self.script_fn(messages)
+        return next(self.script)
+
+    def generate_batch(self, prompts: List[Dict]) -> List[Dict]:
+        outputs = [self.next_output(prompt['messages']) for prompt in prompts]
+        output_counts = [count_tokens(output) for output in outputs]
+        # a batch costs as much as its longest prompt and its longest output
+        time.sleep(
+            self.fixed_latency
+            + self.prefill_seconds_per_token * max(prompt['input_token_count'] for prompt in prompts)
+            + self.decode_seconds_per_token * max(output_counts)
+        )
+        results = []
+        for prompt, output, output_count in zip(prompts, outputs, output_counts):
+            if prompt['token_callback'] is not None:
+                for line in output.splitlines(keepends=True):
+                    prompt['token_callback'](line)
+            results.append({
+                'output': output,
+                'out': None,
+                'input_token_count': prompt['input_token_count'],
+                'output_token_count': output_count,
+            })
+        self.last_input_token_count = results[-1]['input_token_count']
+        self.last_output_token_count = results[-1]['output_token_count']
+        return results
+
+    def make_chat_message(self, prompt: Dict, result: Dict) -> ChatMessage:
+        return ChatMessage(role='assistant', content=result['output'], raw={'out': None})
+
+    def __call__(self, messages, stop_sequences: Optional[List[str]] = None, **kwargs) -> ChatMessage:
+        prompt = self.prepare_prompt(messages, stop_sequences=stop_sequences, **kwargs)
+        return self.make_chat_message(prompt, self.generate_batch([prompt])[0])
@@ -0,0 +1,265 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from castle.battle_state import BattleState
+
+# battle states kept on the server between commands, so a client only sends what changed since the last version
+# - a session holds the battle_state rows (dicts, as the interpreter sees them) of its last few versions; a delta
+#   names the version it is based on and lists moved, added and removed objects, and creates the next version
+# - only added objects are parsed; a moved object gets a new row dict, every other row dict is shared with the
+#   base version. IncrementalEncoder (custom_agent/state_encoding.py) matches rows by identity, so the prompt
+#   text of unchanged objects is reused, and the result cache gets an incrementally updated fingerprint
+# - changed objects move to the end of the state, so the prompt up to the first changed row is the same as for
+#   the previous command and the model's prefix cache can skip its prefill
+# - a delta on a version the session no longer has (or an unknown session, or an object id it does not know)
+#   raises StaleSession; the client then sends its whole state again
+# rows are never edited in place; BattleSnapshot.to_dicts hands out copies for agent code to play with
+# delta (client json): {"moved": [{"id": "Knight1", "position": [3, 4]}], "added": [<gameObject>], "removed": ["Wall2"]}
+# usage:
+# store = BattleSessionStore()
+# snapshot = store.start('player-1', data['gameObjects'])                 # version 1
+# snapshot = store.update('player-1', base_version=1, delta=data['delta'])  # version 2
+# agent.run_battle_command(snapshot, command)
+
+
+class StaleSession(Exception):
+    def __init__(self, session_id, version=None, problem='version'):
+        # version: the session's latest version, None if the session is unknown
+        super().__init__(f'battle session {session_id} cannot apply this update ({problem}), send the whole state')
+        self.session_id = session_id
+        self.version = version
+        self.problem = problem
+
+
+def row_hash(row: Dict) -> int:
+    canonical = json.dumps(row, sort_keys=True, separators=(',', ':'), default=str)
+    return int.from_bytes(hashlib.blake2b(canonical.encode(), digest_size=16).digest(), 'big')
+
+
+def parse_rows(game_objects_data: List[Dict]) -> List[Dict]:
+    return BattleState.from_payload(game_objects_data).to_dicts()
+
+
+def parse_delta(delta: Optional[Dict]) -> Dict:
+    # client json -> {'moved': [(id, position)], 'added': [row dicts], 'removed': [ids]}, the form sent to workers
+    delta = delta or {}
+    return {
+        'moved': [(move['id'], [move['position'][0], move['position'][1]]) for move in delta.get('moved', ())],
+        'added': parse_rows(delta.get('added', ())),
+        'removed': list(delta.get('removed', ())),
+    }
+
+
+class RowView:
+    # attribute access to a battle_state row, like ObjectView, for code written for GameObjects (fast path)
+    __slots__ = ('row',)
+
+    def __init__(self, row):
+        self.row = row
+
+    def __getattr__(self, name):
+        # missing keys read as None, like the unit-only attributes of ObjectView
+        return self.row.get(name)
+
+    def to_dict(self) -> Dict:
+        return dict(self.row)
+
+    def __repr__(self):
+        return f"RowView(id={self.row['object_id']}, position={self.row['position']})"
+
+
+class BattleSnapshot:
+    # one version of a session; cheap to make, it shares the session's row dicts
+    def __init__(self, session, version, rows, fingerprint, changed_ids=frozenset(), base_version=None, delta=None):
+        self.session = session
+        self.session_id = session.session_id
+        self.version = version
+        self.rows = rows  # object_id -> (row dict, row hash), in the client's order (added objects at the end)
+        self.fingerprint = fingerprint
+        self.changed_ids = changed_ids  # objects added or moved since base_version
+        self.base_version = base_version  # None for a full state
+        self.delta = delta  # parsed delta from base_version, for mirroring it in a worker process
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return (RowView(row) for row, _ in self.rows.values())
+
+    def row_dicts(self) -> List[Dict]:
+        # the shared rows, not to be changed
+        return [row for row, _ in self.rows.values()]
+
+    def to_dicts(self) -> List[Dict]:
+        return [{**row, 'position': list(row['position'])} for row, _ in self.rows.values()]
+
+    def encode(self, encoder='compact') -> str:
+        return self.session.encoder(encoder).encode(self.row_dicts())
+
+
+class BattleSession:
+    def __init__(self, session_id, history=4):
+        self.session_id = session_id
+        self.history = history
+        self.versions = OrderedDict()  # version -> BattleSnapshot, oldest first
+        self.encoders = {}  # encoder name -> IncrementalEncoder, shared by every version
+        self.lock = threading.Lock()
+        self.touched_at = time.monotonic()
+
+    @property
+    def version(self):
+        return next(reversed(self.versions)) if self.versions else 0
+
+    def latest(self) -> Optional[BattleSnapshot]:
+        return self.versions[self.version] if self.versions else None
+
+    def encoder(self, name):
+        from custom_agent.state_encoding import IncrementalEncoder
+        with self.lock:
+            if name not in self.encoders:
+                self.encoders[name] = IncrementalEncoder(name)
+            return self.encoders[name]
+
+    def _add(self, snapshot):
+        self.versions[snapshot.version] = snapshot
+        while len(self.versions) > self.history:
+            self.versions.popitem(last=False)
+        self.touched_at = time.monotonic()
+        return snapshot
+
+    def reset(self, rows: List[Dict], version=None) -> BattleSnapshot:
+        # a whole state, as the next version (or the given one, when mirroring); older versions are dropped
+        entries = {}
+        fingerprint = 0
+        for row in rows:
+            h = row_hash(row)
+            entries[row['object_id']] = (row, h)
+            fingerprint += h
+        with self.lock:
+            version = version if version is not None else self.version + 1
+            self.versions.clear()
+            return self._add(BattleSnapshot(self, version, entries, f'{fingerprint % 2 ** 128:032x}', frozenset(entries)))
+
+    def apply(self, base_version, delta: Dict, version=None) -> BattleSnapshot:
+        # delta as returned by parse_delta
+        with self.lock:
+            base = self.versions.get(base_version)
+            if base is None:
+                raise StaleSession(self.session_id, self.version)
+            # a copy, so a bad delta leaves the session as it was
+            rows = dict(base.rows)
+            fingerprint = int(base.fingerprint, 16)
+            for object_id in delta['removed']:
+                if object_id in rows:
+                    fingerprint -= rows.pop(object_id)[1]
+            changed = {}  # object_id -> new row, in the order of the delta
+            for row in delta['added']:
+                changed[row['object_id']] = row
+            for object_id, position in delta['moved']:
+                if object_id in changed:
+                    changed[object_id] = {**changed[object_id], 'position': position}
+                    continue
+                old = rows.get(object_id)
+                if old is None:
+                    raise StaleSession(self.session_id, self.version, problem=f'unknown object {object_id}')
+                changed[object_id] = {**old[0], 'position': position}
+            for object_id, row in changed.items():
+                # assigned without popping, so a changed object keeps its place and the order matches a full
+                # payload from the client (ordinals like 'the first enemy knight' depend on it)
+                old = rows.get(object_id)
+                if old is not None:
+                    fingerprint -= old[1]
+                h = row_hash(row)
+                rows[object_id] = (row, h)
+                fingerprint += h
+            version = version if version is not None else self.version + 1
+            return self._add(BattleSnapshot(
+                self, version, rows, f'{fingerprint % 2 ** 128:032x}',
+                changed_ids=frozenset(changed), base_version=base_version, delta=delta,
+            ))
+
+
+class BattleSessionStore:
+    def __init__(self, max_sessions=256, ttl=1800.0, history=4):
+        self.max_sessions = max_sessions
+        self.ttl = ttl  # seconds a session is kept without updates
+        self.history = history  # versions per session that deltas can be based on
+        self.sessions = OrderedDict()  # session id -> BattleSession, least recently used first
+        self.lock = threading.Lock()
+        # stats
+        self.full_updates = 0
+        self.delta_updates = 0
+        self.stale_updates = 0
+        self.changed_objects = 0
+
+    def get(self, session_id) -> Optional[BattleSession]:
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None and time.monotonic() - session.touched_at > self.ttl:
+                del self.sessions[session_id]
+                session = None
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+            return session
+
+    def _get_or_create(self, session_id) -> BattleSession:
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = BattleSession(session_id, self.history)
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            self.sessions.move_to_end(session_id)
+            return session
+
+    def start(self, session_id, game_objects_data: List[Dict], version=None) -> BattleSnapshot:
+        # session_id None makes a new id
+        session_id = session_id or uuid.uuid4().hex
+        snapshot = self._get_or_create(session_id).reset(parse_rows(game_objects_data), version)
+        with self.lock:
+            self.full_updates += 1
+        return snapshot
+
+    def update(self, session_id, base_version, delta: Optional[Dict]) -> BattleSnapshot:
+        # delta as sent by the client
+        session = self.get(session_id)
+        if session is None:
+            with self.lock:
+                self.stale_updates += 1
+            raise StaleSession(session_id)
+        try:
+            snapshot = session.apply(base_version, parse_delta(delta))
+        except StaleSession:
+            with self.lock:
+                self.stale_updates += 1
+            raise
+        with self.lock:
+            self.delta_updates += 1
+            self.changed_objects += len(snapshot.changed_ids)
+        return snapshot
+
+    def install(self, session_id, version, rows=None, base_version=None, delta=None) -> BattleSnapshot:
+        # mirrors a version made by another store (serving/worker_pool.py): from its rows, or from a parsed delta
+        # on a version this store has
+        if rows is not None:
+            return self._get_or_create(session_id).reset(rows, version)
+        session = self.get(session_id)
+        if session is None:
+            raise StaleSession(session_id)
+        if version in session.versions:
+            return session.versions[version]
+        return session.apply(base_version, delta, version)
+
+    def stats(self):
+        return {
+            'sessions': len(self.sessions),
+            'full_updates': self.full_updates,
+            'delta_updates': self.delta_updates,
+            'stale_updates': self.stale_updates,
+            'changed_objects': self.changed_objects,
+        }
@@ -0,0 +1,212 @@
+import json
+import sys
+from array import array
+from typing import Dict, List
+
+# compact container for a whole battle: one array per field instead of one GameObject (with its own __dict__) per entity
+# - from_payload ingests the gameObjects list the client sends in one pass, without per-object classes
+# - iterating yields ObjectView rows (slotted, two fields) with the same attributes as GameObject, so code written
+#   for a list of GameObjects (fast path, pretty_list, ...) keeps working
+# - to_dicts builds the battle_state list of dicts for the interpreter and the prompt, with the same keys in the
+#   same order as GameObject.__dict__ (castles and walls have no name/is_ranged/fighter_type)
+# coordinates are stored as doubles; integral ones come back as ints
+# usage:
+# state = BattleState.from_payload(data['gameObjects'])
+# for obj in state:
+#     print(obj.object_id, obj.position)
+# battle_state = state.to_dicts()
+
+# kinds decide which keys a row has, mirroring the classes create_game_object picks
+KIND_CASTLE, KIND_WALL, KIND_UNIT, KIND_UNKNOWN = range(4)
+NO_ALLY = -1  # walls (ally=None)
+
+
+def _coordinate(value):
+    return int(value) if value.is_integer() else value
+
+
+class ObjectView:
+    __slots__ = ('state', 'index')
+
+    def __init__(self, state, index):
+        self.state = state
+        self.index = index
+
+    @property
+    def object_id(self):
+        return self.state.object_ids[self.index]
+
+    @property
+    def object_type(self):
+        return self.state.type_names[self.state.types[self.index]]
+
+    @property
+    def position(self):
+        return [_coordinate(self.state.xs[self.index]), _coordinate(self.state.ys[self.index])]
+
+    @property
+    def ally(self):
+        ally = self.state.allies[self.index]
+        return None if ally == NO_ALLY else bool(ally)
+
+    @property
+    def name(self):
+        return self.state.names[self.index]
+
+    @property
+    def is_ranged(self):
+        if self.state.kinds[self.index] != KIND_UNIT:
+            return None
+        return bool(self.state.ranged[self.index])
+
+    @property
+    def fighter_type(self):
+        if self.state.kinds[self.index] != KIND_UNIT:
+            return None
+        return self.state.fighter_type_names[self.state.fighter_types[self.index]]
+
+    def to_dict(self) -> Dict:
+        return self.state.row_dict(self.index)
+
+    def __eq__(self, other):
+        return isinstance(other, ObjectView) and other.state is self.state and other.index == self.index
+
+    def __hash__(self):
+        return hash((id(self.state), self.index))
+
+    def __repr__(self):
+        return f"ObjectView(id={self.object_id}, position={self.position})"
+
+
+class BattleState:
+    def __init__(self):
+        self.object_ids = []
+        self.names = []  # None for structures
+        self.kinds = array('b')
+        self.types = array('b')  # index into type_names
+        self.type_names = []
+        self.fighter_types = array('b')  # index into fighter_type_names, units only
+        self.fighter_type_names = []
+        self.allies = array('b')  # 1, 0 or NO_ALLY
+        self.ranged = array('b')
+        self.xs = array('d')
+        self.ys = array('d')
+
+    @classmethod
+    def from_payload(cls, game_objects_data: List[Dict]) -> 'BattleState':
+        state = cls()
+        type_codes = {}
+        fighter_codes = {}
+        names = {}  # names repeat a lot; keep one string per distinct name
+        # bound methods, looked up once for the loop below
+        add_id, add_name = state.object_ids.append, state.names.append
+        add_kind, add_type, add_fighter = state.kinds.append, state.types.append, state.fighter_types.append
+        add_ally, add_ranged, add_x, add_y = state.allies.append, state.ranged.append, state.xs.append, state.ys.append
+        for data in game_objects_data:
+            obj_type = data['type']
+            if obj_type not in type_codes:
+                type_codes[obj_type] = len(state.type_names)
+                state.type_names.append(obj_type)
+            position = data['position']
+            add_id(data['id'])
+            add_type(type_codes[obj_type])
+            add_x(position[0])
+            add_y(position[1])
+            if obj_type == 'unit':
+                fighter_type = data['fighterType']
+                if fighter_type not in fighter_codes:
+                    fighter_codes[fighter_type] = len(state.fighter_type_names)
+                    state.fighter_type_names.append(fighter_type)
+                name = data['name']
+                add_name(names.setdefault(name, sys.intern(name) if isinstance(name, str) else name))
+                add_kind(KIND_UNIT)
+                add_fighter(fighter_codes[fighter_type])
+                add_ally(1 if data['ally'] else 0)
+                # knights and archers ignore isRanged, like the Knight/Archer classes
+                if fighter_type == 'knight':
+                    add_ranged(0)
+                elif fighter_type == 'archer':
+                    add_ranged(1)
+                else:
+                    add_ranged(1 if data['isRanged'] else 0)
+                continue
+            add_name(None)
+            add_fighter(0)
+            add_ranged(0)
+            if obj_type == 'structure':
+                if 'ally' in data:  # Castle has an ally property
+                    add_kind(KIND_CASTLE)
+                    add_ally(1 if data['ally'] else 0)
+                else:
+                    add_kind(KIND_WALL)
+                    add_ally(NO_ALLY)
+            else:
+                print('WARNING creating unknown object', data)
+                add_kind(KIND_UNKNOWN)
+                add_ally(NO_ALLY)
+        return state
+
+    @classmethod
+    def from_json(cls, text) -> 'BattleState':
+        # text (or bytes) of a gameObjects list
+        return cls.from_payload(json.loads(text))
+
+    def __len__(self):
+        return len(self.object_ids)
+
+    def __iter__(self):
+        return (ObjectView(self, i) for i in range(len(self.object_ids)))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.object_ids)
+        if not 0 <= index < len(self.object_ids):
+            raise IndexError('BattleState index out of range')
+        return ObjectView(self, index)
+
+    def row_dict(self, i) -> Dict:
+        kind = self.kinds[i]
+        x, y = self.xs[i], self.ys[i]
+        row = {
+            'object_id': self.object_ids[i],
+            'object_type': self.type_names[self.types[i]],
+            'position': [int(x) if x.is_integer() else x, int(y) if y.is_integer() else y],
+        }
+        if kind == KIND_UNKNOWN:
+            return row
+        ally = self.allies[i]
+        row['ally'] = None if ally == NO_ALLY else bool(ally)
+        if kind == KIND_UNIT:
+            row['name'] = self.names[i]
+            row['is_ranged'] = bool(self.ranged[i])
+            row['fighter_type'] = self.fighter_type_names[self.fighter_types[i]]
+        return row
+
+    def to_dicts(self) -> List[Dict]:
+        # column by column, which is several times faster than row_dict per row
+        type_names = [self.type_names[t] for t in self.types]
+        # structures hold a placeholder 0, which has no name when there are no units at all
+        fighter_names = self.fighter_type_names or [None]
+        fighter_type_names = [fighter_names[f] for f in self.fighter_types]
+        allies = [None if a == NO_ALLY else a == 1 for a in self.allies]
+        xs = [int(x) if x.is_integer() else x for x in self.xs]
+        ys = [int(y) if y.is_integer() else y for y in self.ys]
+        rows = []
+        append = rows.append
+        for object_id, kind, object_type, x, y, ally, name, ranged, fighter_type in zip(
+                self.object_ids, self.kinds, type_names, xs, ys, allies, self.names, self.ranged, fighter_type_names):
+            if kind == KIND_UNIT:
+                append({'object_id': object_id, 'object_type': object_type, 'position': [x, y], 'ally': ally,
+                        'name': name, 'is_ranged': ranged == 1, 'fighter_type': fighter_type})
+            elif kind == KIND_UNKNOWN:
+                append({'object_id': object_id, 'object_type': object_type, 'position': [x, y]})
+            else:
+                append({'object_id': object_id, 'object_type': object_type, 'position': [x, y], 'ally': ally})
+        return rows
+
+
+def as_battle_state(game_objects) -> List[Dict]:
+    # battle_state list of dicts from a BattleState, a BattleSnapshot (castle/battle_session.py) or a list of GameObjects
+    if isinstance(game_objects, BattleState) or hasattr(game_objects, 'to_dicts'):
+        return game_objects.to_dicts()
+    return [i.__dict__ for i in game_objects]
@@ -73,3 +73,42 @@ game_functions = [
 ]
 
 
+
+function_args = {function['name']: function['args'] for function in game_functions}
+
+def validate_commands(commands, battle_state):
+   # checks a final answer against game_functions and the battle state it was made for
+   # battle_state: the dicts the agent saw (see as_battle_state)
+   # returns a list of problems, empty when every command can be applied by the client
+   if not isinstance(commands, list):
+       return [f'the final answer must be a list of commands, got {type(commands).__name__}']
+   object_types = {obj['object_id']: obj['object_type'] for obj in battle_state}
+   problems = []
+   for i, command in enumerate(commands):
+       if not isinstance(command, dict) or not isinstance(command.get('args'), dict):
+           problems.append(f"command {i} must be a dict with 'name' and 'args'")
+           continue
+       name = command.get('name')
+       if name not in function_args:
+           problems.append(f"command {i} has unknown name {name!r}, expected one of {list(function_args)}")
+           continue
+       args = command['args']
+       for arg, spec in function_args[name].items():
+           if spec.get('required') and arg not in args:
+               problems.append(f"command {i} ({name}) is missing the argument {arg!r}")
+       for arg in args:
+           if arg not in function_args[name]:
+               problems.append(f"command {i} ({name}) has unknown argument {arg!r}")
+       unit_ids = args.get('unit_ids', [])
+       if not isinstance(unit_ids, list):
+           problems.append(f"command {i} ({name}): unit_ids must be a list")
+           unit_ids = []
+       for unit_id in unit_ids:
+           if object_types.get(unit_id) != 'unit':
+               problems.append(f"command {i} ({name}): {unit_id!r} is not a unit in battle_state")
+       if 'target_id' in args and args['target_id'] not in object_types:
+           problems.append(f"command {i} ({name}): target {args['target_id']!r} is not in battle_state")
+       for arg in ('x_delta', 'y_delta'):
+           if arg in args and (isinstance(args[arg], bool) or not isinstance(args[arg], (int, float))):
+               problems.append(f"command {i} ({name}): {arg} must be a number")
+   return problems
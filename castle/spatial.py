@@ -0,0 +1,185 @@
+import math
+from typing import Dict, List, Optional
+
+# uniform grid over battle_state positions, built once per request and handed to the agent's interpreter
+# as plain functions (see spatial_helpers), so generated code can ask for "the nearest enemy" instead of
+# writing list comprehensions that scan the whole battle_state on every query
+# a separate grid is built lazily for every filter combination that is queried (e.g. object_type='unit', ally=False),
+# so a query only ever looks at matching objects near the query point
+# helpers return the battle_state dicts themselves, like a list comprehension would
+# usage:
+# index = SpatialIndex(battle_state)
+# index.nearest([3, 4], object_type='structure')
+# index.within_radius(unit, 2.5, ally=False)
+# code_state = {'battle_state': battle_state, **spatial_helpers(battle_state)}
+
+TARGET_OBJECTS_PER_CELL = 2
+
+# descriptions for the system prompt, rendered in castle_agent.yaml
+helper_functions = [
+    {
+        'signature': 'nearest(origin, **filters)',
+        'description': 'the object closest to origin, or None. origin is a position [x, y] or an object from battle_state (which is never returned itself)',
+    },
+    {
+        'signature': 'nearest_k(origin, k, **filters)',
+        'description': 'list of the k objects closest to origin, closest first',
+    },
+    {
+        'signature': 'within_radius(origin, radius, **filters)',
+        'description': 'list of objects at most radius tiles from origin, closest first',
+    },
+    {
+        'signature': 'filter_objects(**filters)',
+        'description': 'list of objects matching the filters, in battle_state order',
+    },
+    {
+        'signature': 'get_object(object_id)',
+        'description': 'the object with this object_id, or None',
+    },
+]
+
+
+def _distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+class _Grid:
+    def __init__(self, objects: List[Dict]):
+        self.objects = objects
+        self.cells = {}
+        if not objects:
+            self.cell_size = 1.0
+            self.bounds = (0, 0, 0, 0)
+            return
+        xs = [o['position'][0] for o in objects]
+        ys = [o['position'][1] for o in objects]
+        area = max(max(xs) - min(xs), 1) * max(max(ys) - min(ys), 1)
+        self.cell_size = max(1.0, math.sqrt(area * TARGET_OBJECTS_PER_CELL / len(objects)))
+        for obj in objects:
+            self.cells.setdefault(self._cell(obj['position']), []).append(obj)
+        cell_xs = [c[0] for c in self.cells]
+        cell_ys = [c[1] for c in self.cells]
+        self.bounds = (min(cell_xs), min(cell_ys), max(cell_xs), max(cell_ys))
+
+    def _cell(self, position):
+        return int(position[0] // self.cell_size), int(position[1] // self.cell_size)
+
+    def _ring(self, cx, cy, r):
+        # cells at chebyshev distance r from (cx, cy)
+        if r == 0:
+            yield cx, cy
+            return
+        for x in range(cx - r, cx + r + 1):
+            yield x, cy - r
+            yield x, cy + r
+        for y in range(cy - r + 1, cy + r):
+            yield cx - r, y
+            yield cx + r, y
+
+    def nearest_k(self, position, k, exclude=None):
+        if not self.objects or k <= 0:
+            return []
+        cx, cy = self._cell(position)
+        min_x, min_y, max_x, max_y = self.bounds
+        max_ring = max(cx - min_x, max_x - cx, cy - min_y, max_y - cy, 0)
+        found = []  # (distance, order, obj)
+        for r in range(max_ring + 1):
+            for cell in self._ring(cx, cy, r):
+                for obj in self.cells.get(cell, ()):
+                    if obj is not exclude:
+                        found.append((_distance(position, obj['position']), len(found), obj))
+            # anything in ring r + 1 or further is at least r * cell_size away
+            if len(found) >= k:
+                found.sort(key=lambda item: item[:2])
+                if found[k - 1][0] <= r * self.cell_size:
+                    break
+        found.sort(key=lambda item: item[:2])
+        return [obj for _, _, obj in found[:k]]
+
+    def within_radius(self, position, radius, exclude=None):
+        span = int(math.ceil(radius / self.cell_size))
+        cx, cy = self._cell(position)
+        min_x, min_y, max_x, max_y = self.bounds
+        found = []
+        # cells outside the occupied bounds are empty, so a huge radius costs no more than a full scan
+        for x in range(max(cx - span, min_x), min(cx + span, max_x) + 1):
+            for y in range(max(cy - span, min_y), min(cy + span, max_y) + 1):
+                for obj in self.cells.get((x, y), ()):
+                    if obj is exclude:
+                        continue
+                    distance = _distance(position, obj['position'])
+                    if distance <= radius:
+                        found.append((distance, len(found), obj))
+        found.sort(key=lambda item: item[:2])
+        return [obj for _, _, obj in found]
+
+
+class SpatialIndex:
+    def __init__(self, battle_state: List[Dict]):
+        self.battle_state = battle_state
+        self.by_id = {obj['object_id']: obj for obj in battle_state}
+        self.grids = {}  # sorted filter items -> _Grid of the matching objects
+        self.filtered = {}  # sorted filter items -> matching objects in battle_state order
+
+    @staticmethod
+    def _key(filters):
+        # None when a filter value is unhashable (position=[x, y]); such filters are scanned every time
+        key = tuple(sorted(filters.items()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _scan(self, filters):
+        return [obj for obj in self.battle_state if all(obj.get(name) == value for name, value in filters.items())]
+
+    def filter_objects(self, **filters) -> List[Dict]:
+        key = self._key(filters)
+        if key is None:
+            return self._scan(filters)
+        if key not in self.filtered:
+            self.filtered[key] = self._scan(filters)
+        return list(self.filtered[key])
+
+    def _grid(self, filters) -> _Grid:
+        key = self._key(filters)
+        if key is None:
+            return _Grid(self._scan(filters))
+        if key not in self.grids:
+            self.grids[key] = _Grid(self.filter_objects(**filters))
+        return self.grids[key]
+
+    def _origin(self, origin):
+        # a position, or an object whose position is used (and which is left out of the results)
+        if isinstance(origin, dict):
+            return origin['position'], origin
+        return origin, None
+
+    def nearest(self, origin, **filters) -> Optional[Dict]:
+        found = self.nearest_k(origin, 1, **filters)
+        return found[0] if found else None
+
+    def nearest_k(self, origin, k, **filters) -> List[Dict]:
+        position, exclude = self._origin(origin)
+        return self._grid(filters).nearest_k(position, k, exclude=exclude)
+
+    def within_radius(self, origin, radius, **filters) -> List[Dict]:
+        position, exclude = self._origin(origin)
+        return self._grid(filters).within_radius(position, radius, exclude=exclude)
+
+    def get_object(self, object_id) -> Optional[Dict]:
+        return self.by_id.get(object_id)
+
+
+def spatial_helpers(battle_state: List[Dict]) -> Dict:
+    # interpreter variables for code_state; the names match helper_functions
+    index = SpatialIndex(battle_state)
+    return {
+        'nearest': index.nearest,
+        'nearest_k': index.nearest_k,
+        'within_radius': index.within_radius,
+        'filter_objects': index.filter_objects,
+        'get_object': index.get_object,
+    }
@@ -10,8 +10,12 @@ def pretty_print_object(obj, indent_level=0):
 
 
    # Get all properties excluding built-in methods and private attributes
-   properties = {key: value for key, value in vars(obj).items()
-                 if not key.startswith('_')}
+   # (BattleState rows have no __dict__, they build theirs with to_dict)
+   if hasattr(obj, 'to_dict'):
+       properties = obj.to_dict()
+   else:
+       properties = {key: value for key, value in vars(obj).items()
+                     if not key.startswith('_')}
 
 
    # Start the output with the class name
@@ -643,11 +643,125 @@ const getGameObjectsForServer = (gameState) => {
   return gameObjectsData;
 };
 
+// Game objects by id, as the server has them at the last synced session version
+const indexGameObjects = (gameObjectsData) => {
+  const index = {};
+  gameObjectsData.forEach((obj) => {
+    // positions are the live arrays of the game objects, keep a copy
+    index[obj.id] = { ...obj, position: [...obj.position] };
+  });
+  return index;
+};
+
+// What changed between two indexed states, as a battle session delta:
+// objects that only changed position are "moved", other new or changed objects are sent whole as "added"
+const diffGameObjects = (previous, current) => {
+  const moved = [];
+  const added = [];
+  Object.values(current).forEach((obj) => {
+    const old = previous[obj.id];
+    if (!old) {
+      added.push(obj);
+      return;
+    }
+    const { position: oldPosition, ...oldRest } = old;
+    const { position, ...rest } = obj;
+    if (JSON.stringify(oldRest) !== JSON.stringify(rest)) {
+      added.push(obj);
+    } else if (oldPosition[0] !== position[0] || oldPosition[1] !== position[1]) {
+      moved.push({ id: obj.id, position: position });
+    }
+  });
+  const removed = Object.keys(previous).filter((id) => !(id in current));
+  return { moved, added, removed };
+};
+
+// Apply the command list returned by the agent
+const applyAgentCommands = (result) => {
+  result.forEach((commandData) => {
+    console.log("processing agent command", commandData);
+    if (commandData.name === "move_to_target") {
+      const { unit_ids, target_id } = commandData.args;
+      medievalGame.moveTarget(unit_ids, target_id);
+    } else if (commandData.name === "move_in_direction") {
+      const { unit_ids, x_delta, y_delta } = commandData.args;
+      medievalGame.moveDirection(unit_ids, x_delta, y_delta);
+    }
+  });
+};
+
+// Read server-sent events from a streamed fetch response, calling onEvent for each one
+const readEventStream = async (response, onEvent) => {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    // events are separated by a blank line
+    let boundary = buffer.indexOf("\n\n");
+    while (boundary !== -1) {
+      const rawEvent = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      const dataLine = rawEvent
+        .split("\n")
+        .find((line) => line.startsWith("data: "));
+      if (dataLine) {
+        onEvent(JSON.parse(dataLine.slice("data: ".length)));
+      }
+      boundary = buffer.indexOf("\n\n");
+    }
+  }
+};
+
 document.addEventListener("DOMContentLoaded", () => {
   const commandInput = document.getElementById("command-input");
   const submitButton = document.getElementById("submit-command");
   const commandStatus = document.getElementById("command-status");
 
+  // the server cancels an older command from the same session when a newer one arrives
+  const sessionId = Math.random().toString(36).slice(2);
+  let inFlight = null;
+  // the server keeps the battle state of this session; commands only send what changed since syncedVersion
+  let syncedVersion = null;
+  let syncedObjects = {};
+
+  // POST the command with a delta against the last synced version, starting the session first if needed
+  const postCommand = async (command, signal) => {
+    const gameObjectsData = getGameObjectsForServer(medievalGame);
+    const currentObjects = indexGameObjects(gameObjectsData);
+    if (syncedVersion === null) {
+      const started = await fetch(apiEndpoint + "session", {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({ sessionId: sessionId, gameObjects: gameObjectsData }),
+        signal: signal,
+      });
+      if (!started.ok) {
+        return { response: started, currentObjects };
+      }
+      syncedVersion = (await started.json()).version;
+      syncedObjects = currentObjects;
+    }
+    const response = await fetch(apiEndpoint + "command/stream", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify({
+        command: command,
+        sessionId: sessionId,
+        baseVersion: syncedVersion,
+        delta: diffGameObjects(syncedObjects, currentObjects),
+      }),
+      signal: signal,
+    });
+    return { response, currentObjects };
+  };
+
   // submit command used by submit button, and record button
   const submitCommand = async () => {
     const command = commandInput.value.trim();
@@ -655,45 +769,66 @@ document.addEventListener("DOMContentLoaded", () => {
 
     commandStatus.textContent = "Loading...";
     submitButton.disabled = true;
+    // stop waiting for the previous command, a newer one replaces it
+    if (inFlight) inFlight.abort();
+    const controller = new AbortController();
+    inFlight = controller;
 
     try {
-      // Send the command with game objects
-      const gameObjectsData = getGameObjectsForServer(medievalGame);
-      const response = await fetch(apiEndpoint + "command", {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({
-          command: command,
-          gameObjects: gameObjectsData,
-        }),
-      });
+      // Send the command with the changes to the game objects
+      let { response, currentObjects } = await postCommand(command, controller.signal);
+      if (response.status === 409) {
+        // the server no longer has our version (restart, expiry): send the whole state again
+        syncedVersion = null;
+        ({ response, currentObjects } = await postCommand(command, controller.signal));
+      }
 
+      if (response.status === 503) {
+        // model still loading or server busy; the server says when to retry
+        const data = await response.json();
+        commandStatus.textContent = `${data.error} - retry in ${data.retry_after}s`;
+        return;
+      }
       if (!response.ok) {
         throw new Error("Server error");
       }
-      const data = await response.json();
-      console.log("command response", data);
-
-      const result = data.result;
-      result.forEach((commandData) => {
-        console.log("processing agent command", commandData);
-        if (commandData.name === "move_to_target") {
-          const { unit_ids, target_id } = commandData.args;
-          medievalGame.moveTarget(unit_ids, target_id);
-        } else if (commandData.name === "move_in_direction") {
-          const { unit_ids, x_delta, y_delta } = commandData.args;
-          medievalGame.moveDirection(unit_ids, x_delta, y_delta);
+
+      // units start moving as soon as the final answer arrives, before the stream closes
+      let gotAnswer = false;
+      let streamError = null;
+      await readEventStream(response, (event) => {
+        if (event.type === "session") {
+          // the server applied our delta; the next one builds on this version
+          syncedVersion = event.version;
+          syncedObjects = currentObjects;
+        } else if (event.type === "step_start") {
+          commandStatus.textContent = `Thinking (step ${event.step})...`;
+        } else if (event.type === "observation") {
+          console.log("agent observation", event.observation);
+        } else if (event.type === "final_answer" && event.result) {
+          console.log("command response", event);
+          applyAgentCommands(event.result);
+          gotAnswer = true;
+          commandStatus.textContent = "Success!";
+        } else if (event.type === "error") {
+          streamError = event.error;
         }
       });
-
-      commandStatus.textContent = "Success!";
+      if (streamError || !gotAnswer) {
+        throw new Error(streamError || "No answer from agent");
+      }
     } catch (error) {
+      if (error.name === "AbortError" || error.message.includes("superseded")) {
+        // replaced by a newer command, which updates the status itself
+        return;
+      }
       console.log("error:", error);
       commandStatus.textContent = "Error!";
     } finally {
-      submitButton.disabled = false;
+      if (inFlight === controller) {
+        inFlight = null;
+        submitButton.disabled = false;
+      }
     }
   };
 
@@ -0,0 +1,49 @@
+import contextlib
+import queue
+import threading
+
+# fixed set of pre-built agents, handed out one request at a time and reset when given back
+# building an agent renders the system prompt and sets up the interpreter, memory and logger; with a pool
+# that happens size times at startup instead of once per request
+# the pool size also caps how many agent runs can be in flight
+# usage:
+# pool = AgentPool(lambda: CastleAgent(model, debug_mode=False), size=4)
+# with pool.agent() as agent:
+#     result = agent.run_battle_command(game_objects, 'Archer move up 3 tiles')
+
+
+class AgentPool:
+    def __init__(self, agent_factory, size=4):
+        self.size = size
+        self.agents = queue.Queue()
+        for _ in range(size):
+            self.agents.put(agent_factory())
+        self.lock = threading.Lock()
+        self.waits = 0  # acquisitions that found no free agent and had to block
+
+    @contextlib.contextmanager
+    def agent(self, timeout=None):
+        # blocks until an agent is free; raises TimeoutError after timeout seconds
+        try:
+            agent = self.agents.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                self.waits += 1
+            try:
+                agent = self.agents.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f'no free agent after {timeout}s')
+        try:
+            yield agent
+        finally:
+            agent.reset()
+            self.agents.put(agent)
+
+    def stats(self):
+        available = self.agents.qsize()
+        return {
+            'size': self.size,
+            'available': available,
+            'in_use': self.size - available,
+            'waits': self.waits,
+        }
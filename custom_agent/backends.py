@@ -0,0 +1,107 @@
+import os
+import re
+import warnings
+
+import torch
+
+# how ModelWrapper loads its model: every backend returns a HF causal lm + tokenizer pair, so generate_batch,
+# the prefix cache, speculative decoding and the ChatMessage contract stay the same whatever runs underneath
+# - 'unsloth': unsloth FastLanguageModel with 4 bit weights, needs a CUDA GPU (the original setup)
+# - 'cpu': plain transformers on the cpu, nn.Linear layers quantised to int8 with torch dynamic quantisation
+#   (weights int8, activations quantised per batch at runtime); for overflow replicas and development machines
+# - 'auto': 'unsloth' when a GPU is visible, 'cpu' otherwise
+# the backend comes from get_model(backend=...), the tier configs in custom_agent/model_registry.py or the
+# CASTLE_BACKEND environment variable; CASTLE_CPU_THREADS sets torch's thread count for the cpu backend
+# (give each worker process of serving/worker_pool.py its share of the cores)
+# usage:
+# model = ModelWrapper(model_id, backend='cpu')
+# model = ModelWrapper(model_id, backend=CPUBackend(quantize=None, threads=8))
+# model = ModelWrapper.from_model(*CPUBackend().prepare(*make_tiny_model()))  # quantise an already loaded model
+
+
+class UnslothBackend:
+    name = 'unsloth'
+
+    def __init__(self, load_in_4bit=True):
+        self.load_in_4bit = load_in_4bit
+
+    def load(self, model_id, max_seq_length):
+        # imported here since unsloth needs a GPU at import time
+        from unsloth import FastLanguageModel
+        model, tokenizer = FastLanguageModel.from_pretrained(
+            model_name=model_id,
+            max_seq_length=max_seq_length,
+            dtype=None,
+            load_in_4bit=self.load_in_4bit
+        )
+        FastLanguageModel.for_inference(model)
+        # model.load_adapter(lora_path)  # for resuming/loading a trained model
+        return model, tokenizer
+
+
+class CPUBackend:
+    name = 'cpu'
+
+    def __init__(self, quantize='int8', threads=None, dtype=torch.float32):
+        # quantize: 'int8' or None (full precision, e.g. to compare outputs)
+        # threads: torch intra-op threads, None keeps torch's default (all cores) unless CASTLE_CPU_THREADS is set
+        if quantize not in ('int8', None):
+            raise ValueError(f'unknown quantize {quantize!r}')
+        self.quantize = quantize
+        env_threads = os.environ.get('CASTLE_CPU_THREADS')
+        self.threads = threads or (int(env_threads) if env_threads else None)
+        self.dtype = dtype
+
+    def load(self, model_id, max_seq_length):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        model_id = cpu_model_id(model_id)
+        tokenizer = AutoTokenizer.from_pretrained(model_id, model_max_length=max_seq_length)
+        model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=self.dtype)
+        return self.prepare(model, tokenizer)
+
+    def prepare(self, model, tokenizer):
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        model = model.to('cpu').eval()
+        if self.quantize == 'int8':
+            with warnings.catch_warnings():
+                # torch.ao.quantization is deprecated in favour of torchao, but the eager dynamic path still works
+                warnings.simplefilter('ignore')
+                # in place, a copy would hold the float32 and int8 weights at the same time while loading
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        return model, tokenizer
+
+
+BACKENDS = {
+    UnslothBackend.name: UnslothBackend,
+    CPUBackend.name: CPUBackend,
+}
+
+
+def get_backend(backend=None):
+    # backend: a backend instance, a name from BACKENDS, 'auto' or None (CASTLE_BACKEND, default 'auto')
+    if backend is not None and not isinstance(backend, str):
+        return backend
+    name = backend or os.environ.get('CASTLE_BACKEND', 'auto')
+    if name == 'auto':
+        name = UnslothBackend.name if torch.cuda.is_available() else CPUBackend.name
+    if name not in BACKENDS:
+        raise ValueError(f'unknown model backend {name!r}, expected one of {sorted(BACKENDS)} or auto')
+    return BACKENDS[name]()
+
+
+def cpu_model_id(model_id):
+    # unsloth's bnb-4bit checkpoints need bitsandbytes on a GPU; unsloth publishes the same models in full
+    # precision under the name without the suffix
+    return re.sub(r'(-unsloth)?-bnb-4bit$', '', model_id)
+
+
+def model_bytes(model):
+    # weight memory, counting int8 packed weights of dynamically quantised layers at their real size
+    total = 0
+    for value in model.state_dict().values():
+        tensors = value if isinstance(value, tuple) else (value,)
+        for tensor in tensors:
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.nelement() * tensor.element_size()
+    return total
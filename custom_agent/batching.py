@@ -0,0 +1,145 @@
+import queue
+from collections import deque
+import threading
+import time
+from typing import Dict, List, Optional
+
+from smolagents import Model, ChatMessage
+
+from custom_agent.deadline import DeadlineExceeded
+from custom_agent.metrics import SPAN_SECONDS
+from custom_agent.model_wrapper import ModelWrapper
+
+# batching scheduler that sits in front of a ModelWrapper
+# agents call it exactly like the model: scheduler(messages, stop_sequences=[...])
+# calls from concurrent agents (one per request thread) are queued, and a single worker thread
+# gathers everything that arrives within batch_window seconds into one generate_batch call
+# prompts whose deadline passed (or was cancelled) while queued are dropped with DeadlineExceeded
+# a traced request's span list travels with its prompt, so the wait here and the batch's prefill and decode
+# land in that request's trace although they run on the worker thread
+# usage:
+# model = BatchScheduler(get_model(), max_batch_size=8, batch_window=0.02)
+# agent = CastleAgent(model)
+
+
+class PendingPrompt:
+    def __init__(self, prompt: Dict):
+        self.prompt = prompt
+        self.queued_at = time.perf_counter()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchScheduler(Model):
+    def __init__(self, model: ModelWrapper, max_batch_size=8, batch_window=0.02, **kwargs):
+        # token counts of the last call are kept per calling thread (one agent each), not per scheduler
+        self.local = threading.local()
+        super().__init__(**kwargs)
+        self.model = model
+        self.model_id = model.model_id
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window  # seconds to wait for more prompts after the first arrives
+        self.pending = queue.Queue()
+        self.batch_sizes = deque(maxlen=1000)  # recent batch sizes, for benchmarks and debugging
+
+        self.worker = threading.Thread(target=self._worker_loop, name="batch-scheduler", daemon=True)
+        self.worker.start()
+
+    def __call__(
+        self,
+        messages: List[Dict[str, str]],
+        stop_sequences: Optional[List[str]] = None,
+        **kwargs,
+    ) -> ChatMessage:
+        # tokenize in the caller's thread so the worker only runs the model
+        pending = PendingPrompt(self.model.prepare_prompt(messages, stop_sequences=stop_sequences, **kwargs))
+        self.pending.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+
+        self.last_input_token_count = pending.result["input_token_count"]
+        self.last_output_token_count = pending.result["output_token_count"]
+        return self.model.make_chat_message(pending.prompt, pending.result)
+
+    @property
+    def last_input_token_count(self):
+        return getattr(self.local, 'input_token_count', None)
+
+    @last_input_token_count.setter
+    def last_input_token_count(self, value):
+        self.local.input_token_count = value
+
+    @property
+    def last_output_token_count(self):
+        return getattr(self.local, 'output_token_count', None)
+
+    @last_output_token_count.setter
+    def last_output_token_count(self, value):
+        self.local.output_token_count = value
+
+    def close(self):
+        # stops the worker once the prompts already queued are served
+        self.pending.put(None)
+        self.worker.join()
+
+    def _collect_batch(self) -> List[PendingPrompt]:
+        # block for the first prompt, then wait up to batch_window for others to join it
+        first = self.pending.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                pending = self.pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if pending is None:
+                # re-queue the stop signal so the worker exits after this batch
+                self.pending.put(None)
+                break
+            batch.append(pending)
+        return batch
+
+    def _drop_stopped(self, batch: List[PendingPrompt]) -> List[PendingPrompt]:
+        # nobody is waiting for these any more, so they do not get a row in the batch
+        live = []
+        for pending in batch:
+            deadline = pending.prompt.get("deadline")
+            reason = deadline.stop_reason() if deadline is not None else None
+            if reason is None:
+                live.append(pending)
+            else:
+                pending.error = DeadlineExceeded(reason)
+                pending.done.set()
+        return live
+
+    def _worker_loop(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                return
+            batch = self._drop_stopped(batch)
+            if not batch:
+                continue
+            self.batch_sizes.append(len(batch))
+            started = time.perf_counter()
+            for pending in batch:
+                SPAN_SECONDS.observe(started - pending.queued_at, span='batch_queue')
+                if pending.prompt.get("timings") is not None:
+                    pending.prompt["timings"].append(('batch_queue', started - pending.queued_at))
+            try:
+                results = self.model.generate_batch([pending.prompt for pending in batch])
+                for pending, result in zip(batch, results):
+                    pending.result = result
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            finally:
+                for pending in batch:
+                    pending.done.set()
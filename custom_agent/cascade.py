@@ -0,0 +1,64 @@
+from smolagents.utils import AgentGenerationError
+
+from custom_agent.metrics import CASCADE_ESCALATIONS
+
+# model cascade policy: every run starts on the smallest tier of a ModelRegistry and moves one tier up
+# each time a step fails in a way a bigger model is likely to fix: the code could not be parsed, it raised
+# in the interpreter, or the final answer failed its checks (for CastleAgent: validate_commands against
+# game_functions and the battle state). generation errors (e.g. out of memory) do not escalate.
+# the easy majority of commands is served at small-model latency, the hard tail by the big model
+# one ModelCascade per agent, since it tracks the tier of that agent's current run; the models are shared
+# usage:
+# cascade = ModelCascade(registry)
+# agent = CastleAgent(cascade)
+# agent.run_battle_command(game_objects, 'Knights flank the enemy archers')
+# cascade.tier   # tier that produced the last answer, e.g. 'small'
+
+
+class ModelCascade:
+    def __init__(self, registry, tiers=None):
+        # tiers: the registry tiers to use, smallest first (default: all of them)
+        self.registry = registry
+        self.tiers = list(tiers) if tiers is not None else registry.tiers
+        self.level = 0
+        self.escalations = []  # (from tier, to tier, reason) of the current run
+
+    @property
+    def tier(self):
+        return self.tiers[self.level]
+
+    @property
+    def model(self):
+        return self.registry.get(self.tier)
+
+    @property
+    def model_id(self):
+        return self.model.model_id
+
+    @property
+    def last_input_token_count(self):
+        return getattr(self.model, 'last_input_token_count', None)
+
+    @property
+    def last_output_token_count(self):
+        return getattr(self.model, 'last_output_token_count', None)
+
+    def __call__(self, messages, **kwargs):
+        return self.model(messages, **kwargs)
+
+    def reset(self):
+        # back to the smallest tier, at the start of every run
+        self.level = 0
+        self.escalations = []
+
+    def should_escalate(self, error):
+        return not isinstance(error, AgentGenerationError)
+
+    def escalate(self, reason):
+        # moves to the next tier; returns False when already on the biggest one
+        if self.level + 1 >= len(self.tiers):
+            return False
+        CASCADE_ESCALATIONS.inc(from_tier=self.tier, reason=reason)
+        self.escalations.append((self.tier, self.tiers[self.level + 1], reason))
+        self.level += 1
+        return True
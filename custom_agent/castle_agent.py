@@ -1,58 +1,116 @@
+import functools
 import json
 import os
-import yaml
 from typing import List
 
+from custom_agent.metrics import span
 from custom_agent.model_wrapper import ModelWrapper
-from custom_agent.py_agent import PyAgent
+from custom_agent.py_agent import PyAgent, load_templates
+from custom_agent.state_encoding import encode_battle_state
 from smolagents.agents import populate_template
-from castle.game_objects import game_functions, GameObject
+from castle.battle_session import BattleSnapshot
+from castle.battle_state import as_battle_state
+from castle.game_objects import game_functions, GameObject, validate_commands
+from castle.spatial import helper_functions, spatial_helpers
 
 
 class CastleAgent(PyAgent):
-    def __init__(self, model, debug_mode=True, code_state=None):
-        super().__init__(model, debug_mode, code_state)
+    def __init__(self, model, debug_mode=True, code_state=None, state_encoder='compact', include_tool_text=False,
+                 executor='interpreter', validate_answers=True, retention=None):
+        # state_encoder: how battle_state is written into prompts, see custom_agent/state_encoding.py
+        # include_tool_text: repeat game_functions in every user prompt (the system prompt already lists them)
+        # executor: 'interpreter' or 'compiled', see custom_agent/compiled_executor.py
+        # validate_answers: reject final answers with unknown commands, ids or missing args (the step is retried,
+        # on a bigger model when model is a ModelCascade)
+        # retention: what agent memory keeps of each step, see custom_agent/retention.py
+        self.state_encoder = state_encoder
+        self.include_tool_text = include_tool_text
+        self.validate_answers = validate_answers
+        super().__init__(model, debug_mode, code_state, executor=executor, retention=retention)
         # we will overwrite code_state in run_battle_command
     
     def create_system_prompt(self):
        # overwrite
-       yaml_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'castle_agent.yaml')
-       with open(yaml_path, 'r') as file:
-            templates = yaml.safe_load(file)
-       self.system_prompt = populate_template(
-           templates["system_prompt"],
-           variables={
-               'in_game_commands': game_functions
-           },
-       )
+       self.system_prompt = render_system_prompt(self.state_encoder)
     
-    def run_battle_command(self, game_objects: List[GameObject], user_request: str):
-        # this is a wrapper of self.run()
-        # user_request = 'All units attack enemy castle'
-        code_state = {
-            'battle_state': [i.__dict__ for i in game_objects]
-        }
+    def build_battle_prompt(self, game_objects: List[GameObject], user_request: str, battle_state=None):
+        # user prompt for a battle command; also used to warm up the model at server start
+        # game_objects: a list of GameObjects, a BattleState or a session's BattleSnapshot
+        # battle_state: the dicts of game_objects, if the caller already has them
+        if isinstance(game_objects, BattleSnapshot):
+            # only the objects changed since the session's last command are encoded again
+            encoded_state = game_objects.encode(self.state_encoder)
+        else:
+            if battle_state is None:
+                battle_state = as_battle_state(game_objects)
+            encoded_state = encode_battle_state(battle_state, self.state_encoder)
         prompt_frame = '''This is the current battleground state:
         battle_state = {battle-state}
-
+        {tool-section}
+        Please provide the command(s) for my request:
+        {user-request}
+        '''
+        tool_section = ''
+        if self.include_tool_text:
+            tool_section = '''
         As a reminder, these are the in-game commands that you have access to:
         <commands>
         {tool-text}
         </commands>
+'''.replace('{tool-text}', json.dumps(game_functions, indent=2))
+        return prompt_frame\
+            .replace('{battle-state}', encoded_state)\
+            .replace('{tool-section}', tool_section)\
+            .replace('{user-request}', user_request)
 
-        Please provide the command(s) for my request:
-        {user-request}
-        '''
-        user_prompt = prompt_frame\
-            .replace('{battle-state}', json.dumps(code_state["battle_state"], indent=2))\
-            .replace('{user-request}', user_request)\
-            .replace('{tool-text}', json.dumps(game_functions, indent=2))
+    def run_battle_command(self, game_objects: List[GameObject], user_request: str, event_callback=None, deadline=None,
+                           step_max=6):
+        # this is a wrapper of self.run()
+        # user_request = 'All units attack enemy castle'
+        # the spatial helpers (nearest, within_radius, ...) share the battle_state dicts and index them once
+        battle_state = as_battle_state(game_objects)
+        code_state = {
+            'battle_state': battle_state,
+            **spatial_helpers(battle_state),
+        }
+        with span('prompt_build'):
+            user_prompt = self.build_battle_prompt(game_objects, user_request, battle_state=battle_state)
         
+        def valid_commands(final_answer, memory):
+            problems = validate_commands(final_answer, battle_state)
+            if problems:
+                raise ValueError('; '.join(problems))
+            return True
+
         # set code state and run
         self.code_state = code_state
-        return self.run(user_prompt)
+        return self.run(
+            user_prompt,
+            step_max=step_max,
+            event_callback=event_callback,
+            deadline=deadline,
+            final_answer_checks=[valid_commands] if self.validate_answers else None,
+        )
+
+@functools.lru_cache(maxsize=None)
+def render_system_prompt(state_encoder):
+    # the system prompt only depends on the state encoder, so it is rendered once per encoder per process
+    yaml_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'castle_agent.yaml')
+    templates = load_templates(yaml_path)
+    return populate_template(
+        templates["system_prompt"],
+        variables={
+            'in_game_commands': game_functions,
+            'helper_functions': helper_functions,
+            'example_battle_states': [
+                encode_battle_state(state, state_encoder) for state in templates["example_battle_states"]
+            ],
+        },
+    )
 
-def get_model():
+def get_model(backend=None):
+    # a single model; to serve several of these as a cascade, see custom_agent/model_registry.py
+    # backend: 'unsloth', 'cpu' or 'auto', None reads CASTLE_BACKEND, see custom_agent/backends.py
     max_seq_length = 8192
     model_names = [
         'unsloth/Qwen2.5-3B-Instruct-unsloth-bnb-4bit',
@@ -66,6 +124,7 @@ def get_model():
     model_name = model_names[0]
     model = ModelWrapper(
         model_id=model_name,
-        max_seq_length=max_seq_length
+        max_seq_length=max_seq_length,
+        backend=backend,
     )
     return model
\ No newline at end of file
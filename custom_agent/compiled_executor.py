@@ -0,0 +1,397 @@
+import ast
+import builtins
+import hashlib
+import threading
+import traceback
+import types
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from smolagents.local_python_executor import (
+    BASE_PYTHON_TOOLS,
+    DEFAULT_MAX_LEN_OUTPUT,
+    ERRORS,
+    MAX_WHILE_ITERATIONS,
+    FinalAnswerException,
+    InterpreterError,
+    PrintContainer,
+    check_module_authorized,
+    get_safe_module,
+)
+from smolagents.utils import BASE_BUILTIN_MODULES, truncate_content
+
+# drop-in replacement for smolagents' LocalPythonInterpreter that runs the model's code as real bytecode
+# LocalPythonInterpreter walks the AST node by node in python, so a list comprehension over a large battle_state
+# costs thousands of interpreted operations per object; here a snippet is checked once, compiled once and then
+# runs at native speed
+# - same contract: executor(code, additional_variables) -> (output, logs, is_final_answer), variables persist in
+#   executor.state between calls, and errors are raised as InterpreterError with the failing line
+# - same rules: only the tools, BASE_PYTHON_TOOLS, exception classes and authorized imports (with the same
+#   dangerous-module filtering) are reachable, and tool names cannot be reassigned
+# - compiled code can reach object internals that the AST walker never exposes, so the check also rejects
+#   names and attributes starting with '_', frame/code attributes (gi_frame, f_globals, ...), str.format on
+#   anything but a plain literal, global/nonlocal, and async/yield constructs
+# - imported modules are handed out behind a view that refuses the builtins module (re.enum.bltns) and builtin
+#   functions or types that are not tools, and every call goes through a guard that rejects those builtins too,
+#   like the interpreter's check before invoking a builtin
+# - every run of a while loop counts its own iterations and stops after MAX_WHILE_ITERATIONS, like the
+#   interpreter's while loop guard; for loops are bounded by their iterable and not counted, as in the interpreter
+# - compiled snippets are cached by the hash of their source, so retried or repeated code skips the check too
+# usage:
+# executor = CompiledPythonExecutor([], tools={})
+# output, logs, is_final_answer = executor(code_action, {'battle_state': battle_state})
+# agent = CastleAgent(model, executor='compiled')
+
+FILENAME = '<agent code>'
+LOOP_GUARD = '_loop_guard'
+CALL_GUARD = '_call_guard'
+RESULT_NAME = '_result'
+
+# constructs that are never allowed, whatever they operate on
+FORBIDDEN_NODES = (
+    ast.Global, ast.Nonlocal, ast.AsyncFunctionDef, ast.AsyncFor, ast.AsyncWith, ast.Await, ast.Yield, ast.YieldFrom,
+)
+# attributes that lead from an object to frames, code or globals
+FORBIDDEN_ATTRIBUTES = frozenset([
+    'gi_frame', 'gi_code', 'gi_yieldfrom', 'cr_frame', 'cr_code', 'cr_await', 'ag_frame', 'ag_code', 'ag_await',
+    'f_globals', 'f_locals', 'f_builtins', 'f_back', 'f_code', 'tb_frame', 'tb_next', 'func_globals',
+])
+FORMAT_METHODS = frozenset(['format', 'format_map'])
+
+
+def is_forbidden_attribute(name):
+    return name.startswith('_') or name in FORBIDDEN_ATTRIBUTES
+
+
+def is_dunder(name):
+    return len(name) > 4 and name.startswith('__') and name.endswith('__')
+
+
+class _SafetyCheck(ast.NodeVisitor):
+    def __init__(self):
+        self.stored_names = set()  # top-level and local names the code assigns, checked against the tools
+        self.dunder_methods = set()  # ids of the FunctionDef nodes defining __init__, __repr__, ... in a class body
+
+    def generic_visit(self, node):
+        if isinstance(node, FORBIDDEN_NODES):
+            raise InterpreterError(f'{node.__class__.__name__} is not supported.')
+        super().generic_visit(node)
+
+    def visit_Name(self, node):
+        if node.id.startswith('_'):
+            raise InterpreterError(f'Names starting with an underscore are not allowed ({node.id}).')
+        if isinstance(node.ctx, (ast.Store, ast.Del)):
+            self.stored_names.add(node.id)
+
+    def visit_Attribute(self, node):
+        if is_forbidden_attribute(node.attr):
+            raise InterpreterError(f'Access to the attribute {node.attr} is not allowed.')
+        if node.attr in FORMAT_METHODS and not (
+            isinstance(node.value, ast.Constant) and isinstance(node.value.value, str) and '_' not in node.value.value
+        ):
+            # '{0.__class__}'.format(x) reads attributes inside the string, out of reach of this check
+            raise InterpreterError(f'str.{node.attr} is only allowed on a literal string; use an f-string instead.')
+        self.generic_visit(node)
+
+    def visit_arg(self, node):
+        if node.arg.startswith('_'):
+            raise InterpreterError(f'Names starting with an underscore are not allowed ({node.arg}).')
+        self.generic_visit(node)
+
+    def _visit_definition(self, node):
+        if node.name.startswith('_') and id(node) not in self.dunder_methods:
+            raise InterpreterError(f'Names starting with an underscore are not allowed ({node.name}).')
+        self.stored_names.add(node.name)
+        self.generic_visit(node)
+
+    visit_FunctionDef = _visit_definition
+
+    def visit_ClassDef(self, node):
+        # dunder methods can be defined directly in a class body, like in the interpreter;
+        # reading them (self.__init__, obj.__class__) is still rejected by visit_Attribute
+        self.dunder_methods.update(
+            id(item) for item in node.body if isinstance(item, ast.FunctionDef) and is_dunder(item.name)
+        )
+        self._visit_definition(node)
+
+    def visit_alias(self, node):
+        name = node.asname or node.name.split('.')[0]
+        if name.startswith('_'):
+            raise InterpreterError(f'Names starting with an underscore are not allowed ({name}).')
+        self.stored_names.add(name)
+
+
+class _LoopGuard(ast.NodeTransformer):
+    # gives every while loop its own counter: reset right before the loop, counted at the top of its body
+    # (_loop_guard_3 = 0; while ...: _loop_guard_3 = _loop_guard(_loop_guard_3))
+    def __init__(self):
+        self.loops = 0
+
+    def visit_While(self, node):
+        self.generic_visit(node)
+        counter = f'{LOOP_GUARD}_{self.loops}'
+        self.loops += 1
+        reset = ast.Assign(targets=[ast.Name(id=counter, ctx=ast.Store())], value=ast.Constant(0))
+        count = ast.Assign(
+            targets=[ast.Name(id=counter, ctx=ast.Store())],
+            value=ast.Call(func=ast.Name(id=LOOP_GUARD, ctx=ast.Load()), args=[ast.Name(id=counter, ctx=ast.Load())], keywords=[]),
+        )
+        node.body.insert(0, ast.copy_location(count, node))
+        return [ast.copy_location(reset, node), node]
+
+
+class _CallGuard(ast.NodeTransformer):
+    # f(x) becomes _call_guard(f)(x) and @decorator becomes @_call_guard(decorator), so the callee is checked
+    # after it is evaluated and before its arguments, keeping python's evaluation order
+    @staticmethod
+    def guard(node):
+        return ast.copy_location(
+            ast.Call(func=ast.Name(id=CALL_GUARD, ctx=ast.Load()), args=[node], keywords=[]), node,
+        )
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        node.func = self.guard(node.func)
+        return node
+
+    def _visit_decorated(self, node):
+        self.generic_visit(node)
+        node.decorator_list = [self.guard(decorator) for decorator in node.decorator_list]
+        return node
+
+    visit_FunctionDef = visit_ClassDef = _visit_decorated
+
+
+def compile_snippet(code):
+    # returns (code object, names the code assigns); raises InterpreterError like the interpreter does
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        raise InterpreterError(
+            f"Code parsing failed on line {e.lineno} due to: {type(e).__name__}\n"
+            f"{e.text}"
+            f"{' ' * (e.offset or 0)}^\n"
+            f"Error: {str(e)}"
+        )
+    check = _SafetyCheck()
+    check.visit(tree)
+    tree = _CallGuard().visit(tree)
+    tree = _LoopGuard().visit(tree)
+    # the interpreter returns the value of the last statement: keep it for expressions and assignments
+    if tree.body:
+        last = tree.body[-1]
+        if isinstance(last, ast.Expr):
+            tree.body[-1] = ast.copy_location(
+                ast.Assign(targets=[ast.Name(id=RESULT_NAME, ctx=ast.Store())], value=last.value), last,
+            )
+        elif isinstance(last, ast.Assign) and len(last.targets) == 1 and isinstance(last.targets[0], ast.Name):
+            tree.body.append(ast.copy_location(
+                ast.Assign(targets=[ast.Name(id=RESULT_NAME, ctx=ast.Store())], value=ast.Name(id=last.targets[0].id, ctx=ast.Load())),
+                last,
+            ))
+    ast.fix_missing_locations(tree)
+    return compile(tree, FILENAME, 'exec'), frozenset(check.stored_names)
+
+
+class CompiledCodeCache:
+    # snippet hash -> (code object, stored names) or the InterpreterError it raised, least recently used first
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, code):
+        key = hashlib.blake2b(code.encode(), digest_size=16).digest()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            try:
+                entry = compile_snippet(code)
+            except InterpreterError as e:
+                entry = e
+            with self.lock:
+                self.misses += 1
+                self.entries[key] = entry
+                if len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        if isinstance(entry, InterpreterError):
+            raise InterpreterError(str(entry))
+        return entry
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+# shared by every executor in the process; compiled code objects do not depend on the state they run with
+CODE_CACHE = CompiledCodeCache()
+
+
+def _checked_attribute_function(function):
+    # getattr/hasattr/setattr with a computed name would bypass the attribute check
+    def wrapper(obj, name, *args):
+        if isinstance(name, str) and is_forbidden_attribute(name):
+            raise InterpreterError(f'Access to the attribute {name} is not allowed.')
+        return function(obj, name, *args)
+    wrapper.__name__ = function.__name__
+    return wrapper
+
+
+# everything the builtins module holds (vars, open, __import__, ...), by identity: open is io.open, not builtins'
+BUILTIN_IDS = frozenset(id(value) for value in vars(builtins).values())
+
+
+def is_builtin(value):
+    # functions and types of the builtins module; bound methods like [].append have their object as __self__
+    if id(value) in BUILTIN_IDS:
+        return True
+    if isinstance(value, types.BuiltinFunctionType):
+        return getattr(value, '__self__', None) is builtins
+    return isinstance(value, type) and value.__module__ == 'builtins'
+
+
+class _ModuleView:
+    # an authorized module as the agent's code sees it: submodules come back wrapped too, and the builtins module
+    # or builtins that are not tools are refused, so re.enum.bltns.vars cannot hand out __import__ or open
+    __slots__ = ('_module', '_executor')
+
+    def __init__(self, module, executor):
+        object.__setattr__(self, '_module', module)
+        object.__setattr__(self, '_executor', executor)
+
+    def __getattr__(self, name):
+        value = getattr(self._module, name)
+        if isinstance(value, types.ModuleType):
+            # get_safe_module hands out a copy of the builtins module, so compare by name
+            if value.__name__ == 'builtins':
+                raise InterpreterError(f'Access to the builtins module is not allowed ({name}).')
+            return _ModuleView(value, self._executor)
+        if not self._executor.is_allowed(value):
+            raise InterpreterError(f'Access to a builtin that has not been explicitly added as a tool is not allowed ({name}).')
+        return value
+
+    def __repr__(self):
+        return repr(self._module)
+
+
+class CompiledPythonExecutor:
+    def __init__(
+        self,
+        additional_authorized_imports: List[str],
+        tools: Dict,
+        max_print_outputs_length: Optional[int] = None,
+        code_cache: Optional[CompiledCodeCache] = None,
+    ):
+        # same attributes as LocalPythonInterpreter, so PyAgent can reset and inspect either one
+        self.custom_tools = {}
+        self.state = {}
+        self.max_print_outputs_length = max_print_outputs_length or DEFAULT_MAX_LEN_OUTPUT
+        self.additional_authorized_imports = additional_authorized_imports
+        self.authorized_imports = list(set(BASE_BUILTIN_MODULES) | set(self.additional_authorized_imports))
+        self.static_tools = {
+            **tools,
+            **BASE_PYTHON_TOOLS.copy(),
+        }
+        self.code_cache = code_cache if code_cache is not None else CODE_CACHE
+        self.print_outputs = PrintContainer()
+        self.builtins = self._make_builtins()
+        self.allowed_builtins = set()
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # same authorization and dangerous-module filtering as the interpreter's import statement
+        dangerous_patterns = (
+            "_os", "os", "subprocess", "_subprocess", "pty", "system", "popen", "spawn", "shutil", "sys",
+            "pathlib", "io", "socket", "compile", "eval", "exec", "multiprocessing",
+        )
+        if level != 0 or not check_module_authorized(name, self.authorized_imports, dangerous_patterns):
+            raise InterpreterError(f"Import of {name} is not allowed. Authorized imports are: {str(self.authorized_imports)}")
+        module = builtins.__import__(name, fromlist=fromlist)
+        return _ModuleView(get_safe_module(module, dangerous_patterns, self.authorized_imports), self)
+
+    def is_allowed(self, value):
+        # builtins are only callable when they are tools, BASE_PYTHON_TOOLS or exception classes
+        return id(value) in self.allowed_builtins or not is_builtin(value)
+
+    def _make_builtins(self):
+        # built once per executor: functions defined by earlier snippets keep this dict as their builtins,
+        # so per-call values (print target) are read through self
+        def loop_guard(iterations):
+            iterations += 1
+            if iterations > MAX_WHILE_ITERATIONS:
+                raise InterpreterError(f"Maximum number of {MAX_WHILE_ITERATIONS} iterations in While loop exceeded")
+            return iterations
+
+        def print_(*args, **kwargs):
+            self.print_outputs.append(" ".join(map(str, args)) + "\n")
+
+        def final_answer(value):
+            raise FinalAnswerException(value)
+
+        def call_guard(function):
+            if not self.is_allowed(function):
+                name = getattr(function, '__name__', type(function).__name__)
+                raise InterpreterError(
+                    f"Invoking a builtin function that has not been explicitly added as a tool is not allowed ({name})."
+                )
+            return function
+
+        return {
+            **ERRORS,
+            **self.static_tools,
+            'getattr': _checked_attribute_function(getattr),
+            'hasattr': _checked_attribute_function(hasattr),
+            'setattr': _checked_attribute_function(setattr),
+            'print': print_,
+            'final_answer': final_answer,
+            '__import__': self._import,
+            '__build_class__': builtins.__build_class__,
+            '__name__': 'agent_code',
+            LOOP_GUARD: loop_guard,
+            CALL_GUARD: call_guard,
+        }
+
+    def __call__(self, code_action: str, additional_variables: Dict) -> Tuple[Any, str, bool]:
+        self.state.update(additional_variables)
+        self.print_outputs = PrintContainer()
+        self.state["_print_outputs"] = self.print_outputs
+        code, stored_names = self.code_cache.get(code_action)
+        for name in stored_names:
+            if name in self.static_tools:
+                raise InterpreterError(f"Cannot assign to name '{name}': doing this would erase the existing tool!")
+
+        # the state is the code's globals, so its variables and functions carry over to the next snippet
+        self.builtins.update(self.custom_tools)
+        self.allowed_builtins = {id(value) for value in self.builtins.values()}
+        namespace = self.state
+        namespace['__builtins__'] = self.builtins
+        namespace.pop(RESULT_NAME, None)
+        try:
+            exec(code, namespace)
+            output, is_final_answer = namespace.pop(RESULT_NAME, None), False
+        except FinalAnswerException as e:
+            output, is_final_answer = e.value, True
+        except InterpreterError as e:
+            raise InterpreterError(f"Code execution failed at line '{self._failing_line(code_action, e)}' due to: {e}")
+        except Exception as e:
+            raise InterpreterError(
+                f"Code execution failed at line '{self._failing_line(code_action, e)}' due to: {type(e).__name__}: {e}"
+            )
+        finally:
+            self.print_outputs.value = truncate_content(str(self.print_outputs), max_length=self.max_print_outputs_length)
+        return output, str(self.print_outputs), is_final_answer
+
+    @staticmethod
+    def _failing_line(code_action, error):
+        # innermost frame of the agent's code
+        lineno = None
+        for frame in traceback.extract_tb(error.__traceback__):
+            if frame.filename == FILENAME:
+                lineno = frame.lineno
+        lines = code_action.splitlines()
+        if lineno is None or not 0 < lineno <= len(lines):
+            return code_action.strip()
+        return lines[lineno - 1].strip()
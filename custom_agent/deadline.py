@@ -0,0 +1,72 @@
+import threading
+import time
+
+# deadlines and cancellation for a single request, shared by every layer that works on it
+# the server creates one per request (or the InferenceService does, with its default timeout); it is checked
+# by the job queue, PyAgent.run before each step, and DeadlineCriteria (custom_agent/stopping.py) after every
+# generated token, so a request that timed out, was superseded by a newer command from the same session,
+# or whose client disconnected stops using the GPU within one token
+# thread-safe: cancel() may be called from the event loop while an agent thread is generating
+# usage:
+# deadline = Deadline(timeout=30)
+# agent.run_battle_command(game_objects, command, deadline=deadline)
+# deadline.cancel('superseded')   # from another thread
+# deadline.check()                # raises DeadlineExceeded('superseded')
+# deadline.on_cancel(lambda reason: ...)   # e.g. forward the cancel to a worker process
+
+
+class DeadlineExceeded(Exception):
+    # reason: 'timeout', 'superseded', 'disconnected' or whatever was passed to cancel()
+    def __init__(self, reason):
+        super().__init__(f'request stopped: {reason}')
+        self.reason = reason
+
+
+class Deadline:
+    def __init__(self, timeout=None):
+        # timeout in seconds from now; None never times out but can still be cancelled
+        self.expires_at = time.monotonic() + timeout if timeout is not None else None
+        self.cancelled = threading.Event()
+        self.reason = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def cancel(self, reason='cancelled'):
+        # the first reason wins, and only the first cancel runs the callbacks
+        with self.lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            self.cancelled.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(reason)
+
+    def on_cancel(self, callback):
+        # callback(reason) runs in the cancelling thread, right away if already cancelled; timeouts do not call it
+        with self.lock:
+            if self.reason is None:
+                self.callbacks.append(callback)
+                return
+        callback(self.reason)
+
+    def remaining(self):
+        # seconds left, 0 once stopped
+        if self.cancelled.is_set():
+            return 0.0
+        if self.expires_at is None:
+            return float('inf')
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def stop_reason(self):
+        # None while the request may keep running
+        if self.cancelled.is_set():
+            return self.reason
+        if self.expires_at is not None and time.monotonic() >= self.expires_at:
+            return 'timeout'
+        return None
+
+    def check(self):
+        reason = self.stop_reason()
+        if reason is not None:
+            raise DeadlineExceeded(reason)
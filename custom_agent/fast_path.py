@@ -0,0 +1,217 @@
+import math
+from typing import List, Optional
+
+from castle.game_objects import GameObject
+from custom_agent.result_cache import normalize_command
+
+# deterministic resolver for simple orders, tried before the agent
+# grammar: <subjects> <verb> (<directions> | <target>)
+#   subjects:   names, object_ids, fighter types (singular = the only ally of that type, plural = all of them),
+#               melee / ranged / everyone, joined by 'and'
+#   directions: 'up 3', '2 tiles left', 'forward' (1 tile), several can be combined ('up 2 and left 1')
+#   target:     '[the] [first|second|..|last] [enemy|our] <wall|castle|knight|archer|name|object_id>'
+# only allied units are ever selected. any word the grammar does not know, an ambiguous reference or an
+# empty selection makes resolve_command return None, and the command goes to the model instead
+# usage:
+# commands = resolve_command(game_objects, 'Knight move left 2')
+# if commands is None:
+#     commands = agent.run_battle_command(game_objects, 'Knight move left 2')
+
+MOVE_VERBS = {'move', 'go', 'walk', 'march', 'run', 'head', 'advance', 'retreat', 'attack', 'charge'}
+TARGET_VERBS = {'attack', 'charge'}  # need a target, not a direction
+VERB_DIRECTIONS = {'advance': (0, 1), 'retreat': (0, -1)}  # used when no direction is given
+DIRECTIONS = {
+    'up': (0, 1), 'forward': (0, 1), 'forwards': (0, 1), 'north': (0, 1),
+    'down': (0, -1), 'back': (0, -1), 'backward': (0, -1), 'backwards': (0, -1), 'south': (0, -1),
+    'right': (1, 0), 'east': (1, 0),
+    'left': (-1, 0), 'west': (-1, 0),
+}
+ORDINALS = {
+    'first': 0, 'second': 1, 'third': 2, 'fourth': 3, 'fifth': 4,
+    'sixth': 5, 'seventh': 6, 'eighth': 7, 'ninth': 8, 'tenth': 9, 'last': -1,
+}
+GROUPS = {'melee', 'ranged', 'everyone', 'everybody', 'army'}
+ALLY_WORDS = {'our', 'my', 'ally', 'allied', 'friendly', 'own'}
+ENEMY_WORDS = {'enemy', 'enemies', 'opponent', 'opponents', 'hostile'}
+SUBJECT_FILLER = {'the', 'all', 'our', 'my', 'ally', 'allied', 'friendly', 'units', 'unit', 'troops', 'please', 'every', 'each'}
+DIRECTION_FILLER = {'and', 'by', 'to', 'the', 'tiles', 'tile', 'spaces', 'space', 'steps', 'step', 'squares', 'square', 'please'}
+TARGET_FILLER = {'to', 'towards', 'toward', 'at', 'the', 'please'}
+STRUCTURE_TYPES = {'wall', 'castle'}
+
+
+class Unresolved(Exception):
+    # raised by the helpers below when the command is not simple enough; resolve_command turns it into None
+    pass
+
+
+def _is_number(word):
+    # finite only: float() also takes 'inf' and 'nan', which would reach the response as an invalid json number
+    try:
+        return math.isfinite(float(word))
+    except ValueError:
+        return False
+
+
+def _number(word):
+    value = float(word)
+    return int(value) if value.is_integer() else value
+
+
+def _singular(word):
+    return word[:-1] if word.endswith('s') else word
+
+
+def _only(objects, what):
+    if len(objects) != 1:
+        raise Unresolved(f'{len(objects)} objects match {what}')
+    return objects[0]
+
+
+def select_units(game_objects: List[GameObject], words: List[str]) -> List[GameObject]:
+    allies = [o for o in game_objects if o.object_type == 'unit' and o.ally is True]
+    if set(words) & ENEMY_WORDS:
+        raise Unresolved('enemy units can not be commanded')
+    selected = []
+    group = []
+    for word in words + ['and']:
+        if word != 'and':
+            group.append(word)
+            continue
+        everyone = bool(set(group) & {'all', 'every', 'each', 'units', 'troops'})
+        keys = [w for w in group if w not in SUBJECT_FILLER]
+        group = []
+        if not keys:
+            if not everyone:
+                raise Unresolved('empty subject')
+            units = allies
+        elif len(keys) > 1:
+            raise Unresolved(f'unknown subject {keys}')
+        else:
+            units = _select_group(allies, keys[0], everyone)
+        selected.extend(u for u in units if u not in selected)
+    if not selected:
+        raise Unresolved('no units selected')
+    return selected
+
+
+def _select_group(allies, key, everyone):
+    if key in GROUPS:
+        if key == 'melee':
+            return [u for u in allies if u.is_ranged is False]
+        if key == 'ranged':
+            return [u for u in allies if u.is_ranged is True]
+        return allies
+    fighter_types = {u.fighter_type for u in allies}
+    if key in fighter_types:
+        # "archer" means the only allied archer, "all archer" / "archers" mean every one of them
+        units = [u for u in allies if u.fighter_type == key]
+        return units if everyone else [_only(units, key)]
+    if key.endswith('s') and _singular(key) in fighter_types:
+        return [u for u in allies if u.fighter_type == _singular(key)]
+    by_id = [u for u in allies if str(u.object_id).lower() == key]
+    if by_id:
+        return by_id
+    by_name = [u for u in allies if str(u.name).lower() == key]
+    if by_name:
+        return [_only(by_name, key)]
+    raise Unresolved(f'unknown subject {key}')
+
+
+def parse_directions(words: List[str]):
+    # returns (x_delta, y_delta), or None when the words hold no direction at all
+    x_delta, y_delta = 0, 0
+    found = False
+    used = set()
+    for i, word in enumerate(words):
+        if word not in DIRECTIONS:
+            continue
+        found = True
+        used.add(i)
+        # the distance is the number right before ('3 tiles up') or right after ('up 3 tiles') the direction
+        distance = 1
+        for j in (i + 1, i + 2, i - 1, i - 2):
+            if 0 <= j < len(words) and j not in used and _is_number(words[j]):
+                between = words[min(i, j) + 1:max(i, j)]
+                if all(w in DIRECTION_FILLER for w in between):
+                    distance = _number(words[j])
+                    used.add(j)
+                    break
+        dx, dy = DIRECTIONS[word]
+        x_delta += dx * distance
+        y_delta += dy * distance
+    if not found:
+        return None
+    leftover = [w for i, w in enumerate(words) if i not in used and w not in DIRECTION_FILLER]
+    if leftover:
+        raise Unresolved(f'unknown words {leftover}')
+    return x_delta, y_delta
+
+
+def find_target(game_objects: List[GameObject], words: List[str], implicit_enemy=False) -> GameObject:
+    words = [w for w in words if w not in TARGET_FILLER]
+    ally = None
+    if words and words[0] in ENEMY_WORDS:
+        ally, words = False, words[1:]
+    elif words and words[0] in ALLY_WORDS:
+        ally, words = True, words[1:]
+    ordinal = None
+    if words and words[0] in ORDINALS:
+        ordinal, words = ORDINALS[words[0]], words[1:]
+        if words and words[0] in ENEMY_WORDS | ALLY_WORDS and ally is None:
+            ally, words = words[0] in ALLY_WORDS, words[1:]
+    # 'wall 2' works like 'second wall'
+    if len(words) == 2 and _is_number(words[1]) and ordinal is None:
+        ordinal, words = int(float(words[1])) - 1, words[:1]
+    if len(words) != 1:
+        raise Unresolved(f'unknown target {words}')
+    key = _singular(words[0]) if words[0] not in STRUCTURE_TYPES else words[0]
+
+    by_id = [o for o in game_objects if str(o.object_id).lower() == words[0]]
+    if by_id and ordinal is None and ally is None:
+        return by_id[0]
+    if key in STRUCTURE_TYPES:
+        candidates = [o for o in game_objects if o.object_type == 'structure' and str(o.object_id).lower().startswith(key)]
+    else:
+        candidates = [o for o in game_objects if o.object_type == 'unit' and (o.fighter_type == key or str(o.name).lower() == words[0])]
+        if ally is None and implicit_enemy:
+            ally = False
+    if ally is not None:
+        candidates = [o for o in candidates if o.ally is ally]
+    if ordinal is None:
+        return _only(candidates, words[0])
+    # ordinals count objects in battle_state order
+    if not -len(candidates) <= ordinal < len(candidates):
+        raise Unresolved(f'no object {ordinal} among {words[0]}')
+    return candidates[ordinal]
+
+
+def resolve_command(game_objects: List[GameObject], command: str) -> Optional[list]:
+    # returns the final_answer command list, or None when the command needs the model
+    words = normalize_command(command).split()
+    verbs = [i for i, w in enumerate(words) if w in MOVE_VERBS]
+    if len(verbs) != 1:
+        return None
+    verb = words[verbs[0]]
+    subject, rest = words[:verbs[0]], words[verbs[0] + 1:]
+    try:
+        units = select_units(game_objects, subject)
+        unit_ids = [u.object_id for u in units]
+        deltas = None if verb in TARGET_VERBS else parse_directions(rest)
+        if deltas is None and verb in VERB_DIRECTIONS and not [w for w in rest if w not in DIRECTION_FILLER]:
+            deltas = VERB_DIRECTIONS[verb]
+        if deltas is not None:
+            if deltas == (0, 0):
+                raise Unresolved('no movement')
+            return [{
+                'args': {'unit_ids': unit_ids, 'x_delta': deltas[0], 'y_delta': deltas[1]},
+                'name': 'move_in_direction',
+            }]
+        target = find_target(game_objects, rest, implicit_enemy=verb in TARGET_VERBS)
+        if target in units:
+            raise Unresolved('unit can not move to itself')
+        return [{
+            'args': {'unit_ids': unit_ids, 'target_id': target.object_id},
+            'name': 'move_to_target',
+        }]
+    except Unresolved:
+        return None
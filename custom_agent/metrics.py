@@ -0,0 +1,222 @@
+import contextlib
+import threading
+import time
+
+# in-process metrics for the agent pipeline, exported in the prometheus text format by /api/metrics
+# counters, gauges and histograms with labels; everything is module-level so any layer can record
+# without passing objects around, and recording costs a lock and a few additions
+# spans: request_parse, prompt_build, chat_template, prefill, decode, model_call, code_parse, execution, queue_wait
+# usage:
+# with span('execution'):
+#     output = python_executor(code, state)
+# STEP_ERRORS.inc(error='AgentParsingError')
+# text = REGISTRY.render()
+# text = REGISTRY.render([snapshot])   # merged with REGISTRY.snapshot() of another process (serving/worker_pool.py)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), chr(92) + "n")}"'
+        for name, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # label values tuple -> value
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _labels(self, key):
+        return list(zip(self.labelnames, key))
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def _merge(self, values, other):
+        # counters and gauges add up across processes
+        for key, value in other.items():
+            values[key] = values.get(key, 0) + value
+
+    def render(self, snapshots=()):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        values = self.snapshot()
+        for snapshot in snapshots:
+            self._merge(values, snapshot)
+        lines.extend(self._render_samples(values))
+        return lines
+
+    def _render_samples(self, values):
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self._labels(key))} {_format_value(value)}'
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # label values -> [count per bucket (not cumulative), sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels):
+        series = self.values.get(self._key(labels))
+        return series[2] if series else 0
+
+    def snapshot(self):
+        with self.lock:
+            return {key: [list(bucket_counts), total, count] for key, (bucket_counts, total, count) in self.values.items()}
+
+    def _merge(self, values, other):
+        for key, (bucket_counts, total, count) in other.items():
+            series = values.get(key)
+            if series is None:
+                values[key] = [list(bucket_counts), total, count]
+            else:
+                series[0] = [a + b for a, b in zip(series[0], bucket_counts)]
+                series[1] += total
+                series[2] += count
+
+    def _render_samples(self, values):
+        for key, (bucket_counts, total, count) in sorted(values.items()):
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{_format_labels(labels + [("le", _format_value(float(bound)))])} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(labels)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(labels)} {count}'
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def snapshot(self):
+        # metric name -> values, picklable, for sending to another process
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def render(self, snapshots=()):
+        # snapshots: REGISTRY.snapshot() of other processes, added to this process' values
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.extend(metric.render([snapshot[name] for snapshot in snapshots if name in snapshot]))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+SPAN_SECONDS = REGISTRY.histogram('castle_span_seconds', 'Time spent in each stage of a request', ['span'])
+REQUEST_SECONDS = REGISTRY.histogram('castle_request_seconds', 'Time from dequeue to answer by serving path', ['path'])
+REQUESTS = REGISTRY.counter('castle_requests_total', 'Finished requests by serving path and outcome', ['path', 'outcome'])
+AGENT_STEPS = REGISTRY.histogram('castle_agent_steps', 'Agent steps per model-served request', buckets=(1, 2, 3, 4, 5, 6, 8, 10))
+STEP_ERRORS = REGISTRY.counter('castle_step_errors_total', 'Failed agent steps by error class', ['error'])
+TOKENS = REGISTRY.counter('castle_tokens_total', 'Prompt and generated tokens', ['kind'])
+SPECULATIVE_TOKENS = REGISTRY.counter(
+    'castle_speculative_tokens_total', 'Prompt-lookup draft tokens proposed and accepted', ['kind'],
+)
+DECODE_TOKENS_PER_SECOND = REGISTRY.histogram(
+    'castle_decode_tokens_per_second', 'Generated tokens per second of decode, per generate call',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+ABORTED_GENERATIONS = REGISTRY.counter(
+    'castle_aborted_generations_total', 'Generations stopped early by a deadline or cancellation', ['reason'],
+)
+CASCADE_ESCALATIONS = REGISTRY.counter(
+    'castle_cascade_escalations_total', 'Runs moved to a bigger model tier, by tier left and failure', ['from_tier', 'reason'],
+)
+TIER_REQUESTS = REGISTRY.counter('castle_tier_requests_total', 'Model-served requests by the tier that answered', ['tier'])
+BATCH_SIZE = REGISTRY.histogram('castle_batch_size', 'Prompts per generate call', buckets=(1, 2, 4, 8, 16, 32))
+QUEUE_DEPTH = REGISTRY.gauge('castle_queue_depth', 'Jobs waiting in the inference queue')
+ACTIVE_JOBS = REGISTRY.gauge('castle_active_jobs', 'Jobs being worked on')
+WORKERS_READY = REGISTRY.gauge('castle_workers_ready', 'Worker processes ready to take commands')
+WORKER_RESTARTS = REGISTRY.counter('castle_worker_restarts_total', 'Worker processes restarted, by cause', ['reason'])
+TRACE_RECORDS = REGISTRY.counter('castle_trace_records_total', 'Request traces written, or dropped from a full ring buffer', ['outcome'])
+
+
+# per thread: while a request trace (custom_agent/tracing.py) collects spans, timings is a list of (name, seconds)
+span_sink = threading.local()
+
+
+@contextlib.contextmanager
+def span(name):
+    ts = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - ts
+        SPAN_SECONDS.observe(elapsed, span=name)
+        timings = getattr(span_sink, 'timings', None)
+        if timings is not None:
+            timings.append((name, elapsed))
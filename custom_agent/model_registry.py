@@ -0,0 +1,80 @@
+import functools
+import threading
+from collections import OrderedDict
+
+# named model tiers, smallest first, each loaded once per process and shared by every agent
+# the cascade (custom_agent/cascade.py) starts every request on the first tier and moves up on failures
+# a tier's factory returns anything callable like a model: a ModelWrapper, a BatchScheduler in front of one,
+# or a StubModel in benchmarks
+# usage:
+# registry = ModelRegistry.from_tiers(MODEL_TIERS)
+# registry.load_all()
+# model = registry.get('small')
+
+# 4 bit weights: about 1, 2 and 5.5 GB of GPU memory, so all three fit next to each other on a 12 GB card
+# on the cpu backend the full precision models are quantised to int8 (the embedding stays float32): about 2.5, 4.5 and 9 GB of ram
+MODEL_TIERS = [
+    {'tier': 'small', 'model_id': 'unsloth/Qwen2.5-Coder-1.5B-Instruct-bnb-4bit'},
+    {'tier': 'medium', 'model_id': 'unsloth/Qwen2.5-3B-Instruct-unsloth-bnb-4bit'},
+    {'tier': 'large', 'model_id': 'unsloth/Qwen2.5-7B-Instruct-bnb-4bit'},
+]
+
+
+def load_model_wrapper(model_id, max_seq_length=8192, backend=None):
+    from custom_agent.model_wrapper import ModelWrapper
+    return ModelWrapper(model_id=model_id, max_seq_length=max_seq_length, backend=backend)
+
+
+def model_wrapper_factory(model_id, max_seq_length=8192, backend=None):
+    # a partial rather than a closure, so worker processes (serving/worker_pool.py) can receive it
+    # backend is a name from custom_agent/backends.py (None: CASTLE_BACKEND in the process that loads the model)
+    return functools.partial(load_model_wrapper, model_id, max_seq_length, backend)
+
+
+def tier_factories(tiers=MODEL_TIERS, max_seq_length=8192):
+    # [(tier, factory), ...] for ModelRegistry or InferenceService(model_tiers=...)
+    # a tier may set 'backend', e.g. {'tier': 'small', 'model_id': ..., 'backend': 'cpu'}
+    return [
+        (tier['tier'], model_wrapper_factory(tier['model_id'], max_seq_length, tier.get('backend')))
+        for tier in tiers
+    ]
+
+
+class ModelRegistry:
+    def __init__(self, factories):
+        # factories: tier name -> zero-argument function that builds the model, smallest tier first
+        self.factories = OrderedDict(factories)
+        self.models = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_tiers(cls, tiers=MODEL_TIERS, max_seq_length=8192):
+        return cls(tier_factories(tiers, max_seq_length))
+
+    @property
+    def tiers(self):
+        return list(self.factories)
+
+    def get(self, tier):
+        # double-checked so concurrent callers load each tier only once
+        model = self.models.get(tier)
+        if model is None:
+            with self.lock:
+                model = self.models.get(tier)
+                if model is None:
+                    print(f'loading model tier {tier}')
+                    model = self.models[tier] = self.factories[tier]()
+        return model
+
+    def load_all(self):
+        # loading a big model in the middle of a request would stall it, so servers load every tier up front
+        for tier in self.tiers:
+            self.get(tier)
+
+    def loaded(self):
+        return [tier for tier in self.tiers if tier in self.models]
+
+    def close(self):
+        for model in self.models.values():
+            if hasattr(model, 'close'):
+                model.close()
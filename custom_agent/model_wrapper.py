@@ -1,25 +1,58 @@
 from PIL import Image
 import json
 import random
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Union
 
-from unsloth import FastLanguageModel
+import torch
 from smolagents import Model, ChatMessage, Tool
-from smolagents.models import get_tool_json_schema, remove_stop_sequences, ChatMessageToolCall, ChatMessageToolCallDefinition
+from smolagents.models import get_tool_json_schema, ChatMessageToolCall, ChatMessageToolCallDefinition
 
-from transformers import StoppingCriteriaList, StoppingCriteria
+from transformers import StoppingCriteriaList
+
+from custom_agent.backends import get_backend
+from custom_agent.deadline import Deadline
+from custom_agent.metrics import ABORTED_GENERATIONS, BATCH_SIZE, DECODE_TOKENS_PER_SECOND, SPAN_SECONDS, TOKENS, span_sink
+from custom_agent.prefix_cache import PrefixCache
+from custom_agent.speculative import SpeculativeStats, speculative_generate
+from custom_agent.stopping import CODE_FENCE, FINAL_ANSWER_CALL, DeadlineCriteria, StopAutomaton, StopSequenceCriteria, truncate_at_stop_sequences
+from custom_agent.streaming import BatchTextStreamer
 
 # make sure version is correct
 # smolagents.__version__  # '1.9.2'
 
 # below is a reimplementation of smolagent TransformerModel, which is a wrapper around a model made with HuggingFace.from_pretrained(model)
-# our implementation is a bare bones version that wraps the Unsloth FastLanguageModel
+# our implementation is a bare bones version that wraps the Unsloth FastLanguageModel, or a quantised cpu model
+# (custom_agent/backends.py)
+# generation is batch-aware: __call__ runs a batch of one, and BatchScheduler (custom_agent/batching.py)
+# groups prompts from concurrent agents into a single generate_batch call
+
+def count_output_tokens(generated_tokens: List[int], pad_token_id, eos_token_ids, stopped_length=None) -> int:
+    # rows that finish early are padded until the whole batch is done; a row ends at its first eos (counted, it
+    # was generated) or where the stop criteria stopped it. pad is often eos (qwen), so it cannot be counted out
+    limit = min(stopped_length, len(generated_tokens)) if stopped_length is not None else len(generated_tokens)
+    for i in range(limit):
+        if generated_tokens[i] in eos_token_ids:
+            return i + 1
+    if pad_token_id in eos_token_ids:
+        return limit
+    return sum(1 for token_id in generated_tokens[:limit] if token_id != pad_token_id)
+
 
 class ModelWrapper(Model):
     def __init__(
         self,
         model_id,
         max_seq_length=4096,
+        model=None,
+        tokenizer=None,
+        prefix_cache_tokens=16384,
+        max_new_tokens=1024,
+        stop_on_final_answer=True,
+        speculative=False,
+        num_draft_tokens=10,
+        max_ngram_size=3,
+        backend=None,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -29,49 +62,73 @@ class ModelWrapper(Model):
         # vlm disabled (visual model)
         self._is_vlm = False
 
-        # our custom logic to use faster Unsloth model
-        model, tokenizer = FastLanguageModel.from_pretrained(
-            model_name=model_id,
-            max_seq_length=max_seq_length,
-            dtype=None,
-            load_in_4bit=True
-        )
-        FastLanguageModel.for_inference(model)
-        # model.load_adapter(lora_path)  # for resuming/loading a trained model
+        # what loads the model: unsloth on a GPU or quantised transformers on the cpu, see custom_agent/backends.py
+        self.backend = get_backend(backend) if model is None else None
+        if model is None:
+            model, tokenizer = self.backend.load(model_id, max_seq_length)
 
         self.kwargs = kwargs
         self.model = model
         self.tokenizer = tokenizer
 
-    def make_stopping_criteria(self, stop_sequences: List[str], tokenizer) -> StoppingCriteriaList:
-        # unsloth code below
-        class StopOnStrings(StoppingCriteria):
-            def __init__(self, stop_strings: List[str], tokenizer):
-                self.stop_strings = stop_strings
-                self.tokenizer = tokenizer
-                self.stream = ""
+        # kv cache of previously seen prompt prefixes (system prompt, earlier agent steps)
+        # set prefix_cache_tokens=0 to disable
+        self.prefix_cache = PrefixCache(max_tokens=prefix_cache_tokens) if prefix_cache_tokens else None
 
-            def reset(self):
-                self.stream = ""
+        # generation budget and stop engine settings, see custom_agent/stopping.py
+        # max_new_tokens=None falls back to the model's generation_config
+        self.max_new_tokens = max_new_tokens
+        self.stop_on_final_answer = stop_on_final_answer
+        self.stop_automata = {}
 
-            def __call__(self, input_ids, scores, **kwargs):
-                generated = self.tokenizer.decode(input_ids[0][-1], skip_special_tokens=True)
-                self.stream += generated
-                if any([self.stream.endswith(stop_string) for stop_string in self.stop_strings]):
-                    return True
-                return False
+        # prompt-lookup speculative decoding for single prompts, see custom_agent/speculative.py
+        # greedy only: the output is the same as generate(do_sample=False), just with fewer forward passes
+        self.speculative = speculative
+        self.num_draft_tokens = num_draft_tokens
+        self.max_ngram_size = max_ngram_size
+        self.speculative_stats = SpeculativeStats()
 
-        return StoppingCriteriaList([StopOnStrings(stop_sequences, tokenizer)])
+    @classmethod
+    def from_model(cls, model, tokenizer, model_id=None, max_seq_length=4096, **kwargs):
+        # wrap an already loaded HF model + tokenizer (e.g. a tiny CPU model for benchmarks)
+        return cls(
+            model_id or model.config.name_or_path,
+            max_seq_length=max_seq_length,
+            model=model,
+            tokenizer=tokenizer,
+            **kwargs,
+        )
 
-    def __call__(
+    def make_stopping_criteria(self, stop_sequences: List[List[str]], tokenizer, prompt_length: int) -> StoppingCriteriaList:
+        # stop_sequences holds one list of stop strings per row
+        # automata are kept per set of stop strings, so their memoised token transitions stay warm across calls
+        patterns = tuple(sorted({stop for row_stops in stop_sequences for stop in row_stops}))
+        automaton = self.stop_automata.get(patterns)
+        if automaton is None:
+            automaton = StopAutomaton(list(patterns) + [CODE_FENCE, FINAL_ANSWER_CALL], tokenizer)
+            self.stop_automata[patterns] = automaton
+        return StoppingCriteriaList([StopSequenceCriteria(
+            automaton,
+            stop_sequences,
+            prompt_length=prompt_length,
+            max_new_tokens=self.max_new_tokens,
+            stop_on_final_answer=self.stop_on_final_answer,
+        )])
+
+    def prepare_prompt(
         self,
         messages: List[Dict[str, str]],
         stop_sequences: Optional[List[str]] = None,
         grammar: Optional[str] = None,
         tools_to_call_from: Optional[List[Tool]] = None,
         images: Optional[List[Image.Image]] = None,
+        token_callback: Optional[Callable[[str], None]] = None,
+        deadline: Optional[Deadline] = None,
         **kwargs,
-    ) -> ChatMessage:
+    ) -> Dict:
+        # tokenizes one request; the result is consumed by generate_batch
+        # token_callback (optional) receives the generated text of this request as it is produced
+        # deadline (optional) stops this request's generation once it passes or is cancelled
         # below is the smolagent code in case we ever want to enable vlm, tools, or more kwargs
         # however, most of this is not necessary for current unsloth models
         completion_kwargs = self._prepare_completion_kwargs(
@@ -84,9 +141,10 @@ class ModelWrapper(Model):
 
         messages = completion_kwargs.pop("messages")
         stop_sequences = completion_kwargs.pop("stop", None)
-        
+
         completion_kwargs['max_seq_length'] = self.max_seq_length
 
+        chat_template_started = time.perf_counter()
         if hasattr(self, "processor"):
             images = [Image.open(image) for image in images] if images else None
             prompt_tensor = self.processor.apply_chat_template(
@@ -106,34 +164,184 @@ class ModelWrapper(Model):
                 return_dict=True,
                 add_generation_prompt=True if tools_to_call_from else False,
             )
+        chat_template_seconds = time.perf_counter() - chat_template_started
+        SPAN_SECONDS.observe(chat_template_seconds, span='chat_template')
+        # the request trace of the calling thread, if any: generate_batch may run on the batch scheduler's thread,
+        # so the prompt carries it there (see custom_agent/tracing.py)
+        timings = getattr(span_sink, 'timings', None)
+        if timings is not None:
+            timings.append(('chat_template', chat_template_seconds))
 
-        prompt_tensor = prompt_tensor.to(self.model.device)
-        count_prompt_tokens = prompt_tensor["input_ids"].shape[1]
+        return {
+            "input_ids": prompt_tensor["input_ids"][0],
+            "stop_sequences": stop_sequences,
+            "tools_to_call_from": tools_to_call_from,
+            "completion_kwargs": completion_kwargs,
+            "token_callback": token_callback,
+            "deadline": deadline,
+            "timings": timings,
+        }
 
-        if stop_sequences:
-            stopping_criteria = self.make_stopping_criteria(
-                stop_sequences, tokenizer=self.processor if hasattr(self, "processor") else self.tokenizer
-            )
-        else:
-            stopping_criteria = None
-        
-        out = self.model.generate(
-            **prompt_tensor,
-            stopping_criteria=stopping_criteria,
-            # **completion_kwargs, # smolagent extra kwargs not needed by unsloth
+    def generate_batch(self, prompts: List[Dict]) -> List[Dict]:
+        # one generate call for all prepared prompts
+        # prompts are left padded so every row continues from the same position
+        tokenizer = self.processor if hasattr(self, "processor") else self.tokenizer
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        prompt_lengths = [len(prompt["input_ids"]) for prompt in prompts]
+        padded_length = max(prompt_lengths)
+
+        input_ids = torch.full((len(prompts), padded_length), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prompts), padded_length), dtype=torch.long)
+        for i, prompt in enumerate(prompts):
+            input_ids[i, padded_length - prompt_lengths[i]:] = prompt["input_ids"]
+            attention_mask[i, padded_length - prompt_lengths[i]:] = 1
+        input_ids = input_ids.to(self.model.device)
+        attention_mask = attention_mask.to(self.model.device)
+
+        stopping_criteria = self.make_stopping_criteria(
+            [prompt["stop_sequences"] or [] for prompt in prompts], tokenizer=tokenizer, prompt_length=padded_length
         )
-        generated_tokens = out[0, count_prompt_tokens:]
-        if hasattr(self, "processor"):
-            output = self.processor.decode(generated_tokens, skip_special_tokens=True)
+        deadline_criteria = None
+        if any(prompt.get("deadline") is not None for prompt in prompts):
+            deadline_criteria = DeadlineCriteria([prompt.get("deadline") for prompt in prompts])
+            stopping_criteria.append(deadline_criteria)
+
+        # the prefix cache only serves single prompts; left padding shifts positions in a batch
+        use_prefix_cache = self.prefix_cache is not None and len(prompts) == 1
+        past_key_values = None
+        if use_prefix_cache:
+            past_key_values, _ = self.prefix_cache.lookup(prompts[0]["input_ids"].tolist())
+
+        streamer = None
+        if any(prompt["token_callback"] is not None for prompt in prompts):
+            streamer = BatchTextStreamer(tokenizer, [prompt["token_callback"] for prompt in prompts])
+        generate_started = time.perf_counter()
+        if self.speculative and len(prompts) == 1:
+            out, past_key_values = self.generate_speculative(input_ids, stopping_criteria, past_key_values, streamer)
         else:
-            output = self.tokenizer.decode(generated_tokens, skip_special_tokens=True)
-        self.last_input_token_count = count_prompt_tokens
-        self.last_output_token_count = len(generated_tokens)
+            generate_kwargs = {}
+            if self.max_new_tokens is not None:
+                generate_kwargs["max_new_tokens"] = self.max_new_tokens
+            if streamer is not None:
+                generate_kwargs["streamer"] = streamer
+            generation = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                pad_token_id=pad_token_id,
+                stopping_criteria=stopping_criteria,
+                past_key_values=past_key_values,
+                return_dict_in_generate=True,
+                **generate_kwargs,
+                # **completion_kwargs, # smolagent extra kwargs not needed by unsloth
+            )
+            out, past_key_values = generation.sequences, generation.past_key_values
+        generate_ended = time.perf_counter()
+        if use_prefix_cache and past_key_values is not None:
+            self.prefix_cache.insert(prompts[0]["input_ids"].tolist(), past_key_values)
+
+        eos_token_ids = self.eos_token_ids(tokenizer)
+        results = []
+        for i, prompt in enumerate(prompts):
+            generated_tokens = out[i, padded_length:]
+            output_token_count = count_output_tokens(
+                generated_tokens.tolist(), pad_token_id, eos_token_ids, stopping_criteria[0].lengths[i]
+            )
+            output = tokenizer.decode(generated_tokens, skip_special_tokens=True)
+            if prompt["stop_sequences"] is not None:
+                output = truncate_at_stop_sequences(output, prompt["stop_sequences"])
+            stopped = deadline_criteria.stopped[i] if deadline_criteria is not None else None
+            if stopped is not None:
+                ABORTED_GENERATIONS.inc(reason=stopped)
+            results.append({
+                "output": output,
+                "out": out[i:i + 1, padded_length - prompt_lengths[i]:],
+                "input_token_count": prompt_lengths[i],
+                "output_token_count": output_token_count,
+                "stopped": stopped,  # deadline stop reason, the output is cut short
+            })
+        prefill_seconds, decode_seconds = self.record_generate_metrics(
+            results, stopping_criteria[0].first_token_at, generate_started, generate_ended
+        )
+        for prompt in prompts:
+            # every row of the batch waited for the whole prefill and decode
+            if prompt.get("timings") is not None:
+                prompt["timings"].extend((('prefill', prefill_seconds), ('decode', decode_seconds)))
+        self.last_input_token_count = results[-1]["input_token_count"]
+        self.last_output_token_count = results[-1]["output_token_count"]
+        return results
+
+    def eos_token_ids(self, tokenizer):
+        eos_token_ids = self.model.generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = []
+        elif isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+        return set(eos_token_ids) | ({tokenizer.eos_token_id} if tokenizer.eos_token_id is not None else set())
 
-        if stop_sequences is not None:
-            output = remove_stop_sequences(output, stop_sequences)
+    def generate_speculative(self, input_ids, stopping_criteria, past_key_values, streamer):
+        # stands in for model.generate on a batch of one; returns the sequences and the kv cache
+        generation_config = self.model.generation_config
+        max_new_tokens = self.max_new_tokens or generation_config.max_new_tokens or self.max_seq_length - input_ids.shape[1]
+        eos_token_ids = generation_config.eos_token_id
+        if isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+        out, past_key_values, stats = speculative_generate(
+            self.model,
+            input_ids,
+            stopping_criteria,
+            max_new_tokens=max_new_tokens,
+            past_key_values=past_key_values,
+            eos_token_ids=eos_token_ids or (),
+            streamer=streamer,
+            num_draft=self.num_draft_tokens,
+            max_ngram=self.max_ngram_size,
+        )
+        self.speculative_stats.add(stats)
+        return out, past_key_values
+
+    def record_generate_metrics(self, results, first_token_at, started, ended):
+        # prefill runs until the first token is out, everything after is decode (shared by all rows)
+        first_token_at = first_token_at or ended
+        prefill_seconds = first_token_at - started
+        decode_seconds = ended - first_token_at
+        output_tokens = sum(result["output_token_count"] for result in results)
+        SPAN_SECONDS.observe(prefill_seconds, span='prefill')
+        SPAN_SECONDS.observe(decode_seconds, span='decode')
+        BATCH_SIZE.observe(len(results))
+        TOKENS.inc(sum(result["input_token_count"] for result in results), kind='input')
+        TOKENS.inc(output_tokens, kind='output')
+        if decode_seconds > 0 and output_tokens > 1:
+            # the first token of each row came out of prefill
+            DECODE_TOKENS_PER_SECOND.observe((output_tokens - len(results)) / decode_seconds)
+        return prefill_seconds, decode_seconds
 
-        if tools_to_call_from is None:
+    def __call__(
+        self,
+        messages: List[Dict[str, str]],
+        stop_sequences: Optional[List[str]] = None,
+        grammar: Optional[str] = None,
+        tools_to_call_from: Optional[List[Tool]] = None,
+        images: Optional[List[Image.Image]] = None,
+        **kwargs,
+    ) -> ChatMessage:
+        prompt = self.prepare_prompt(
+            messages,
+            stop_sequences=stop_sequences,
+            grammar=grammar,
+            tools_to_call_from=tools_to_call_from,
+            images=images,
+            **kwargs,
+        )
+        result = self.generate_batch([prompt])[0]
+        return self.make_chat_message(prompt, result)
+
+    def make_chat_message(self, prompt: Dict, result: Dict) -> ChatMessage:
+        # turns one row of generate_batch output into the ChatMessage that agents expect
+        output = result["output"]
+        out = result["out"]
+        completion_kwargs = prompt["completion_kwargs"]
+
+        if prompt["tools_to_call_from"] is None:
             return ChatMessage(
                 role="assistant",
                 content=output,
@@ -167,4 +375,4 @@ class ModelWrapper(Model):
                     )
                 ],
                 raw={"out": out, "completion_kwargs": completion_kwargs},
-            )
\ No newline at end of file
+            )
@@ -0,0 +1,185 @@
+import threading
+from collections import OrderedDict
+
+from transformers import DynamicCache
+
+# prefix cache of past_key_values, keyed on prompt token ids
+# prompts are stored in a radix tree; a new prompt reuses the kv cache of any stored prompt that
+# shares its longest prefix, so generate only has to prefill the new suffix.
+# every agent step starts with the same castle_agent.yaml system prompt, and every step of a run
+# extends the previous step's prompt, so most of the prefill is served from here.
+# entries are evicted least-recently-used once max_tokens or max_entries is exceeded
+# usage:
+# cache = PrefixCache(max_tokens=16384)
+# past_key_values, n_reused = cache.lookup(token_ids)
+# ... generate(input_ids, past_key_values=past_key_values) ...
+# cache.insert(token_ids, generated.past_key_values)
+
+
+class _Node:
+    __slots__ = ('edge', 'children', 'parent', 'entry')
+
+    def __init__(self, edge=(), parent=None):
+        self.edge = edge  # token ids on the edge from parent to this node
+        self.children = {}  # first token of child edge -> child node
+        self.parent = parent
+        self.entry = None  # _Entry if a stored prompt ends at this node
+
+
+class _Entry:
+    __slots__ = ('node', 'length', 'past_key_values')
+
+    def __init__(self, node, length, past_key_values):
+        self.node = node
+        self.length = length
+        self.past_key_values = past_key_values
+
+
+def slice_cache(past_key_values, length):
+    # copy of the first `length` positions; generate appends to the cache it is given,
+    # so stored entries are never handed out directly
+    if isinstance(past_key_values, tuple):
+        past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+    sliced = DynamicCache()
+    for layer_idx in range(len(past_key_values.key_cache)):
+        sliced.update(
+            past_key_values.key_cache[layer_idx][..., :length, :].clone(),
+            past_key_values.value_cache[layer_idx][..., :length, :].clone(),
+            layer_idx,
+        )
+    return sliced
+
+
+class PrefixCache:
+    def __init__(self, max_tokens=16384, max_entries=32, min_prefix_tokens=16):
+        self.max_tokens = max_tokens
+        self.max_entries = max_entries
+        self.min_prefix_tokens = min_prefix_tokens  # shorter matches are not worth the copy
+        self.root = _Node()
+        self.entries = OrderedDict()  # _Entry -> None, least recently used first
+        self.total_tokens = 0
+        self.lock = threading.Lock()
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def _match(self, token_ids):
+        # walk the tree as far as token_ids match; returns (deepest node covering the match, match length)
+        node = self.root
+        i = 0
+        while i < len(token_ids):
+            child = node.children.get(token_ids[i])
+            if child is None:
+                break
+            edge = child.edge
+            j = 0
+            while j < len(edge) and i + j < len(token_ids) and edge[j] == token_ids[i + j]:
+                j += 1
+            i += j
+            node = child
+            if j < len(edge):
+                break
+        return node, i
+
+    def _any_entry(self, node):
+        # every entry below node shares the matched prefix; take the first we find
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.entry is not None:
+                return node.entry
+            stack.extend(node.children.values())
+        return None
+
+    def lookup(self, token_ids):
+        # returns (past_key_values, number of reused tokens), or (None, 0) on a miss
+        token_ids = tuple(token_ids)
+        with self.lock:
+            node, matched = self._match(token_ids)
+            # leave at least one token for generate to prefill
+            matched = min(matched, len(token_ids) - 1)
+            entry = self._any_entry(node) if matched >= self.min_prefix_tokens else None
+            if entry is None:
+                self.misses += 1
+                return None, 0
+            self.entries.move_to_end(entry)
+            self.hits += 1
+            self.reused_tokens += matched
+            return slice_cache(entry.past_key_values, matched), matched
+
+    def insert(self, token_ids, past_key_values):
+        # stores the kv cache for token_ids; past_key_values may run longer (e.g. generated tokens)
+        token_ids = tuple(token_ids)
+        if len(token_ids) < self.min_prefix_tokens or len(token_ids) > self.max_tokens:
+            return
+        stored = slice_cache(past_key_values, len(token_ids))
+        with self.lock:
+            node = self.root
+            i = 0
+            while i < len(token_ids):
+                child = node.children.get(token_ids[i])
+                if child is None:
+                    child = _Node(token_ids[i:], parent=node)
+                    node.children[token_ids[i]] = child
+                    node = child
+                    break
+                edge = child.edge
+                j = 0
+                while j < len(edge) and i + j < len(token_ids) and edge[j] == token_ids[i + j]:
+                    j += 1
+                if j < len(edge):
+                    # split the edge so the new prompt can end or branch in the middle of it
+                    middle = _Node(edge[:j], parent=node)
+                    node.children[token_ids[i]] = middle
+                    child.edge = edge[j:]
+                    child.parent = middle
+                    middle.children[edge[j]] = child
+                    child = middle
+                node = child
+                i += j
+
+            if node.entry is not None:
+                # same prompt stored again, replace it in place
+                self.total_tokens -= node.entry.length
+                del self.entries[node.entry]
+            # entries further up the path are prefixes of this prompt, the new entry covers them
+            ancestor = node.parent
+            while ancestor is not None:
+                if ancestor.entry is not None:
+                    self._remove(ancestor.entry)
+                ancestor = ancestor.parent
+
+            entry = _Entry(node, len(token_ids), stored)
+            node.entry = entry
+            self.entries[entry] = None
+            self.total_tokens += entry.length
+
+            while self.entries and (self.total_tokens > self.max_tokens or len(self.entries) > self.max_entries):
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, entry):
+        del self.entries[entry]
+        self.total_tokens -= entry.length
+        node = entry.node
+        node.entry = None
+        # prune branches that no longer lead to an entry
+        while node.parent is not None and node.entry is None and not node.children:
+            del node.parent.children[node.edge[0]]
+            node = node.parent
+
+    def clear(self):
+        with self.lock:
+            self.root = _Node()
+            self.entries.clear()
+            self.total_tokens = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'reused_tokens': self.reused_tokens,
+            'entries': len(self.entries),
+            'cached_tokens': self.total_tokens,
+        }
@@ -1,3 +1,4 @@
+import functools
 import yaml
 import time
 from rich.text import Text
@@ -7,6 +8,12 @@ from rich.console import Group
 import os
 import traceback
 
+from custom_agent.cascade import ModelCascade
+from custom_agent.compiled_executor import CompiledPythonExecutor
+from custom_agent.deadline import DeadlineExceeded
+from custom_agent.metrics import AGENT_STEPS, STEP_ERRORS, span
+from custom_agent.retention import RetentionPolicy
+
 
 
 from smolagents.memory import AgentMemory, TaskStep, ActionStep, MemoryStep, ToolCall
@@ -29,12 +36,29 @@ from smolagents.local_python_executor import (
 # see the log:
 # agent.memory.replay(detailed=True)
 # - also, default PyAgent(debug_mode=True) option should have active logging
+# streaming: agent.run(task, event_callback=fn) calls fn(event_dict) for step boundaries, generated tokens,
+# execution observations, step errors and the final answer (see emit below)
+# reuse: agent.reset() clears memory, code_state and the interpreter between runs (see agent_pool.py)
+# cascade: with a ModelCascade as the model, failed steps are retried on the next bigger model (see cascade.py)
+# deadlines: agent.run(task, deadline=Deadline(timeout=30)) stops generation when the deadline passes or is
+# cancelled, and skips steps that would not finish in the time left; run raises DeadlineExceeded in both cases
+# retention: what memory keeps of each step (model inputs, raw model output tensors), see retention.py
+
+
+@functools.lru_cache(maxsize=None)
+def load_templates(yaml_path):
+    # prompt templates are parsed once per process; do not modify the returned dict
+    with open(yaml_path, 'r') as file:
+        return yaml.safe_load(file)
 
 
 
 class PyAgent:
-   def __init__(self, model, debug_mode=True, code_state=None):
+   def __init__(self, model, debug_mode=True, code_state=None, executor='interpreter', retention=None):
+        # executor: 'interpreter' (smolagents' AST walker) or 'compiled' (bytecode, see compiled_executor.py)
+        # retention: a RetentionPolicy, by default only the latest model input and no raw output tensors are kept
         self.model = model
+        self.retention = retention if retention is not None else RetentionPolicy()
 
         # tools and managed_agents can be added, similar to CodeAgent
         self.tools = {}
@@ -44,7 +68,8 @@ class PyAgent:
 
         self.additional_authorized_imports = [] # List[str] if specified
         self.code_state = code_state or dict() # to store variables
-        self.python_executor = LocalPythonInterpreter(
+        executor_class = CompiledPythonExecutor if executor == 'compiled' else LocalPythonInterpreter
+        self.python_executor = executor_class(
             self.additional_authorized_imports,
             self.all_tools,
             max_print_outputs_length=None,
@@ -55,10 +80,25 @@ class PyAgent:
         self.memory = AgentMemory(self.system_prompt)
         self.logger = AgentLogger(
             level=LogLevel.DEBUG if debug_mode else LogLevel.INFO)
+        self.event_callback = None  # set during run() when streaming
+        self.deadline = None  # set during run() when the request has one
+        # moving average of step durations, kept across runs; decides if another step fits before the deadline
+        self.step_seconds = None
+        # tokens the model read and wrote during the current (or last) run
+        self.input_tokens = 0
+        self.output_tokens = 0
 
 
-   def run(self, task: str, task_images=None, step_max=6, final_answer_checks=None):
+   def run(self, task: str, task_images=None, step_max=6, final_answer_checks=None, event_callback=None, deadline=None):
        # final_answer_checks: validator functions go here (final_answer, memory) => bool
+       # event_callback: optional fn(event_dict) to stream progress, see emit()
+       # deadline: optional custom_agent.deadline.Deadline for this run
+       self.event_callback = event_callback
+       self.deadline = deadline
+       self.input_tokens = 0
+       self.output_tokens = 0
+       if isinstance(self.model, ModelCascade):
+           self.model.reset()
 
 
        task_step = TaskStep(task=task, task_images=task_images)
@@ -66,10 +106,14 @@ class PyAgent:
 
 
        final_answer = None
+       stopped = None
        step_num = 1
        # iterate until we get final answer
        # intermediate actions will be added to memory.steps
        while final_answer is None and step_num < step_max:
+           stopped = self.check_step_budget()
+           if stopped is not None:
+               break
            # timing
            ts_start = time.time()
            action = ActionStep(
@@ -80,6 +124,7 @@ class PyAgent:
            try:
                # planning would go here; we skip
                self.logger.log_rule(f"Step {step_num}", level=LogLevel.INFO)
+               self.emit("step_start", step=step_num)
 
 
                # step forward
@@ -94,22 +139,67 @@ class PyAgent:
                                f"Check {check_function.__name__} failed with error: {e}", self.logger)
            except AgentError as e:
                action.error = e
+               STEP_ERRORS.inc(error=type(e).__name__)
+               self.emit("step_error", step=step_num, error_type=type(e).__name__, message=str(e))
+               if isinstance(self.model, ModelCascade) and self.model.should_escalate(e):
+                   if self.model.escalate(reason=type(e).__name__):
+                       self.emit("escalate", step=step_num, tier=self.model.tier)
+           except DeadlineExceeded as e:
+               stopped = e
            finally:
                action.end_time = time.time()
                action.duration = action.end_time - ts_start
                self.memory.steps.append(action)  # add to our memory
                step_num += 1
-
-
+           if stopped is not None:
+               break
+           self.step_seconds = action.duration if self.step_seconds is None else 0.7 * self.step_seconds + 0.3 * action.duration
+
+
+       AGENT_STEPS.observe(step_num - 1)
+       self.deadline = None
+       if stopped is not None:
+           self.event_callback = None
+           print(f'Stopped after {step_num - 1} steps: {stopped.reason}')
+           STEP_ERRORS.inc(error=type(stopped).__name__)
+           raise stopped
        if final_answer is None:
            print(f'No answer after {step_max - 1} steps')
+       self.emit("final_answer", result=final_answer, steps=step_num - 1)
+       self.event_callback = None
        return final_answer
+
+   def check_step_budget(self):
+       # returns DeadlineExceeded if the run must stop before the next step, else None
+       # a step is skipped when the average step takes longer than the time left, since its answer would be late
+       if self.deadline is None:
+           return None
+       reason = self.deadline.stop_reason()
+       if reason is None and self.step_seconds is not None and self.deadline.remaining() < self.step_seconds:
+           reason = 'timeout'
+       return DeadlineExceeded(reason) if reason is not None else None
+
+   def reset(self, code_state=None):
+       # forget the previous run: memory steps, interpreter variables and functions, code_state
+       # the system prompt, interpreter and logger are kept, which is what makes reuse cheap
+       self.memory.reset()
+       self.code_state = code_state or dict()
+       self.python_executor.state = {}
+       self.python_executor.custom_tools = {}
+       self.event_callback = None
+       self.deadline = None
+       self.input_tokens = 0
+       self.output_tokens = 0
+
+   def emit(self, event_type, **data):
+       # event types: step_start, token, observation, step_error, escalate, final_answer
+       if self.event_callback is not None:
+           self.event_callback({"type": event_type, **data})
    
    def create_system_prompt(self):
        # overwrite this to load a different system prompt
        yaml_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'code_agent.yaml')
-       with open(yaml_path, 'r') as file:
-            templates = yaml.safe_load(file)
+       templates = load_templates(yaml_path)
 
        # extra params: pass in if needed in future
        self.authorized_imports = 'None'  
@@ -132,15 +222,17 @@ class PyAgent:
        # helper, called once currently; smolagents may call more in future
        messages = self.memory.system_prompt.to_messages(
            summary_mode=summary_mode)
+       # with retention.summarize_after, older steps are summarized (the system prompt never is)
+       summarized = self.retention.summarized(self.memory.steps)
        for memory_step in self.memory.steps:
-           messages.extend(memory_step.to_messages(summary_mode=summary_mode))
+           messages.extend(memory_step.to_messages(summary_mode=summary_mode or id(memory_step) in summarized))
        return messages
 
 
    def step(self, action: MemoryStep):
        # 1. create model input
        messages = self.get_messages()
-       action.model_input_messages = messages.copy()
+       self.retention.keep_input(self.memory.steps, action, messages)
 
 
        # 2. get model response
@@ -148,16 +240,32 @@ class PyAgent:
            ###################################
            # call the actual model! big stuff
            ###################################
-           response = self.model(
-               messages,
-                stop_sequences=["<end_code>", "Observation:"],
-           )
-           action.model_output_message = response
+           model_kwargs = {}
+           if self.deadline is not None:
+               model_kwargs["deadline"] = self.deadline
+           if self.event_callback is not None:
+               step_number = action.step_number
+               model_kwargs["token_callback"] = lambda text: self.emit("token", step=step_number, text=text)
+           with span('model_call'):
+               response = self.model(
+                   messages,
+                   stop_sequences=["<end_code>", "Observation:"],
+                   **model_kwargs,
+               )
+           action.model_output_message = self.retention.keep_output(response)
            action.model_output = response.content
+           # per calling thread on a BatchScheduler, so concurrent agents each count their own
+           self.input_tokens += getattr(self.model, 'last_input_token_count', None) or 0
+           self.output_tokens += getattr(self.model, 'last_output_token_count', None) or 0
+       except DeadlineExceeded:
+           raise
        except Exception as e:
            print('full traceback', traceback.format_exc())
            raise AgentGenerationError(
                f"Error in generating model output:\n{e}", self.logger) from e
+       # generation was cut short: the output is unfinished, so it is not parsed or run
+       if self.deadline is not None:
+           self.deadline.check()
 
        self.logger.log_markdown(
            content=response.content,
@@ -167,8 +275,9 @@ class PyAgent:
 
        # 3. Expect model to output python code. Parse it here
        try:
-           code_action = fix_final_answer_code(
-               parse_code_blobs(response.content))
+           with span('code_parse'):
+               code_action = fix_final_answer_code(
+                   parse_code_blobs(response.content))
        except Exception as e:
            error_msg = f"Error in code parsing:\n{e}\nMake sure to provide correct code blobs."
            raise AgentParsingError(error_msg, self.logger)
@@ -185,10 +294,11 @@ class PyAgent:
                             content=code_action, level=LogLevel.INFO)
        is_final_answer = False
        try:
-           output, execution_logs, is_final_answer = self.python_executor(
-               code_action,
-               self.code_state,
-           )
+           with span('execution'):
+               output, execution_logs, is_final_answer = self.python_executor(
+                   code_action,
+                   self.code_state,
+               )
            execution_outputs_console = []
            if len(execution_logs) > 0:
                execution_outputs_console += [
@@ -218,6 +328,7 @@ class PyAgent:
        truncated_output = truncate_content(str(output))
        observation += 'Last output from code snippet:\n' + truncated_output
        action.observations = observation
+       self.emit("observation", step=action.step_number, observation=observation)
 
        # 5. check if final answer exists
        execution_outputs_console += [
@@ -0,0 +1,147 @@
+import copy
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# cache of final_answer command lists, in front of CastleAgent.run_battle_command
+# key = normalised command text + fingerprint of the battle_state (list of dicts, as the interpreter sees it)
+# entries expire after ttl seconds and the least recently used ones are dropped beyond max_size
+# relational mode adds a second key that ignores positions. it is only used for answers made entirely of
+# RELATIONAL_COMMANDS (e.g. "knight move left 2" means the same thing wherever the knight stands) and
+# only when the command text has no words that select units by where they are
+# usage:
+# cache = CommandResultCache(max_size=1024, ttl=300)
+# result = cache.get(battle_state, command)
+# if result is None:
+#     result = agent.run_battle_command(game_objects, command)
+#     cache.put(battle_state, command, result)
+# callers that keep their own fingerprint of the state (castle/battle_session.py) pass it instead of having
+# the whole battle_state serialised: cache.get(battle_state, command, fingerprint=snapshot.fingerprint)
+
+RELATIONAL_COMMANDS = {'move_in_direction'}
+SPATIAL_WORDS = {
+    'near', 'nearest', 'nearby', 'close', 'closer', 'closest', 'far', 'farther', 'farthest', 'further', 'furthest',
+    'first', 'second', 'third', 'last', 'behind', 'front', 'around', 'between', 'next', 'within',
+    'top', 'bottom', 'side', 'leftmost', 'rightmost', 'edge', 'middle', 'center', 'centre',
+}
+NUMBER_WORDS = {
+    'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5',
+    'six': '6', 'seven': '7', 'eight': '8', 'nine': '9', 'ten': '10',
+}
+IGNORED_KEYS = {'position'}  # keys left out of the relational fingerprint
+
+
+def normalize_command(command: str) -> str:
+    # case, punctuation, spacing and spelled-out numbers do not change the meaning of an order;
+    # words are any unicode letters, so commands in other scripts keep their own keys
+    words = re.findall(r"-?\d+(?:\.\d+)?|[^\W\d_][^\W_]*", command.lower())
+    return ' '.join(NUMBER_WORDS.get(word, word) for word in words)
+
+
+def fingerprint_battle_state(battle_state: List[Dict], include_positions=True) -> str:
+    if include_positions:
+        rows = battle_state
+    else:
+        rows = [{k: v for k, v in obj.items() if k not in IGNORED_KEYS} for obj in battle_state]
+    rows = sorted(rows, key=lambda obj: str(obj.get('object_id')))
+    canonical = json.dumps(rows, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def is_relational_answer(command: str, result) -> bool:
+    if not isinstance(result, list) or not result:
+        return False
+    if any(not isinstance(c, dict) or c.get('name') not in RELATIONAL_COMMANDS for c in result):
+        return False
+    return not (set(normalize_command(command).split()) & SPATIAL_WORDS)
+
+
+class CommandResultCache:
+    def __init__(self, max_size=1024, ttl=300.0, relational=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.relational = relational
+        self.entries = OrderedDict()  # key -> (stored_at, result), least recently used first
+        self.lock = threading.Lock()
+
+        # stats
+        self.hits = 0
+        self.relational_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _keys(self, battle_state, command, fingerprint=None):
+        # a command with no words or numbers at all (emoji, symbols) keys on its own text rather than on ''
+        command = normalize_command(command) or command.strip()
+        if fingerprint is not None:
+            exact_key = ('session', command, fingerprint)
+        else:
+            exact_key = ('exact', command, fingerprint_battle_state(battle_state))
+        relational_key = None
+        if self.relational:
+            relational_key = ('relational', command, fingerprint_battle_state(battle_state, include_positions=False))
+        return exact_key, relational_key
+
+    def _lookup(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored_at, result = entry
+        if now - stored_at > self.ttl:
+            del self.entries[key]
+            self.evictions += 1
+            return None
+        self.entries.move_to_end(key)
+        return result
+
+    def get(self, battle_state: List[Dict], command: str, fingerprint=None) -> Optional[list]:
+        exact_key, relational_key = self._keys(battle_state, command, fingerprint)
+        now = time.time()
+        with self.lock:
+            result = self._lookup(exact_key, now)
+            if result is not None:
+                self.hits += 1
+                return copy.deepcopy(result)
+            if self.relational:
+                result = self._lookup(relational_key, now)
+                if result is not None:
+                    self.hits += 1
+                    self.relational_hits += 1
+                    return copy.deepcopy(result)
+            self.misses += 1
+            return None
+
+    def put(self, battle_state: List[Dict], command: str, result, fingerprint=None):
+        # only real answers are cached; a failed run (None) should be retried
+        if result is None:
+            return
+        exact_key, relational_key = self._keys(battle_state, command, fingerprint)
+        entry = (time.time(), copy.deepcopy(result))
+        with self.lock:
+            self.entries[exact_key] = entry
+            self.entries.move_to_end(exact_key)
+            if self.relational and is_relational_answer(command, result):
+                self.entries[relational_key] = entry
+                self.entries.move_to_end(relational_key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'relational_hits': self.relational_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
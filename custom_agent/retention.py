@@ -0,0 +1,64 @@
+from smolagents.memory import ActionStep
+
+# what an agent keeps of its run in AgentMemory
+# smolagents stores a copy of the whole model input on every ActionStep, so a run of k steps holds k prompts
+# (quadratic in steps), and ModelWrapper's ChatMessage.raw['out'] is a view of the generated batch tensor,
+# which keeps the whole batch's token ids on the gpu for as long as the memory lives
+# - input_messages: 'all' (a copy per step, like smolagents), 'last' (only the latest step keeps its model input,
+#   by reference; earlier steps let theirs go) or 'none'
+# - raw_output: 'keep', 'cpu' (tensors in raw are copied to the cpu, the batch they viewed is freed) or 'drop'
+# - summarize_after: None, or how many of the latest steps go into the prompt in full; older steps are rendered with
+#   smolagents' summary_mode (their thought text is left out, their code, observations and errors stay). this
+#   shortens long retries, but changes the prompt prefix of the old steps once, so the prefix cache misses there
+# get_messages, the trace recorder (custom_agent/tracing.py) and validation only need the latest input and the
+# text fields, so the default keeps just those; FULL_RETENTION keeps everything for memory.replay(detailed=True)
+# usage:
+# agent = CastleAgent(model)                                          # RetentionPolicy() by default
+# agent = CastleAgent(model, retention=RetentionPolicy(raw_output='cpu', summarize_after=2))
+# agent = CastleAgent(model, retention=FULL_RETENTION)
+
+
+class RetentionPolicy:
+    def __init__(self, input_messages='last', raw_output='drop', summarize_after=None):
+        if input_messages not in ('all', 'last', 'none'):
+            raise ValueError(f'unknown input_messages retention {input_messages!r}')
+        if raw_output not in ('keep', 'cpu', 'drop'):
+            raise ValueError(f'unknown raw_output retention {raw_output!r}')
+        self.input_messages = input_messages
+        self.raw_output = raw_output
+        self.summarize_after = summarize_after
+
+    def keep_input(self, steps, action, messages):
+        # called by PyAgent.step with the messages it is about to send; action is not in steps yet
+        if self.input_messages == 'all':
+            action.model_input_messages = messages.copy()
+            return
+        if self.input_messages == 'last':
+            for step in reversed(steps):
+                if isinstance(step, ActionStep):
+                    step.model_input_messages = None
+                    break
+            action.model_input_messages = messages
+
+    def keep_output(self, response):
+        # the ChatMessage as it is stored on the ActionStep
+        raw = response.raw
+        if self.raw_output == 'keep' or not isinstance(raw, dict):
+            return response
+        if self.raw_output == 'drop':
+            response.raw = None
+        else:
+            # copy=True so a cpu view does not keep its batch either, the copy holds only the row
+            response.raw = {key: value.to('cpu', copy=True) if hasattr(value, 'device') else value for key, value in raw.items()}
+        return response
+
+    def summarized(self, steps):
+        # ids of the action steps that get_messages renders in summary mode
+        if self.summarize_after is None:
+            return set()
+        actions = [step for step in steps if isinstance(step, ActionStep)]
+        old = actions[:-self.summarize_after] if self.summarize_after > 0 else actions
+        return {id(step) for step in old}
+
+
+FULL_RETENTION = RetentionPolicy(input_messages='all', raw_output='keep')
@@ -0,0 +1,153 @@
+import torch
+from transformers import DynamicCache
+
+from custom_agent.metrics import SPECULATIVE_TOKENS
+
+# prompt-lookup speculative decoding for ModelWrapper.generate_batch (a batch of one, greedy)
+# the agent's code mostly copies text that is already in the context: object ids, names, argument schemas,
+# earlier code. after each token we look up the latest earlier occurrence of the last few tokens and propose
+# the tokens that followed it as a draft; one forward pass over [token, *draft] verifies the whole draft, and
+# every draft token that matches the model's own greedy choice is accepted for free
+# - the output is what greedy decoding (generate(do_sample=False)) produces, up to float rounding between
+#   one-token and multi-token forward passes deciding a near tie differently
+# - accepted tokens are fed to the stopping criteria and the streamer one at a time, so the stop automaton
+#   sees every token and stops at the same place as without speculation
+# - the kv cache is cropped back to the accepted tokens after each verification
+# usage:
+# sequences, past_key_values, stats = speculative_generate(model, input_ids, stopping_criteria, max_new_tokens=256)
+# stats.acceptance_rate, stats.tokens_per_forward
+
+
+class PromptLookup:
+    # n-gram -> position right after its latest occurrence, for n = 1..max_ngram
+    # an n-gram is only indexed once a token follows it, so the trailing n-gram never finds itself
+    def __init__(self, tokens, max_ngram=3, num_draft=10):
+        self.tokens = list(tokens)
+        self.max_ngram = max_ngram
+        self.num_draft = num_draft
+        self.index = {}
+        for end in range(1, len(self.tokens)):
+            self._index_ngrams_ending_at(end)
+
+    def _index_ngrams_ending_at(self, end):
+        for n in range(1, self.max_ngram + 1):
+            if end - n < 0:
+                break
+            self.index[tuple(self.tokens[end - n:end])] = end
+
+    def append(self, token):
+        self.tokens.append(token)
+        self._index_ngrams_ending_at(len(self.tokens) - 1)
+
+    def draft(self):
+        # longest matching n-gram first, since it predicts the continuation best
+        for n in range(min(self.max_ngram, len(self.tokens)), 0, -1):
+            position = self.index.get(tuple(self.tokens[-n:]))
+            if position is not None:
+                return self.tokens[position:position + self.num_draft]
+        return []
+
+
+class SpeculativeStats:
+    def __init__(self):
+        self.forward_passes = 0
+        self.drafted = 0
+        self.accepted = 0
+        self.generated = 0
+
+    def add(self, other):
+        self.forward_passes += other.forward_passes
+        self.drafted += other.drafted
+        self.accepted += other.accepted
+        self.generated += other.generated
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    @property
+    def tokens_per_forward(self):
+        return self.generated / self.forward_passes if self.forward_passes else 0.0
+
+    def as_dict(self):
+        return {
+            'forward_passes': self.forward_passes,
+            'drafted_tokens': self.drafted,
+            'accepted_tokens': self.accepted,
+            'generated_tokens': self.generated,
+            'acceptance_rate': round(self.acceptance_rate, 3),
+            'tokens_per_forward': round(self.tokens_per_forward, 3),
+        }
+
+
+@torch.no_grad()
+def speculative_generate(
+    model,
+    input_ids,
+    stopping_criteria,
+    max_new_tokens,
+    past_key_values=None,
+    eos_token_ids=(),
+    streamer=None,
+    num_draft=10,
+    max_ngram=3,
+):
+    # input_ids: (1, prompt length). past_key_values (optional) covers a prefix of the prompt.
+    # returns (sequences, past_key_values, stats) like generate(return_dict_in_generate=True) would,
+    # with the cache covering every token but the last
+    stats = SpeculativeStats()
+    cache = past_key_values if past_key_values is not None else DynamicCache()
+    lookup = PromptLookup(input_ids[0].tolist(), max_ngram=max_ngram, num_draft=num_draft)
+    prompt_length = input_ids.shape[1]
+    eos_token_ids = set(eos_token_ids)
+    # the stopping criteria get a view of this buffer, so a token costs no new tensor of the whole sequence
+    sequence = torch.empty((1, prompt_length + max_new_tokens), dtype=input_ids.dtype, device=input_ids.device)
+    sequence[:, :prompt_length] = input_ids
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+
+    def emit(token):
+        # append one token; True when generation is over
+        lookup.append(token)
+        stats.generated += 1
+        length = len(lookup.tokens)
+        sequence[0, length - 1] = token
+        if streamer is not None:
+            streamer.put(torch.tensor([token]))
+        done = bool(stopping_criteria(sequence[:, :length], None).all())
+        return done or token in eos_token_ids or length - prompt_length >= max_new_tokens
+
+    logits = model(input_ids[:, cache.get_seq_length():], past_key_values=cache, use_cache=True).logits
+    stats.forward_passes += 1
+    token = int(logits[0, -1].argmax())
+    finished = emit(token)
+    while not finished:
+        # the cache covers every token but `token`; verify [token, *draft] in one pass
+        draft = lookup.draft()[:max(0, max_new_tokens - (len(lookup.tokens) - prompt_length))]
+        block = torch.tensor([[token] + draft], device=input_ids.device)
+        cached_length = cache.get_seq_length()
+        logits = model(block, past_key_values=cache, use_cache=True).logits
+        stats.forward_passes += 1
+        stats.drafted += len(draft)
+        predictions = logits[0].argmax(dim=-1).tolist()  # predictions[i] follows block[:, :i + 1]
+
+        accepted = 0
+        while accepted < len(draft) and draft[accepted] == predictions[accepted]:
+            accepted += 1
+            stats.accepted += 1
+            finished = emit(draft[accepted - 1])
+            if finished:
+                break
+        # drop the kv of rejected draft tokens
+        cache.crop(cached_length + 1 + accepted)
+        if finished:
+            break
+        # the model's own next token after the accepted ones comes for free with the same pass
+        token = predictions[accepted]
+        finished = emit(token)
+
+    if streamer is not None:
+        streamer.end()
+    SPECULATIVE_TOKENS.inc(stats.drafted, kind='drafted')
+    SPECULATIVE_TOKENS.inc(stats.accepted, kind='accepted')
+    return sequence[:, :len(lookup.tokens)], cache, stats
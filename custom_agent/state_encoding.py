@@ -0,0 +1,140 @@
+import json
+import threading
+from typing import Dict, List
+
+# encoders that turn the battle_state (list of dicts, as the interpreter sees it) into prompt text
+# 'json' is the original json.dumps(..., indent=2): one line per key and per coordinate
+# 'compact' is a table with one row per object and the keys written once in a header,
+# which needs several times fewer tokens per object and so less prefill time and kv memory
+# the interpreter-side battle_state is the same whichever encoder is used
+# IncrementalEncoder is for battle states that change a few objects at a time (castle/battle_session.py):
+# row dicts it has seen before keep their text, so only new or moved objects are formatted again
+# usage:
+# encode_battle_state(battle_state, 'compact')
+# encoder = IncrementalEncoder('compact')
+# text = encoder.encode(battle_state)
+
+
+def encode_json(battle_state: List[Dict]) -> str:
+    return json.dumps(battle_state, indent=2)
+
+
+def _format_value(value):
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(_format_value(v) for v in value) + ']'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _add_columns(columns, obj):
+    for key in obj:
+        if key not in columns:
+            columns.append(key)
+
+
+def _compact_header(columns):
+    return [
+        "[  # table: one dict per row, keys in the header row, '-' means the dict has no such key",
+        '|'.join(columns),
+    ]
+
+
+def _compact_row(obj, columns):
+    return '|'.join(_format_value(obj[key]) if key in obj else '-' for key in columns)
+
+
+def _json_row(obj):
+    # the row as json.dumps(battle_state, indent=2) writes it
+    return '  ' + json.dumps(obj, indent=2).replace('\n', '\n  ')
+
+
+def encode_compact(battle_state: List[Dict]) -> str:
+    # columns in order of first appearance, so the common keys (object_id, object_type, position) lead
+    columns = []
+    for obj in battle_state:
+        _add_columns(columns, obj)
+    lines = _compact_header(columns)
+    for obj in battle_state:
+        lines.append(_compact_row(obj, columns))
+    lines.append(']')
+    return '\n'.join(lines)
+
+
+STATE_ENCODERS = {
+    'json': encode_json,
+    'compact': encode_compact,
+}
+
+
+def encode_battle_state(battle_state: List[Dict], encoder='compact') -> str:
+    if encoder not in STATE_ENCODERS:
+        raise ValueError(f"Unknown state encoder '{encoder}', choose from {list(STATE_ENCODERS)}")
+    return STATE_ENCODERS[encoder](battle_state)
+
+
+class IncrementalEncoder:
+    # rows are matched by identity, so callers must replace a changed row dict instead of editing it
+    # compact columns only ever grow, so a key that disappears keeps its (all '-') column until the encoder is
+    # dropped; new columns re-encode every row once
+    def __init__(self, encoder='compact'):
+        if encoder not in STATE_ENCODERS:
+            raise ValueError(f"Unknown state encoder '{encoder}', choose from {list(STATE_ENCODERS)}")
+        self.encoder = encoder
+        self.texts = {}  # object_id -> (row dict, its text)
+        self.columns = []
+        self.lock = threading.Lock()
+        # stats
+        self.reused_rows = 0
+        self.encoded_rows = 0
+
+    def _row_text(self, obj):
+        return _compact_row(obj, self.columns) if self.encoder == 'compact' else _json_row(obj)
+
+    def encode(self, battle_state: List[Dict]) -> str:
+        with self.lock:
+            texts = self.texts
+            if self.encoder == 'compact':
+                n_columns = len(self.columns)
+                for obj in battle_state:
+                    cached = texts.get(obj['object_id'])
+                    if cached is None or cached[0] is not obj:
+                        _add_columns(self.columns, obj)
+                if len(self.columns) != n_columns:
+                    texts.clear()
+            rows = []
+            for obj in battle_state:
+                cached = texts.get(obj['object_id'])
+                if cached is not None and cached[0] is obj:
+                    self.reused_rows += 1
+                    rows.append(cached[1])
+                    continue
+                text = self._row_text(obj)
+                texts[obj['object_id']] = (obj, text)
+                self.encoded_rows += 1
+                rows.append(text)
+            if len(texts) > 2 * len(battle_state) + 64:
+                # forget removed objects
+                self.texts = {obj['object_id']: texts[obj['object_id']] for obj in battle_state}
+            # the columns the rows were encoded with; another encode may add columns once the lock is released
+            columns = list(self.columns)
+        if self.encoder == 'compact':
+            return '\n'.join(_compact_header(columns) + rows + [']'])
+        return '[\n' + ',\n'.join(rows) + '\n]' if rows else '[]'
+
+    def stats(self):
+        return {'encoder': self.encoder, 'reused_rows': self.reused_rows, 'encoded_rows': self.encoded_rows}
+
+
+def token_count_report(tokenizer, battle_state: List[Dict]) -> Dict[str, Dict]:
+    # prompt tokens used by the battle state under every encoder
+    report = {}
+    for name in STATE_ENCODERS:
+        text = encode_battle_state(battle_state, name)
+        tokens = len(tokenizer(text, add_special_tokens=False)['input_ids'])
+        report[name] = {
+            'tokens': tokens,
+            'tokens_per_object': round(tokens / max(len(battle_state), 1), 2),
+            'characters': len(text),
+        }
+    return report
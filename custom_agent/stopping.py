@@ -0,0 +1,168 @@
+import time
+from collections import deque
+from typing import List, Optional
+
+import torch
+from transformers import StoppingCriteria
+
+from custom_agent.deadline import Deadline
+
+# token-level stop engine for ModelWrapper.generate_batch
+# stop strings are compiled into an aho-corasick automaton over characters, and transitions are
+# memoised per (state, token id); after warm up each generated token costs one dict lookup per row,
+# with no decoding and no growing string buffer.
+# a stop string may be split across tokens in any way, or end in the middle of a token.
+# every row of the batch keeps its own state, its own stop strings and its own done flag
+# usage:
+# automaton = StopAutomaton(["<end_code>", "Observation:"], tokenizer)
+# criteria = StopSequenceCriteria(automaton, [["<end_code>", "Observation:"]], prompt_length=n)
+# model.generate(..., stopping_criteria=StoppingCriteriaList([criteria]))
+
+CODE_FENCE = "```"
+FINAL_ANSWER_CALL = "final_answer("
+
+
+class StopAutomaton:
+    def __init__(self, patterns: List[str], tokenizer):
+        self.patterns = list(dict.fromkeys(patterns))
+        self.pattern_index = {pattern: i for i, pattern in enumerate(self.patterns)}
+        self.tokenizer = tokenizer
+        self.token_text = {}  # token id -> decoded text
+        self.transitions = {}  # (state, token id) -> (next state, tuple of matched pattern indices)
+
+        # goto/fail/output tables of the character automaton
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state] += (index,)
+
+        # breadth first, so fail links of shorter prefixes are ready first
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def _step_char(self, state, char):
+        while state and char not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(char, 0)
+
+    def step(self, state, token_id):
+        # feeds one token; returns the new state and the patterns that ended inside it, in order
+        key = (state, token_id)
+        transition = self.transitions.get(key)
+        if transition is None:
+            text = self.token_text.get(token_id)
+            if text is None:
+                text = self.tokenizer.decode([token_id], skip_special_tokens=True)
+                self.token_text[token_id] = text
+            matched = ()
+            next_state = state
+            for char in text:
+                next_state = self._step_char(next_state, char)
+                matched += self.output[next_state]
+            transition = (next_state, matched)
+            self.transitions[key] = transition
+        return transition
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    def __init__(
+        self,
+        automaton: StopAutomaton,
+        stop_sequences: List[List[str]],
+        prompt_length: int,
+        max_new_tokens: Optional[int] = None,
+        stop_on_final_answer: bool = True,
+    ):
+        # stop_sequences holds one list of stop strings per row
+        self.automaton = automaton
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.stop_on_final_answer = stop_on_final_answer
+        self.fence_index = automaton.pattern_index.get(CODE_FENCE)
+        self.final_answer_index = automaton.pattern_index.get(FINAL_ANSWER_CALL)
+
+        self.stop_indices = [
+            frozenset(automaton.pattern_index[stop] for stop in row_stops)
+            for row_stops in stop_sequences
+        ]
+        self.states = [0] * len(stop_sequences)
+        self.in_code = [False] * len(stop_sequences)
+        self.final_answer_in_code = [False] * len(stop_sequences)
+        self.done = [False] * len(stop_sequences)
+        self.lengths = [None] * len(stop_sequences)  # generated tokens of each row when it stopped
+        # generate calls the criteria right after each new token, so the first call marks the end of prefill
+        self.first_token_at = None
+
+    def _update_row(self, i, token_id):
+        self.states[i], matched = self.automaton.step(self.states[i], token_id)
+        for index in matched:
+            if index in self.stop_indices[i]:
+                return True
+            if not self.stop_on_final_answer:
+                continue
+            if index == self.fence_index:
+                if self.in_code[i] and self.final_answer_in_code[i]:
+                    # closing fence of a code block that calls final_answer: nothing useful comes after it
+                    return True
+                self.in_code[i] = not self.in_code[i]
+            elif index == self.final_answer_index and self.in_code[i]:
+                self.final_answer_in_code[i] = True
+        return False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        last_tokens = input_ids[:, -1].tolist()
+        generated = input_ids.shape[1] - self.prompt_length
+        for i, token_id in enumerate(last_tokens):
+            if not self.done[i]:
+                self.done[i] = self._update_row(i, token_id)
+                if self.done[i]:
+                    self.lengths[i] = generated
+        if self.max_new_tokens is not None and generated >= self.max_new_tokens:
+            for i in range(len(self.done)):
+                if not self.done[i]:
+                    self.done[i], self.lengths[i] = True, generated
+        return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
+
+
+class DeadlineCriteria(StoppingCriteria):
+    # stops each row once its request's deadline (custom_agent/deadline.py) has passed or was cancelled
+    # a stopped row is padded until the rest of the batch finishes; a batch where every row stopped ends right away
+    def __init__(self, deadlines: List[Optional[Deadline]]):
+        self.deadlines = deadlines
+        self.stopped = [None] * len(deadlines)  # stop reason per row
+
+    def __call__(self, input_ids, scores, **kwargs):
+        for i, deadline in enumerate(self.deadlines):
+            if deadline is not None and self.stopped[i] is None:
+                self.stopped[i] = deadline.stop_reason()
+        return torch.tensor([reason is not None for reason in self.stopped], dtype=torch.bool, device=input_ids.device)
+
+
+def truncate_at_stop_sequences(content: str, stop_sequences: List[str]) -> str:
+    # the automaton can stop in the middle of a token, so cut at the first stop string found
+    # rather than only stripping it from the end
+    cut = len(content)
+    for stop_seq in stop_sequences:
+        index = content.find(stop_seq)
+        if index != -1:
+            cut = min(cut, index)
+    return content[:cut]
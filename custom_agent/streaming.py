@@ -0,0 +1,51 @@
+from typing import Callable, List, Optional
+
+# token streamer for ModelWrapper.generate_batch
+# transformers' TextStreamer only supports a batch of one; this one decodes every row separately
+# and hands new text to that row's callback (rows without a callback are skipped).
+# text is flushed on whitespace/newlines like TextStreamer, so callbacks never see half a word
+# or half a utf-8 character.
+# generate() calls put() once with the prompt ids, then once per step with the new token of each row
+
+
+class BatchTextStreamer:
+    def __init__(self, tokenizer, callbacks: List[Optional[Callable[[str], None]]]):
+        self.tokenizer = tokenizer
+        self.callbacks = callbacks
+        self.token_cache = [[] for _ in callbacks]
+        self.printed_length = [0 for _ in callbacks]
+        self.next_tokens_are_prompt = True
+
+    def put(self, value):
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        for i, token_id in enumerate(value.reshape(-1).tolist()):
+            if self.callbacks[i] is None:
+                continue
+            self.token_cache[i].append(token_id)
+            text = self.tokenizer.decode(self.token_cache[i], skip_special_tokens=True)
+            if text.endswith("\n"):
+                new_text = text[self.printed_length[i]:]
+                self.token_cache[i] = []
+                self.printed_length[i] = 0
+            elif text.endswith("�"):
+                # incomplete utf-8 character, wait for the next token
+                continue
+            else:
+                new_text = text[self.printed_length[i]: text.rfind(" ") + 1]
+                self.printed_length[i] += len(new_text)
+            if new_text:
+                self.callbacks[i](new_text)
+
+    def end(self):
+        for i, callback in enumerate(self.callbacks):
+            if callback is None or not self.token_cache[i]:
+                continue
+            text = self.tokenizer.decode(self.token_cache[i], skip_special_tokens=True)
+            new_text = text[self.printed_length[i]:]
+            self.token_cache[i] = []
+            self.printed_length[i] = 0
+            if new_text:
+                callback(new_text)
+        self.next_tokens_are_prompt = True
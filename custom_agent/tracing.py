@@ -0,0 +1,374 @@
+import argparse
+import collections
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from typing import Dict, Iterable, List, Optional
+
+from custom_agent.metrics import TRACE_RECORDS, span_sink
+
+# request traces: what a command got, what the model said, what the code did and where the time went
+# - the serving thread only builds a dict of references (payload, prompt strings, ActionStep fields, span timings)
+#   and appends it to a bounded ring buffer; when the buffer is full the oldest trace is dropped, never waited on
+# - a background thread flushes the buffer every flush_interval seconds (sooner when it is half full):
+#   each record is json, zlib-compressed and appended to a segment file as a frame: 4 byte little-endian length +
+#   compressed bytes. segments roll over at max_segment_bytes and are named by pid, so worker processes
+#   (serving/worker_pool.py) can share a trace_dir
+# - the system prompt is the same for every request, so a segment stores each distinct prompt once
+#   ({'kind': 'prompt'}) and traces refer to it by hash; read_traces puts the text back
+# - a segment cut short by a crash is read up to its last complete frame
+# replay feeds a trace's model outputs back through a CastleAgent (no model, no gpu), so the same code runs on
+# the same battle state: answers, step errors and execution times can be compared with the recording
+# usage:
+# tracer = Tracer('traces/')
+# tracer.start()
+# service = InferenceService(trace_dir='traces/')        # or CASTLE_TRACE_DIR=traces/ python server.py
+# python -m custom_agent.tracing list traces/
+# python -m custom_agent.tracing show traces/ <trace id>
+# python -m custom_agent.tracing replay traces/ <trace id> [--executor compiled]
+# python -m custom_agent.tracing replay traces/ --all
+
+SEGMENT_MAGIC = b'CTRACE1\n'
+FRAME_HEADER = struct.Struct('<I')
+
+
+def prompt_hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+class RequestTrace:
+    # one request, filled in by the thread that serves it
+    def __init__(self, command, game_objects_data=None, battle_state=None, session_id=None, submitted_at=None):
+        # game_objects_data: the client payload; battle_state: rows of a session snapshot instead
+        self.record = {
+            'kind': 'request',
+            'trace_id': uuid.uuid4().hex[:16],
+            'pid': os.getpid(),
+            'submitted_at': submitted_at or time.time(),
+            'started_at': time.time(),
+            'command': command,
+            'session_id': session_id,
+            'game_objects': game_objects_data,
+            'battle_state': battle_state,
+        }
+        self.timings = []  # (span name, seconds), collected through custom_agent/metrics.py span()
+
+    def __enter__(self):
+        span_sink.timings = self.timings
+        return self
+
+    def __exit__(self, *exc):
+        span_sink.timings = None
+
+    def record_agent(self, agent):
+        # the agent's run, before the agent goes back to its pool; only references, nothing is copied
+        from smolagents.memory import ActionStep, TaskStep
+        steps = agent.memory.steps
+        self.record.update({
+            'system_prompt': agent.system_prompt,
+            'task': next((step.task for step in steps if isinstance(step, TaskStep)), None),
+            'model_id': getattr(agent.model, 'model_id', None),
+            'input_tokens': agent.input_tokens,
+            'output_tokens': agent.output_tokens,
+            'steps': [
+                {
+                    'step': step.step_number,
+                    'model_output': step.model_output,
+                    'code': step.tool_calls[0].arguments if step.tool_calls else None,
+                    'observations': step.observations,
+                    'error_type': type(step.error).__name__ if step.error is not None else None,
+                    'error': step.error,
+                    'duration': step.duration,
+                }
+                for step in steps if isinstance(step, ActionStep)
+            ],
+        })
+
+    def finish(self, **fields):
+        # path, tier, outcome, result, error, ...
+        self.record.update(fields)
+        self.record['duration'] = time.time() - self.record['started_at']
+        self.record['spans'] = self.timings
+        return self.record
+
+
+class Tracer:
+    def __init__(self, trace_dir, capacity=1024, flush_interval=1.0, max_segment_bytes=64 * 1024 * 1024,
+                 compress_level=6):
+        self.trace_dir = trace_dir
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.max_segment_bytes = max_segment_bytes
+        self.compress_level = compress_level
+        self.buffer = collections.deque()
+        self.lock = threading.Lock()  # buffer and stats
+        self.write_lock = threading.Lock()  # segment file
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.flusher = None
+        self.segment = None
+        self.segment_path = None
+        self.segment_prompts = set()  # prompt hashes written to the current segment
+        # stats
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.bytes_written = 0
+        self.segments = 0
+        self.flush_seconds = 0.0
+
+    def start(self):
+        os.makedirs(self.trace_dir, exist_ok=True)
+        self.flusher = threading.Thread(target=self._flush_loop, name='trace-flusher', daemon=True)
+        self.flusher.start()
+        return self
+
+    def close(self):
+        self.stopped.set()
+        self.wake.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+        with self.write_lock:
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+
+    def begin(self, command, **kwargs) -> RequestTrace:
+        return RequestTrace(command, **kwargs)
+
+    def add(self, record: Dict):
+        # hot path: an append under a lock
+        with self.lock:
+            if len(self.buffer) >= self.capacity:
+                self.buffer.popleft()
+                self.dropped += 1
+                TRACE_RECORDS.inc(outcome='dropped')
+            self.buffer.append(record)
+            self.recorded += 1
+            if len(self.buffer) >= self.capacity // 2:
+                self.wake.set()
+
+    def _flush_loop(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # tracing must never take the server down; the records of this flush are lost
+                print(f'trace flush failed: {type(e).__name__}: {e}')
+
+    def flush(self):
+        with self.lock:
+            records, self.buffer = list(self.buffer), collections.deque()
+        if not records:
+            return
+        ts = time.perf_counter()
+        with self.write_lock:
+            for record in records:
+                self._write(record)
+            self.segment.flush()
+        with self.lock:
+            self.written += len(records)
+            self.flush_seconds += time.perf_counter() - ts
+        TRACE_RECORDS.inc(len(records), outcome='written')
+
+    def _open_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+        self.segments += 1
+        name = f'trace-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{self.segments}.ctrace'
+        self.segment_path = os.path.join(self.trace_dir, name)
+        self.segment = open(self.segment_path, 'ab')
+        self.segment.write(SEGMENT_MAGIC)
+        self.segment_prompts = set()
+
+    def _frame(self, record):
+        data = zlib.compress(json.dumps(record, default=str).encode(), self.compress_level)
+        self.segment.write(FRAME_HEADER.pack(len(data)) + data)
+        self.bytes_written += FRAME_HEADER.size + len(data)
+
+    def _write(self, record):
+        if self.segment is None or self.segment.tell() >= self.max_segment_bytes:
+            self._open_segment()
+        system_prompt = record.get('system_prompt')
+        if system_prompt is not None:
+            key = prompt_hash(system_prompt)
+            if key not in self.segment_prompts:
+                self._frame({'kind': 'prompt', 'hash': key, 'text': system_prompt})
+                self.segment_prompts.add(key)
+            record = {**record, 'system_prompt': key}
+        self._frame(record)
+
+    def stats(self):
+        return {
+            'trace_dir': self.trace_dir,
+            'buffered': len(self.buffer),
+            'recorded': self.recorded,
+            'dropped': self.dropped,
+            'written': self.written,
+            'bytes_written': self.bytes_written,
+            'segments': self.segments,
+            'flush_seconds': round(self.flush_seconds, 3),
+        }
+
+
+def read_segment(path) -> Iterable[Dict]:
+    # every complete frame, prompt records included
+    with open(path, 'rb') as f:
+        if f.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            raise ValueError(f'{path} is not a trace segment')
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            (length,) = FRAME_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield json.loads(zlib.decompress(data))
+
+
+def segment_paths(path) -> List[str]:
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.ctrace'))
+    return [path]
+
+
+def read_traces(path) -> Iterable[Dict]:
+    # request records of a segment or a trace directory, with their system prompt text
+    for segment in segment_paths(path):
+        prompts = {}
+        for record in read_segment(segment):
+            if record['kind'] == 'prompt':
+                prompts[record['hash']] = record['text']
+                continue
+            if record.get('system_prompt') is not None:
+                record['system_prompt'] = prompts.get(record['system_prompt'], record['system_prompt'])
+            yield record
+
+
+def find_trace(path, trace_id) -> Optional[Dict]:
+    return next((record for record in read_traces(path) if record['trace_id'].startswith(trace_id)), None)
+
+
+def span_totals(timings) -> Dict[str, float]:
+    totals = {}
+    for name, seconds in timings:
+        totals[name] = round(totals.get(name, 0.0) + seconds, 6)
+    return totals
+
+
+class ReplayModel:
+    # answers with the recorded model outputs, in order
+    def __init__(self, outputs, model_id='replay'):
+        self.outputs = list(outputs)
+        self.model_id = model_id
+        self.calls = 0
+
+    def __call__(self, messages, **kwargs):
+        from smolagents import ChatMessage
+        if self.calls >= len(self.outputs):
+            raise RuntimeError(f'the trace has only {len(self.outputs)} model outputs')
+        output = self.outputs[self.calls]
+        self.calls += 1
+        return ChatMessage(role='assistant', content=output)
+
+
+def replay(record, executor='interpreter', state_encoder='compact') -> Dict:
+    # runs a trace's model outputs through a new CastleAgent and compares the run with the recording
+    from castle.battle_session import BattleSession
+    from castle.battle_state import BattleState
+    from custom_agent.castle_agent import CastleAgent
+    from smolagents.memory import ActionStep
+    from smolagents.monitoring import LogLevel
+
+    if not record.get('steps'):
+        return {'trace_id': record['trace_id'], 'replayed': False, 'reason': f"served by {record.get('path')}, no model steps"}
+    if record.get('game_objects') is not None:
+        game_objects = BattleState.from_payload(record['game_objects'])
+    else:
+        game_objects = BattleSession('replay').reset(record['battle_state'])
+    model = ReplayModel([step['model_output'] or '' for step in record['steps']], record.get('model_id') or 'replay')
+    agent = CastleAgent(model, debug_mode=False, state_encoder=state_encoder, executor=executor)
+    agent.logger.level = LogLevel.OFF
+    trace = RequestTrace(record['command'])
+    error = None
+    with trace:
+        try:
+            result = agent.run_battle_command(game_objects, record['command'])
+        except Exception as e:
+            result, error = None, f'{type(e).__name__}: {e}'
+    actions = [step for step in agent.memory.steps if isinstance(step, ActionStep)]
+    recorded_errors = [step['error_type'] for step in record['steps']]
+    replayed_errors = [type(step.error).__name__ if step.error is not None else None for step in actions]
+    task = next((step.task for step in agent.memory.steps if hasattr(step, 'task')), None)
+    return {
+        'trace_id': record['trace_id'],
+        'replayed': True,
+        'command': record['command'],
+        'result_matches': json.dumps(result, sort_keys=True, default=str) == json.dumps(record.get('result'), sort_keys=True, default=str),
+        'step_errors_match': recorded_errors == replayed_errors,
+        'task_prompt_matches': task == record.get('task'),
+        'system_prompt_matches': agent.system_prompt == record.get('system_prompt'),
+        'recorded': {'outcome': record.get('outcome'), 'result': record.get('result'), 'step_errors': recorded_errors,
+                     'spans': span_totals(record.get('spans', ()))},
+        'replayed_run': {'result': result, 'error': error, 'step_errors': replayed_errors, 'spans': span_totals(trace.timings)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='action', required=True)
+    list_parser = commands.add_parser('list', help='one line per trace')
+    list_parser.add_argument('path', help='trace directory or segment file')
+    show_parser = commands.add_parser('show', help='print a trace as json')
+    show_parser.add_argument('path')
+    show_parser.add_argument('trace_id', help='a trace id or its prefix')
+    replay_parser = commands.add_parser('replay', help='rerun recorded model outputs through a CastleAgent')
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('trace_id', nargs='?')
+    replay_parser.add_argument('--all', action='store_true', help='replay every trace with model steps, print a summary')
+    replay_parser.add_argument('--executor', default='interpreter', choices=['interpreter', 'compiled'])
+    replay_parser.add_argument('--state-encoder', default='compact', choices=['compact', 'json'])
+    args = parser.parse_args()
+
+    if args.action == 'list':
+        for record in read_traces(args.path):
+            started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['started_at']))
+            print(f"{record['trace_id']}  {started}  {record.get('path') or '-':9}  {record.get('outcome') or '-':10}  "
+                  f"{record.get('duration', 0):7.3f}s  {len(record.get('steps') or ())} steps  {record['command']!r}")
+    elif args.action == 'show':
+        record = find_trace(args.path, args.trace_id)
+        if record is None:
+            sys.exit(f'no trace {args.trace_id} in {args.path}')
+        print(json.dumps(record, indent=2, default=str))
+    elif args.all:
+        reports = [replay(record, args.executor, args.state_encoder) for record in read_traces(args.path)]
+        replayed = [report for report in reports if report['replayed']]
+        print(json.dumps({
+            'traces': len(reports),
+            'replayed': len(replayed),
+            'result_matches': sum(report['result_matches'] for report in replayed),
+            'step_errors_match': sum(report['step_errors_match'] for report in replayed),
+            'task_prompt_matches': sum(report['task_prompt_matches'] for report in replayed),
+            'mismatches': [report['trace_id'] for report in replayed if not report['result_matches']],
+        }, indent=2))
+    else:
+        if args.trace_id is None:
+            parser.error('replay needs a trace id, or --all')
+        record = find_trace(args.path, args.trace_id)
+        if record is None:
+            sys.exit(f'no trace {args.trace_id} in {args.path}')
+        print(json.dumps(replay(record, args.executor, args.state_encoder), indent=2, default=str))
+
+
+if __name__ == '__main__':
+    main()
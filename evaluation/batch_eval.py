@@ -0,0 +1,418 @@
+import argparse
+import contextlib
+import functools
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+
+# offline evaluation of CastleAgent on a jsonl dataset of commands, for comparing prompt and model changes
+# - one record per line: {"id": "...", "gameObjects": [...], "command": "...", "expected": [<command>, ...]}
+#   (id defaults to the line number, expected is optional)
+# - the dataset is streamed: records are read as agents free up, never all at once
+# - each worker loads the model once behind a BatchScheduler and runs agent_workers agents on it, so the
+#   generate calls of concurrent records are batched; with --workers > 1 every worker is a spawned process
+#   (with --devices, worker i only sees devices[i % len(devices)], like serving/worker_pool.py)
+# - results are appended to the output jsonl as they finish; a rerun with the same output skips the records
+#   already in it, so an interrupted run (or one whose worker crashed) picks up where it stopped
+# - every result has the answer, its validate_commands problems (game_functions schema and battle state ids),
+#   exact and command-name match against expected, steps, tokens and latency; the report sums them up
+# usage:
+# python -m evaluation.batch_eval commands.jsonl --output results.jsonl --workers 2 --devices 0,1
+# python -m evaluation.batch_eval commands.jsonl --output results.jsonl --cascade --agent-workers 8
+# python -m evaluation.batch_eval commands.jsonl --output results.jsonl --stub --limit 100   # pipeline only, no GPU
+# python -m evaluation.batch_eval --report-only --output results.jsonl
+
+
+def read_records(path, done=(), limit=None):
+    # yields (id, record) for the first limit records of the dataset, skipping the ids in done
+    with open(path) as f:
+        count = 0
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            count += 1
+            if limit is not None and count > limit:
+                return
+            record = json.loads(line)
+            record_id = str(record.get('id', line_number))
+            if record_id not in done:
+                yield record_id, record
+
+
+def read_results(path):
+    # results written so far; a line cut short by an interruption is skipped
+    results = []
+    if not os.path.exists(path):
+        return results
+    with open(path) as f:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return results
+
+
+def truncate_partial_line(path):
+    # so the next result does not get appended to half a line
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end != len(data):
+            f.truncate(end)
+
+
+def normalize_commands(commands):
+    # order-free form of a command list for comparing answers: unit_ids as sorted lists, commands sorted
+    if not isinstance(commands, list):
+        return None
+    normalized = []
+    for command in commands:
+        if not isinstance(command, dict):
+            return None
+        args = dict(command.get('args') or {})
+        if isinstance(args.get('unit_ids'), list):
+            args['unit_ids'] = sorted(map(str, args['unit_ids']))
+        normalized.append(json.dumps({'name': command.get('name'), 'args': args}, sort_keys=True, default=str))
+    return sorted(normalized)
+
+
+def command_names(commands):
+    if not isinstance(commands, list):
+        return None
+    return sorted(str(command.get('name')) for command in commands if isinstance(command, dict))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Evaluator:
+    # the model and agents of one worker
+    def __init__(self, model_factory=None, model_tiers=None, agent_workers=8, batch_window=0.02,
+                 state_encoder='compact', executor='interpreter', timeout=120.0):
+        # model_tiers: [(tier, model factory), ...], smallest first; every agent runs a ModelCascade over them
+        self.model_factory = model_factory
+        self.model_tiers = model_tiers
+        self.agent_workers = agent_workers
+        self.batch_window = batch_window
+        self.state_encoder = state_encoder
+        self.executor = executor
+        self.timeout = timeout  # seconds per record
+        self.model = None
+        self.agent_pool = None
+
+    def _scheduled(self, model_factory):
+        from custom_agent.batching import BatchScheduler
+        return BatchScheduler(model_factory(), max_batch_size=self.agent_workers, batch_window=self.batch_window)
+
+    def start(self):
+        from custom_agent.agent_pool import AgentPool
+        from custom_agent.cascade import ModelCascade
+        from custom_agent.castle_agent import CastleAgent
+        from custom_agent.model_registry import ModelRegistry
+        if self.model_tiers is not None:
+            self.model = ModelRegistry((tier, functools.partial(self._scheduled, factory)) for tier, factory in self.model_tiers)
+            self.model.load_all()
+        else:
+            self.model = self._scheduled(self.model_factory)
+        self.agent_pool = AgentPool(
+            lambda: CastleAgent(
+                ModelCascade(self.model) if self.model_tiers is not None else self.model,
+                debug_mode=False,
+                state_encoder=self.state_encoder,
+                executor=self.executor,
+            ),
+            size=self.agent_workers,
+        )
+
+    def close(self):
+        if self.model is not None:
+            self.model.close()
+
+    def evaluate(self, record_id, record):
+        from castle.battle_state import as_battle_state
+        from castle.client_adapter import create_game_object
+        from castle.game_objects import validate_commands
+        from custom_agent.deadline import Deadline, DeadlineExceeded
+        from smolagents.memory import ActionStep
+
+        result = {'id': record_id, 'command': record.get('command')}
+        answer, error = None, None
+        ts = time.perf_counter()
+        with self.agent_pool.agent() as agent:
+            try:
+                game_objects = [create_game_object(data) for data in record['gameObjects']]
+                # a copy to check the answer against, whatever the agent's code does to its battle_state
+                battle_state = [dict(row) for row in as_battle_state(game_objects)]
+                answer = agent.run_battle_command(game_objects, record['command'], deadline=Deadline(self.timeout))
+            except DeadlineExceeded as e:
+                error = e.reason
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+            actions = [step for step in agent.memory.steps if isinstance(step, ActionStep)]
+            result.update({
+                'latency_s': round(time.perf_counter() - ts, 3),
+                'steps': len(actions),
+                'step_errors': [type(step.error).__name__ for step in actions if step.error is not None],
+                'input_tokens': agent.input_tokens,
+                'output_tokens': agent.output_tokens,
+                'tier': agent.model.tier if self.model_tiers is not None else None,
+            })
+        problems = validate_commands(answer, battle_state) if answer is not None else []
+        expected = record.get('expected')
+        result.update({
+            'answer': answer,
+            'error': error,
+            'valid': answer is not None and not problems,
+            'problems': problems,
+            'exact': normalize_commands(answer) == normalize_commands(expected) if expected is not None else None,
+            'names_match': command_names(answer) == command_names(expected) if expected is not None else None,
+        })
+        return result
+
+
+def serve(evaluator, tasks, results, worker_index):
+    # agent_workers threads taking (id, record) tasks until each gets a None; returns the started threads
+    def loop():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            result = evaluator.evaluate(*task)
+            result['worker'] = worker_index
+            results.put(result)
+
+    threads = [threading.Thread(target=loop, name=f'eval-agent-{i}', daemon=True) for i in range(evaluator.agent_workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def worker_main(tasks, results, env, evaluator_kwargs, worker_index, log_path=None):
+    # entry point of a worker process
+    os.environ.update(env)  # before torch is imported
+    if log_path is not None:
+        sys.stdout = open(log_path, 'a', buffering=1)
+    evaluator = Evaluator(**evaluator_kwargs)
+    evaluator.start()
+    for thread in serve(evaluator, tasks, results, worker_index):
+        thread.join()
+    evaluator.close()
+
+
+def worker_env(index, workers, devices):
+    env = {}
+    if devices:
+        env['CUDA_VISIBLE_DEVICES'] = str(devices[index % len(devices)])
+    elif 'OMP_NUM_THREADS' not in os.environ:
+        env['OMP_NUM_THREADS'] = str(max(1, (os.cpu_count() or 1) // workers))
+    return env
+
+
+def put_task(tasks, task, workers):
+    # blocks while the agents are busy, but not forever if every worker died
+    while True:
+        try:
+            tasks.put(task, timeout=1.0)
+            return
+        except queue.Full:
+            if not any(worker.is_alive() for worker in workers):
+                raise RuntimeError('every evaluation worker stopped, see the log')
+
+
+def write_results(results, output, total_before):
+    # writer thread of the main process: one line per result, flushed, until a None
+    written = 0
+    last_progress = time.time()
+    ts = time.time()
+    with open(output, 'a', buffering=1) as f:
+        while True:
+            result = results.get()
+            if result is None:
+                return
+            f.write(json.dumps(result, default=str) + '\n')
+            written += 1
+            if time.time() - last_progress > 10:
+                last_progress = time.time()
+                print(f'{total_before + written} records done, {written / (time.time() - ts):.2f} records/s',
+                      file=sys.stderr)
+
+
+def evaluate_dataset(dataset, output, evaluator_kwargs, workers=1, devices=None, limit=None, log_path=None):
+    # runs the records of dataset that are not in output yet; returns how many ran and how long it took
+    done = set()
+    if os.path.exists(output):
+        truncate_partial_line(output)
+        done = {str(result['id']) for result in read_results(output)}
+        if done:
+            print(f'resuming: {len(done)} records already in {output}', file=sys.stderr)
+
+    agent_workers = evaluator_kwargs.get('agent_workers', 8)
+    ts = time.time()
+    evaluator = log = None
+    if workers > 1:
+        context = multiprocessing.get_context('spawn')
+        tasks = context.Queue(maxsize=2 * workers * agent_workers)
+        results = context.Queue()
+        runners = [
+            context.Process(
+                target=worker_main,
+                args=(tasks, results, worker_env(i, workers, devices), evaluator_kwargs, i, log_path),
+                name=f'eval-worker-{i}',
+                daemon=True,
+            )
+            for i in range(workers)
+        ]
+        for process in runners:
+            process.start()
+        consumers = workers * agent_workers
+    else:
+        tasks = queue.Queue(maxsize=2 * agent_workers)
+        results = queue.Queue()
+        # in this process the agents print to the log as well
+        log = open(log_path, 'a', buffering=1) if log_path is not None else None
+        evaluator = Evaluator(**evaluator_kwargs)
+        with contextlib.redirect_stdout(log) if log is not None else contextlib.nullcontext():
+            evaluator.start()
+        runners = serve(evaluator, tasks, results, 0)
+        consumers = len(runners)
+
+    writer = threading.Thread(target=write_results, args=(results, output, len(done)), name='eval-writer', daemon=True)
+    writer.start()
+    submitted = 0
+    with contextlib.redirect_stdout(log) if log is not None else contextlib.nullcontext():
+        for task in read_records(dataset, done, limit):
+            put_task(tasks, task, runners)
+            submitted += 1
+        for _ in range(consumers):
+            put_task(tasks, None, runners)
+        for runner in runners:
+            runner.join()
+    results.put(None)
+    writer.join()
+    if evaluator is not None:
+        evaluator.close()
+    if log is not None:
+        log.close()
+    return submitted, time.time() - ts
+
+
+def summarize(results, elapsed=None, ran=None):
+    # report over every result in the output, not only the ones of this run
+    n = len(results)
+
+    def rate(count, total):
+        return round(count / total, 4) if total else None
+
+    def distribution(values):
+        values = sorted(values)
+        if not values:
+            return None
+        return {
+            'mean': round(sum(values) / len(values), 3),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'max': values[-1],
+        }
+
+    with_expected = [result for result in results if result.get('exact') is not None]
+    model_results = [result for result in results if result.get('steps')]
+    report = {
+        'records': n,
+        'answered': rate(sum(1 for result in results if result.get('answer') is not None), n),
+        'schema_valid': rate(sum(1 for result in results if result.get('valid')), n),
+        'with_expected': len(with_expected),
+        'exact_match': rate(sum(1 for result in with_expected if result['exact']), len(with_expected)),
+        'command_names_match': rate(sum(1 for result in with_expected if result['names_match']), len(with_expected)),
+        'errors': dict(Counter(result['error'].split(':')[0] for result in results if result.get('error')).most_common()),
+        'step_errors': dict(Counter(error for result in results for error in result.get('step_errors', ())).most_common()),
+        'steps': distribution([result['steps'] for result in results if 'steps' in result]),
+        'steps_histogram': {str(k): v for k, v in sorted(Counter(result.get('steps', 0) for result in results).items())},
+        'input_tokens': distribution([result['input_tokens'] for result in model_results]),
+        'output_tokens': distribution([result['output_tokens'] for result in model_results]),
+        'latency_s': distribution([result['latency_s'] for result in results if 'latency_s' in result]),
+        'tiers': dict(Counter(result['tier'] for result in results if result.get('tier')).most_common()),
+    }
+    total_output = sum(result['output_tokens'] for result in model_results)
+    total_latency = sum(result['latency_s'] for result in model_results)
+    report['output_tokens_per_s_per_record'] = round(total_output / total_latency, 1) if total_latency else None
+    if elapsed is not None:
+        report['run'] = {
+            'records': ran,
+            'elapsed_s': round(elapsed, 1),
+            'records_per_s': round(ran / elapsed, 2) if elapsed else None,
+        }
+    return report
+
+
+def model_options(args):
+    # model_factory or model_tiers for Evaluator; factories are picklable, for the worker processes
+    from custom_agent.model_registry import model_wrapper_factory, tier_factories
+    if args.stub:
+        from benchmarks.stub_model import StubModel
+        return {'model_factory': functools.partial(StubModel, fixed_latency=args.stub_ms / 1000)}
+    if args.cascade:
+        return {'model_tiers': tier_factories(max_seq_length=args.max_seq_length)}
+    if args.model:
+        return {'model_factory': model_wrapper_factory(args.model, args.max_seq_length)}
+    from serving.inference import load_default_model
+    return {'model_factory': load_default_model}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset', nargs='?', help='jsonl of {id, gameObjects, command, expected} records')
+    parser.add_argument('--output', required=True, help='results jsonl, appended to and resumed from')
+    parser.add_argument('--report', help='also write the report json here')
+    parser.add_argument('--report-only', action='store_true', help='only summarize the results in --output')
+    parser.add_argument('--limit', type=int, help='evaluate only the first LIMIT records of the dataset')
+    parser.add_argument('--workers', type=int, default=1, help='model processes; 1 runs in this process')
+    parser.add_argument('--devices', help='comma separated CUDA devices for the workers, e.g. 0,1')
+    parser.add_argument('--agent-workers', type=int, default=8, help='concurrent records (batch size) per worker')
+    parser.add_argument('--batch-window', type=float, default=0.02)
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds per record')
+    parser.add_argument('--model', help='model id (default: the one of castle_agent.get_model)')
+    parser.add_argument('--cascade', action='store_true', help='run the small-to-large cascade of model_registry.MODEL_TIERS')
+    parser.add_argument('--max-seq-length', type=int, default=8192)
+    parser.add_argument('--state-encoder', default='compact', choices=['compact', 'json'])
+    parser.add_argument('--executor', default='interpreter', choices=['interpreter', 'compiled'])
+    parser.add_argument('--stub', action='store_true', help='StubModel instead of a real model, to check the pipeline')
+    parser.add_argument('--stub-ms', type=float, default=0.0, help='--stub: latency per generate call')
+    parser.add_argument('--log', help='agent and model output goes here instead of stdout')
+    args = parser.parse_args()
+
+    ran = elapsed = None
+    if not args.report_only:
+        if args.dataset is None:
+            parser.error('a dataset is needed unless --report-only')
+        evaluator_kwargs = dict(
+            agent_workers=args.agent_workers,
+            batch_window=args.batch_window,
+            state_encoder=args.state_encoder,
+            executor=args.executor,
+            timeout=args.timeout,
+            **model_options(args),
+        )
+        devices = args.devices.split(',') if args.devices else None
+        ran, elapsed = evaluate_dataset(args.dataset, args.output, evaluator_kwargs, workers=args.workers,
+                                        devices=devices, limit=args.limit, log_path=args.log)
+
+    report = summarize(read_results(args.output), elapsed=elapsed, ran=ran)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,49 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+import argparse
+import asyncio
+import contextlib
+import json
+import os
 import socket
 import uvicorn
-from asgiref.wsgi import WsgiToAsgi
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
 
-from castle.client_adapter import create_game_object
-from castle.utils import pretty_list
-from custom_agent.castle_agent import CastleAgent, get_model
+from castle.battle_session import BattleSnapshot, StaleSession
+from custom_agent.deadline import Deadline, DeadlineExceeded
+from custom_agent.model_registry import tier_factories
+from serving.inference import InferenceService, NotReady, QueueFull
+from serving.worker_pool import WorkerCrashed, WorkerPool
 
-app = Flask(__name__)
-CORS(app, resources={r"/*": {
-    "origins": "*",
-    "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-    "allow_headers": ["Content-Type", "Authorization"]
-}})
-model = None
+# native ASGI server; the blocking agent work happens in the InferenceService threads,
+# handlers only await its futures so the event loop never stalls
+# the model loads in the background at startup; poll /api/status until "ready" is true
+# command requests may carry "sessionId" (a newer command from the same session cancels the older one)
+# and "timeout" (seconds, capped at the service's request_timeout); a client that disconnects cancels its job
+# battle sessions: POST /api/session with the whole gameObjects list returns a version; commands can then send
+# "sessionId", "baseVersion" and a "delta" (moved/added/removed objects, see castle/battle_session.py) instead of
+# "gameObjects". a 409 with "resync": true means the server lost that version: start the session again
+# CASTLE_MODEL_CASCADE=1 serves from the small/medium/large tiers of custom_agent/model_registry.py instead of one model
+# CASTLE_WORKERS=N runs N worker processes with a model each (serving/worker_pool.py), CASTLE_WORKER_DEVICES=0,1
+# puts them on those GPUs; /api/status then lists every worker's health
+# CASTLE_BACKEND=cpu serves from an int8 model on the cpu instead of unsloth on a GPU (default auto: cpu without a GPU),
+# CASTLE_CPU_THREADS=N sets its torch threads, see custom_agent/backends.py
+# CASTLE_TRACE_DIR=traces/ records every request for `python -m custom_agent.tracing list|show|replay traces/`
+def make_service():
+    model_tiers = tier_factories() if os.environ.get('CASTLE_MODEL_CASCADE') == '1' else None
+    trace_dir = os.environ.get('CASTLE_TRACE_DIR')  # request traces, see custom_agent/tracing.py
+    workers = int(os.environ.get('CASTLE_WORKERS', '0'))
+    if workers > 0:
+        devices = os.environ.get('CASTLE_WORKER_DEVICES')
+        return WorkerPool(workers=workers, devices=devices.split(',') if devices else None, model_tiers=model_tiers,
+                          trace_dir=trace_dir)
+    return InferenceService(model_tiers=model_tiers, trace_dir=trace_dir)
+
+service = make_service()
 
 # Helper function to get local IP address
 def get_local_ip():
@@ -29,75 +58,265 @@ def get_local_ip():
     except Exception:
         return "127.0.0.1"  # Fallback to localhost
 
+def busy_response(e):
+    # 503 + Retry-After lets clients back off instead of stacking requests
+    if isinstance(e, NotReady):
+        error = f"Model is not ready yet ({e.phase})"
+    elif isinstance(e, WorkerCrashed):
+        error = "Worker stopped while running the command, retry"
+    else:
+        error = "Server busy, retry later"
+    return JSONResponse(
+        {"error": error, "retry_after": e.retry_after},
+        status_code=503,
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+def stopped_response(e):
+    # 409 when a newer command replaced this one, 504 when it ran out of time
+    if e.reason == 'superseded':
+        return JSONResponse({"error": "Replaced by a newer command"}, status_code=409)
+    return JSONResponse({"error": f"Command stopped ({e.reason})"}, status_code=504)
+
+def stale_response(e):
+    return JSONResponse({"error": str(e), "resync": True, "version": e.version}, status_code=409)
+
+def make_deadline(data):
+    timeout = service.request_timeout
+    # bool is an int: true/false are rejected by read_command_request, not read as 1 and 0 seconds
+    if isinstance(data.get('timeout'), (int, float)) and not isinstance(data['timeout'], bool) and data['timeout'] > 0:
+        timeout = min(timeout, data['timeout']) if timeout is not None else data['timeout']
+    return Deadline(timeout)
+
+async def cancel_on_disconnect(request: Request, deadline: Deadline):
+    # the body is already read, so the next message is the disconnect
+    while True:
+        message = await request.receive()
+        if message['type'] == 'http.disconnect':
+            deadline.cancel('disconnected')
+            return
+
+async def read_command_request(request: Request):
+    # returns the parsed json body, or None if it is not a valid command request
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict) or 'command' not in data:
+        return None
+    if isinstance(data.get('timeout'), bool):
+        return None
+    if 'gameObjects' not in data and not ('sessionId' in data and 'baseVersion' in data):
+        return None
+    return data
+
+def command_state(data):
+    # the gameObjects payload, or the session snapshot with the request's delta applied
+    # raises StaleSession, or KeyError/TypeError/ValueError for a malformed delta
+    if 'gameObjects' in data:
+        return data['gameObjects']
+    return service.update_session(data['sessionId'], data['baseVersion'], data.get('delta'))
+
+async def read_session_state(data):
+    # (state, error response); a delta is parsed and hashed off the event loop, large ones take a while
+    try:
+        return await run_in_threadpool(command_state, data), None
+    except StaleSession as e:
+        return None, stale_response(e)
+    except (KeyError, TypeError, ValueError, IndexError):
+        return None, JSONResponse({"error": "Invalid delta"}, status_code=400)
+
 # A simple status endpoint for debugging
-@app.route('/api/status', methods=['GET'])
-def get_status():
+async def get_status(request: Request):
     print('getting status')
-    response = jsonify({
-        "status": "online",
-        "message": "API server is running"
+    stats = service.stats()
+    return JSONResponse({
+        "status": "online" if stats["ready"] else "loading",
+        "message": "API server is running",
+        "ready": stats["ready"],
+        "inference": stats,
     })
-    
-    # Print the response headers for debugging
-    print("\n--- DEBUG: Response Headers ---")
-    print(f"Status: {response.status_code}")
-    for header, value in response.headers.items():
-        print(f"{header}: {value}")
-    print("-----------------------------\n")
-    
-    return response
+
+# prometheus text format: stage timings (prefill, decode, execution, ...), tokens, steps, errors, queue
+async def get_metrics(request: Request):
+    return PlainTextResponse(service.render_metrics(), media_type='text/plain; version=0.0.4')
 
 # POST submit command
-@app.route('/api/command', methods=['POST'])
-def submit_command():
-    if not request.json or 'command' not in request.json or 'gameObjects' not in request.json:
-        return jsonify({"error": "Invalid data"}), 400
-    
-    # load unsloth model just once
-    global model
-    if model is None:
-        print('loading castle model first')
-        model = get_model()
-    else:
-        print('found existing model')
-    
-    # print the data we received
-    print('new command request:', request)
-    game_objects_data = request.json['gameObjects']
-    game_objects = [create_game_object(o) for o in game_objects_data]
-    game_str = pretty_list(game_objects)
-    print('got game_objects', game_str)
-    
-    # create the agent and fulfill request
-    user_request = request.json['command']
-    print(f'running command "{user_request}"')
-    agent = CastleAgent(model)
-    agent_answer = agent.run_battle_command(game_objects, user_request)
+async def submit_command(request: Request):
+    data = await read_command_request(request)
+    if data is None:
+        return JSONResponse({"error": "Invalid data"}, status_code=400)
+
+    user_request = data['command']
+    print('new command request:', user_request)
+    state, error_response = await read_session_state(data)
+    if error_response is not None:
+        return error_response
+    deadline = make_deadline(data)
+    try:
+        future = service.submit(state, user_request, deadline=deadline, session_id=data.get('sessionId'))
+    except (NotReady, QueueFull) as e:
+        return busy_response(e)
+    watcher = asyncio.create_task(cancel_on_disconnect(request, deadline))
+    try:
+        agent_answer = await asyncio.wrap_future(future)
+    except DeadlineExceeded as e:
+        return stopped_response(e)
+    except (NotReady, QueueFull, WorkerCrashed) as e:
+        # from a worker process: it was not ready, its own queue was full, or it died
+        return busy_response(e)
+    except StaleSession as e:
+        # the worker's mirror of the session lost this version
+        return stale_response(e)
+    finally:
+        watcher.cancel()
 
     response = {
         'command': user_request,
         'result': agent_answer
     }
-    return jsonify(response), 200
+    if isinstance(state, BattleSnapshot):
+        response['version'] = state.version
+    return JSONResponse(response, status_code=200)
+
+# POST submit command, streamed back as server-sent events
+# events: session (with the new version, for delta requests), step_start, token, observation, step_error,
+# final_answer, then done (or error)
+# the client can apply the commands as soon as final_answer arrives
+async def submit_command_stream(request: Request):
+    data = await read_command_request(request)
+    if data is None:
+        return JSONResponse({"error": "Invalid data"}, status_code=400)
 
-# Convert Flask WSGI app to ASGI
-asgi_app = WsgiToAsgi(app)
+    user_request = data['command']
+    print(f'running streamed command "{user_request}"')
+    state, error_response = await read_session_state(data)
+    if error_response is not None:
+        return error_response
+
+    # agent threads push events onto the loop's queue
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def push_event(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    if isinstance(state, BattleSnapshot):
+        # first event, so the client knows the version its next delta builds on even if this command is replaced
+        events.put_nowait({'type': 'session', 'sessionId': state.session_id, 'version': state.version})
+
+    deadline = make_deadline(data)
+    try:
+        future = service.submit(
+            state, user_request, event_callback=push_event,
+            deadline=deadline, session_id=data.get('sessionId'),
+        )
+    except (NotReady, QueueFull) as e:
+        return busy_response(e)
+
+    def on_done(done_future):
+        error = done_future.exception()
+        if isinstance(error, DeadlineExceeded):
+            push_event({'type': 'error', 'error': str(error), 'reason': error.reason})
+        elif isinstance(error, StaleSession):
+            push_event({'type': 'error', 'error': str(error), 'resync': True, 'version': error.version})
+        elif isinstance(error, (NotReady, QueueFull, WorkerCrashed)):
+            push_event({'type': 'error', 'error': str(error), 'retry_after': error.retry_after})
+        elif error is not None:
+            push_event({'type': 'error', 'error': str(error)})
+        else:
+            push_event({'type': 'done', 'command': user_request})
+    future.add_done_callback(on_done)
+
+    async def event_stream():
+        # starlette cancels this generator when the client disconnects
+        try:
+            while True:
+                event = await events.get()
+                yield f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+                if event['type'] in ('done', 'error'):
+                    return
+        finally:
+            if not future.done():
+                deadline.cancel('disconnected')
+
+    return StreamingResponse(event_stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+# POST start (or restart) a battle session with the whole state; returns its id and version
+async def start_session(request: Request):
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get('gameObjects'), list):
+        return JSONResponse({"error": "Invalid data"}, status_code=400)
+    # a whole map can take a while to parse, keep it off the event loop
+    snapshot = await run_in_threadpool(service.start_session, data.get('sessionId'), data['gameObjects'])
+    return JSONResponse({'sessionId': snapshot.session_id, 'version': snapshot.version, 'objects': len(snapshot)})
+
+# POST apply a delta without a command, e.g. to keep the server in sync while nothing is asked
+async def update_session(request: Request):
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict) or 'sessionId' not in data or 'baseVersion' not in data:
+        return JSONResponse({"error": "Invalid data"}, status_code=400)
+    snapshot, error_response = await read_session_state(data)
+    if error_response is not None:
+        return error_response
+    return JSONResponse({
+        'sessionId': snapshot.session_id,
+        'version': snapshot.version,
+        'changed': sorted(snapshot.changed_ids),
+    })
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    service.start()
+    yield
+    service.stop()
+
+app = Starlette(
+    routes=[
+        Route('/api/status', get_status, methods=['GET']),
+        Route('/api/metrics', get_metrics, methods=['GET']),
+        Route('/api/command', submit_command, methods=['POST']),
+        Route('/api/command/stream', submit_command_stream, methods=['POST']),
+        Route('/api/session', start_session, methods=['POST']),
+        Route('/api/session/update', update_session, methods=['POST']),
+    ],
+    middleware=[
+        Middleware(
+            CORSMiddleware,
+            allow_origins=["*"],
+            allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+            allow_headers=["Content-Type", "Authorization"],
+        ),
+    ],
+    lifespan=lifespan,
+)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # the reloader runs the app in a child process and restarts it (and reloads the model) on file changes
+    parser.add_argument('--reload', action='store_true', help='restart the server when files change (development)')
+    args = parser.parse_args()
+
     local_ip = get_local_ip()
     port = 5000
     print(f"Server starting on http://{local_ip}:{port}")
     print(f"Local network access URL: http://{local_ip}:{port}")
-    
-    # Use uvicorn with auto-reload
+
+    # Use uvicorn, with auto-reload only when asked for
     uvicorn.run(
-        "server:asgi_app",
+        "server:app",
         host="0.0.0.0",
         port=port,
-        reload=True,
+        reload=args.reload,
         log_level="info",
          # unsloth modifies a cache on startup
          # uvicorn restarts when detecting file change
          # below is necessary to prevent uvicorn from infinitely rebooting
-        reload_excludes=["unsloth_compiled_cache/*"] 
-    )
\ No newline at end of file
+        reload_excludes=["unsloth_compiled_cache/*"]
+    )
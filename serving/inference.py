@@ -0,0 +1,429 @@
+import contextlib
+import importlib
+import math
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future
+
+from castle.battle_session import BattleSessionStore, BattleSnapshot
+from castle.battle_state import BattleState
+from castle.utils import pretty_list
+from custom_agent.deadline import Deadline, DeadlineExceeded
+from custom_agent.fast_path import resolve_command
+from custom_agent.metrics import (
+    ACTIVE_JOBS, QUEUE_DEPTH, REGISTRY, REQUEST_SECONDS, REQUESTS, SPAN_SECONDS, TIER_REQUESTS, span,
+)
+from custom_agent.result_cache import CommandResultCache
+from custom_agent.tracing import Tracer
+
+# inference service behind the async server
+# - torch/transformers/smolagents are only imported by the background loader, so importing the server is cheap
+# - start() loads the model in the background (importing -> loading_model -> warming_up -> ready) and
+#   submit() refuses commands with NotReady until then; load_status() reports the phase and progress
+# - the model is created once, under a lock, and wrapped in a BatchScheduler; the scheduler's thread is
+#   the single inference worker that owns the model and runs every generate call
+# - commands wait in a bounded job queue; a few agent threads take jobs, parse the game objects and run
+#   CastleAgent (their generate calls are batched together by the scheduler)
+# - the agents come from an AgentPool with one pre-built agent per worker thread, created with the model
+# - with model_tiers, every tier gets its own BatchScheduler in a ModelRegistry (all loaded at start) and each agent
+#   runs a ModelCascade over them: smallest tier first, bigger tiers after failed steps; the tier that answered
+#   is sent with the final_answer event and counted in stats()
+# - each job is served by the first path that can answer it: 'fast_path' (rule-based resolver for simple orders),
+#   'cache' (repeated command on an equivalent battle state) or 'model' (CastleAgent); the path is sent with
+#   the final_answer event and counted in stats()
+# - queue wait, parse time, request time and outcome go to custom_agent/metrics.py (/api/metrics)
+# - when the queue is full, submit() raises QueueFull right away with a Retry-After estimate, instead of
+#   piling up more blocked threads
+# - every job has a Deadline (request_timeout by default) covering its queue wait and agent run; a new command
+#   with the same session_id cancels the session's older job ('superseded'), and the server cancels jobs whose
+#   client disconnected. a stopped job fails with DeadlineExceeded and its generation is aborted mid-token
+# - battle sessions (castle/battle_session.py) keep a client's battle state between commands: start_session takes
+#   the whole state, update_session a delta on a version; a snapshot passed to submit() instead of the gameObjects
+#   payload skips the parse, reuses the prompt text of unchanged objects and the session's cache fingerprint
+# - with trace_dir, every job leaves a trace (payload, prompts, model outputs, code, observations, span timings)
+#   in custom_agent/tracing.py's ring buffer, flushed to compressed segment files in the background
+# usage:
+# service = InferenceService()
+# service.start()
+# future = service.submit(game_objects_data, 'Archer move up 3 tiles')
+# future = service.submit(game_objects_data, 'Archer move up 3 tiles', session_id='player-1', deadline=Deadline(10))
+# result = await asyncio.wrap_future(future)
+# snapshot = service.update_session('player-1', base_version=3, delta={'moved': [{'id': 'Archer1', 'position': [3, 4]}]})
+# future = service.submit(snapshot, 'Archer move up 3 tiles', session_id='player-1')
+
+
+# heavy modules, imported during the 'importing' phase
+HEAVY_MODULES = ['torch', 'transformers', 'smolagents', 'custom_agent.castle_agent', 'custom_agent.batching']
+# order of load phases; progress is the fraction of phases completed
+LOAD_PHASES = ['starting', 'importing', 'loading_model', 'warming_up', 'ready']
+WARM_UP_COMMANDS = ['Archer move up 3 tiles', 'Melee units move to the first wall']
+WARM_UP_OBJECTS = [
+    {'id': 'Castle1', 'type': 'structure', 'position': [2, 0], 'ally': True},
+    {'id': 'Wall1', 'type': 'structure', 'position': [4, 5]},
+    {'id': 'Knight1', 'type': 'unit', 'position': [0, 1], 'ally': True, 'name': 'Roland', 'isRanged': False, 'fighterType': 'knight'},
+    {'id': 'Archer1', 'type': 'unit', 'position': [3, 1], 'ally': True, 'name': 'Owen', 'isRanged': True, 'fighterType': 'archer'},
+]
+
+
+def load_default_model():
+    from custom_agent.castle_agent import get_model
+    return get_model()
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'inference queue is full, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class NotReady(Exception):
+    def __init__(self, phase, retry_after):
+        super().__init__(f'model is not ready yet (phase: {phase}), retry after {retry_after}s')
+        self.phase = phase
+        self.retry_after = retry_after
+
+
+class CommandJob:
+    def __init__(self, game_objects_data, command, event_callback=None, deadline=None, session_id=None):
+        self.game_objects_data = game_objects_data
+        self.command = command
+        self.event_callback = event_callback
+        self.deadline = deadline if deadline is not None else Deadline()
+        self.session_id = session_id
+        self.future = Future()
+        self.submitted_at = time.time()
+        self.path = None  # set by run_job: 'fast_path', 'cache' or 'model'
+        self.tier = None  # model tier that answered, with model_tiers
+        self.trace = None  # RequestTrace, when the service traces requests
+
+
+class InferenceService:
+    def __init__(self, model_factory=load_default_model, max_queue_size=16, agent_workers=4, batch_window=0.02,
+                 debug_mode=True, warm_up=True, result_cache=None, fast_path=True, request_timeout=60.0,
+                 code_executor='interpreter', model_tiers=None, session_store=None, trace_dir=None):
+        self.model_factory = model_factory
+        self.agent_workers = agent_workers
+        self.batch_window = batch_window
+        self.debug_mode = debug_mode
+        self.warm_up = warm_up
+        self.result_cache = result_cache if result_cache is not None else CommandResultCache()
+        self.fast_path = fast_path
+        self.request_timeout = request_timeout  # seconds, for jobs submitted without a deadline
+        self.code_executor = code_executor  # how agents run generated code: 'interpreter' or 'compiled'
+        # optional [(tier, model factory), ...], smallest first; replaces model_factory with a cascade
+        self.model_tiers = model_tiers
+        self.sessions = session_store if session_store is not None else BattleSessionStore()
+        self.trace_dir = trace_dir  # a path rather than a Tracer, so worker processes can be given it
+        self.tracer = None
+
+        self.model = None
+        self.agent_pool = None
+        self.model_lock = threading.Lock()
+        self.phase = 'starting'
+        self.phase_started_at = time.time()
+        self.load_error = None
+        self.phase_timings = {}  # phase -> seconds spent
+        self.jobs = queue.Queue(maxsize=max_queue_size)
+        self.workers = []
+        self.recent_durations = deque(maxlen=50)  # seconds per job, for Retry-After estimates
+        self.stats_lock = threading.Lock()
+        self.active_jobs = 0
+        self.completed_jobs = 0
+        self.rejected_jobs = 0
+        self.served_by = {'fast_path': 0, 'cache': 0, 'model': 0}
+        self.served_by_tier = {}
+        self.stopped_jobs = {}  # stop reason -> count
+        self.session_jobs = {}  # session id -> its latest job
+
+    def get_model(self):
+        # double-checked so concurrent callers load the weights only once
+        # returns the BatchScheduler, or the ModelRegistry of schedulers when model_tiers is set
+        if self.model is None:
+            with self.model_lock:
+                if self.model is None:
+                    print('loading castle model first')
+                    if self.model_tiers is not None:
+                        from custom_agent.model_registry import ModelRegistry
+                        registry = ModelRegistry((tier, self._scheduled(factory)) for tier, factory in self.model_tiers)
+                        registry.load_all()
+                        self.model = registry
+                    else:
+                        self.model = self._scheduled(self.model_factory)()
+        return self.model
+
+    def _scheduled(self, model_factory):
+        def factory():
+            from custom_agent.batching import BatchScheduler
+            return BatchScheduler(model_factory(), max_batch_size=self.agent_workers, batch_window=self.batch_window)
+        return factory
+
+    def model_instances(self):
+        # every loaded scheduler, one per tier
+        if self.model_tiers is not None:
+            return [self.model.get(tier) for tier in self.model.tiers]
+        return [self.model]
+
+    def get_agent_pool(self):
+        if self.agent_pool is None:
+            model = self.get_model()
+            with self.model_lock:
+                if self.agent_pool is None:
+                    from custom_agent.agent_pool import AgentPool
+                    from custom_agent.cascade import ModelCascade
+                    from custom_agent.castle_agent import CastleAgent
+                    self.agent_pool = AgentPool(
+                        lambda: CastleAgent(
+                            ModelCascade(model) if self.model_tiers is not None else model,
+                            debug_mode=self.debug_mode,
+                            executor=self.code_executor,
+                        ),
+                        size=self.agent_workers,
+                    )
+        return self.agent_pool
+
+    def is_ready(self):
+        return self.phase == 'ready'
+
+    def load(self):
+        # runs in the background loader thread; every phase is timed for /api/status
+        try:
+            self._set_phase('importing')
+            for module in HEAVY_MODULES:
+                importlib.import_module(module)
+            self._set_phase('loading_model')
+            self.get_model()
+            self.get_agent_pool()
+            self._set_phase('warming_up')
+            if self.warm_up:
+                self._warm_up()
+            self._set_phase('ready')
+        except Exception as e:
+            traceback.print_exc()
+            self.load_error = f'{type(e).__name__}: {e}'
+            self._set_phase('failed')
+
+    def _set_phase(self, phase):
+        now = time.time()
+        if self.phase in LOAD_PHASES:
+            self.phase_timings[self.phase] = round(now - self.phase_started_at, 3)
+        self.phase = phase
+        self.phase_started_at = now
+        print(f'inference service phase: {phase}')
+
+    def _warm_up(self):
+        # one generate per sample prompt: primes kernels, the prefix cache (system prompt) and the stop automata
+        from smolagents.memory import TaskStep
+        game_objects = BattleState.from_payload(WARM_UP_OBJECTS)
+        with self.get_agent_pool().agent() as agent:
+            for command in WARM_UP_COMMANDS:
+                agent.memory.steps = [TaskStep(task=agent.build_battle_prompt(game_objects, command))]
+                for model in self.model_instances():
+                    model(agent.get_messages(), stop_sequences=["<end_code>", "Observation:"])
+
+    def load_status(self):
+        if self.phase in LOAD_PHASES:
+            progress = LOAD_PHASES.index(self.phase) / (len(LOAD_PHASES) - 1)
+        else:
+            progress = 0.0
+        return {
+            'phase': self.phase,
+            'progress': round(progress, 2),
+            'ready': self.is_ready(),
+            'error': self.load_error,
+            'phase_seconds': dict(self.phase_timings),
+        }
+
+    def start(self):
+        if self.trace_dir is not None:
+            self.tracer = Tracer(self.trace_dir).start()
+        threading.Thread(target=self.load, name='model-loader', daemon=True).start()
+        for i in range(self.agent_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f'agent-worker-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        if self.model is not None:
+            self.model.close()
+        if self.tracer is not None:
+            self.tracer.close()
+
+    def submit(self, game_objects_data, command, event_callback=None, deadline=None, session_id=None) -> Future:
+        if not self.is_ready():
+            raise NotReady(self.phase, retry_after=5)
+        if deadline is None:
+            deadline = Deadline(self.request_timeout)
+        job = CommandJob(game_objects_data, command, event_callback, deadline=deadline, session_id=session_id)
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            with self.stats_lock:
+                self.rejected_jobs += 1
+            raise QueueFull(self.retry_after())
+        if session_id is not None:
+            with self.stats_lock:
+                previous = self.session_jobs.get(session_id)
+                self.session_jobs[session_id] = job
+            if previous is not None:
+                previous.deadline.cancel('superseded')
+        return job.future
+
+    def start_session(self, session_id, game_objects_data):
+        # parses the whole state, so the server calls it off the event loop
+        return self.sessions.start(session_id, game_objects_data)
+
+    def update_session(self, session_id, base_version, delta):
+        # raises StaleSession when the client has to send its whole state again
+        return self.sessions.update(session_id, base_version, delta)
+
+    def retry_after(self):
+        # rough wait in whole seconds: queued jobs drain agent_workers at a time
+        average = sum(self.recent_durations) / len(self.recent_durations) if self.recent_durations else 5.0
+        return max(1, math.ceil(average * (self.jobs.qsize() + 1) / self.agent_workers))
+
+    def _worker_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            with self.stats_lock:
+                self.active_jobs += 1
+            ts_start = time.time()
+            SPAN_SECONDS.observe(ts_start - job.submitted_at, span='queue_wait')
+            result, error = None, None
+            if self.tracer is not None:
+                job.trace = self._begin_trace(job)
+            try:
+                with job.trace if job.trace is not None else contextlib.nullcontext():
+                    result = self.run_job(job)
+            except Exception as e:
+                error = e
+            # bookkeeping first, so a caller woken by the future already sees this job in stats and metrics
+            if isinstance(error, DeadlineExceeded):
+                outcome = error.reason
+            else:
+                outcome = 'error' if error is not None else 'ok' if result is not None else 'no_answer'
+            with self.stats_lock:
+                self.active_jobs -= 1
+                self.completed_jobs += 1
+                if isinstance(error, DeadlineExceeded):
+                    self.stopped_jobs[outcome] = self.stopped_jobs.get(outcome, 0) + 1
+                if job.session_id is not None and self.session_jobs.get(job.session_id) is job:
+                    del self.session_jobs[job.session_id]
+            duration = time.time() - ts_start
+            self.recent_durations.append(duration)
+            path = job.path or 'none'
+            REQUEST_SECONDS.observe(duration, path=path)
+            REQUESTS.inc(path=path, outcome=outcome)
+            if job.trace is not None:
+                self.tracer.add(job.trace.finish(
+                    path=path, tier=job.tier, outcome=outcome, result=result,
+                    error=f'{type(error).__name__}: {error}' if error is not None else None,
+                    queue_wait=ts_start - job.submitted_at,
+                ))
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+
+    def run_job(self, job):
+        # superseded, disconnected or timed out while queued
+        job.deadline.check()
+        fingerprint = None
+        if isinstance(job.game_objects_data, BattleSnapshot):
+            # already parsed, when its delta was applied
+            game_objects = job.game_objects_data
+            fingerprint = game_objects.fingerprint
+        else:
+            with span('request_parse'):
+                game_objects = BattleState.from_payload(job.game_objects_data)
+        if self.debug_mode:
+            print('got game_objects', pretty_list(game_objects))
+
+        if self.fast_path:
+            result = resolve_command(game_objects, job.command)
+            if result is not None:
+                return self._served(job, 'fast_path', result)
+
+        # to_dicts builds new dicts on every call, so this snapshot is not affected by the agent's code
+        # (a session's rows are never handed to the agent, it gets copies)
+        battle_state = game_objects.row_dicts() if fingerprint is not None else game_objects.to_dicts()
+        cached = self.result_cache.get(battle_state, job.command, fingerprint=fingerprint)
+        if cached is not None:
+            return self._served(job, 'cache', cached)
+
+        print(f'running command "{job.command}"')
+        job.path = 'model'
+
+        with self.get_agent_pool().agent() as agent:
+            def tag_final_answer(event):
+                # the agent emits its own final_answer event, tag it with the path (and tier) like the other ones
+                if event['type'] == 'final_answer':
+                    event = {**event, 'path': 'model'}
+                    if self.model_tiers is not None:
+                        event['tier'] = agent.model.tier
+                job.event_callback(event)
+            event_callback = tag_final_answer if job.event_callback is not None else None
+            try:
+                result = agent.run_battle_command(game_objects, job.command, event_callback=event_callback, deadline=job.deadline)
+            finally:
+                if job.trace is not None:
+                    job.trace.record_agent(agent)
+            if self.model_tiers is not None:
+                job.tier = agent.model.tier
+        self.result_cache.put(battle_state, job.command, result, fingerprint=fingerprint)
+        self._served(job, 'model', result, emit=False)
+        return result
+
+    def _begin_trace(self, job):
+        if isinstance(job.game_objects_data, BattleSnapshot):
+            return self.tracer.begin(job.command, battle_state=job.game_objects_data.row_dicts(),
+                                     session_id=job.session_id, submitted_at=job.submitted_at)
+        return self.tracer.begin(job.command, game_objects_data=job.game_objects_data, session_id=job.session_id,
+                                 submitted_at=job.submitted_at)
+
+    def _served(self, job, path, result, emit=True):
+        print(f'command "{job.command}" served by {path}' + (f' ({job.tier})' if job.tier else ''))
+        job.path = path
+        with self.stats_lock:
+            self.served_by[path] += 1
+            if job.tier is not None:
+                self.served_by_tier[job.tier] = self.served_by_tier.get(job.tier, 0) + 1
+        if job.tier is not None:
+            TIER_REQUESTS.inc(tier=job.tier)
+        if emit and job.event_callback is not None:
+            job.event_callback({'type': 'final_answer', 'result': result, 'steps': 0, 'path': path})
+        return result
+
+    def render_metrics(self):
+        # prometheus text for /api/metrics, with the queue gauges brought up to date
+        QUEUE_DEPTH.set(self.jobs.qsize())
+        ACTIVE_JOBS.set(self.active_jobs)
+        return REGISTRY.render()
+
+    def stats(self):
+        return {
+            **self.load_status(),
+            'queue_depth': self.jobs.qsize(),
+            'queue_capacity': self.jobs.maxsize,
+            'active_jobs': self.active_jobs,
+            'completed_jobs': self.completed_jobs,
+            'rejected_jobs': self.rejected_jobs,
+            'stopped_jobs': dict(self.stopped_jobs),
+            'served_by': dict(self.served_by),
+            'served_by_tier': dict(self.served_by_tier),
+            'result_cache': self.result_cache.stats(),
+            'sessions': self.sessions.stats(),
+            'tracing': self.tracer.stats() if self.tracer is not None else None,
+            'agent_pool': self.agent_pool.stats() if self.agent_pool is not None else None,
+        }
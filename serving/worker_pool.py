@@ -0,0 +1,536 @@
+import functools
+import itertools
+import math
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future
+
+from castle.battle_session import BattleSessionStore, BattleSnapshot, StaleSession
+from custom_agent.deadline import Deadline, DeadlineExceeded
+from custom_agent.metrics import ACTIVE_JOBS, QUEUE_DEPTH, REGISTRY, WORKER_RESTARTS, WORKERS_READY
+from serving.inference import LOAD_PHASES, NotReady, QueueFull
+
+# multi-process serving: N worker processes, each with its own InferenceService (model, agents, batching),
+# behind one front end with the InferenceService interface (start, stop, submit, stats, render_metrics)
+# - commands go to the ready worker with the fewest commands in flight, over a multiprocessing pipe per worker;
+#   streamed events, results and errors come back on the same pipe
+# - workers are started with 'spawn' (safe with CUDA and with threads); with devices, worker i only sees
+#   devices[i % len(devices)] through CUDA_VISIBLE_DEVICES, so one node's GPUs each get a model.
+#   without devices the cpu threads are split between the workers
+# - every worker sends a heartbeat with its stats and metrics; a worker that exits or stops sending heartbeats is
+#   killed and started again, and the commands it had in flight fail with WorkerCrashed (the server answers 503)
+# - drain() stops sending a worker commands, waits for the ones it has, then stops (and restarts) it;
+#   rolling_restart() drains them one by one, stop() drains all of them
+# - deadlines stay in the front end: the worker gets the remaining time, and cancels (superseded, disconnected)
+#   are forwarded to it, so the abort reaches its generate call like in a single process
+# - battle sessions live in the front end's store; a session's commands stick to one worker, which mirrors the
+#   session from the deltas (or, when it lacks the base version, the whole rows) sent along with each command
+# - everything passed to the workers is pickled: model factories must be module-level functions or partials
+# usage:
+# pool = WorkerPool(workers=2, devices=['0', '1'])
+# pool = WorkerPool(workers=4, model_factory=functools.partial(StubModel, fixed_latency=0.05), warm_up=False)
+# pool.start()
+# future = pool.submit(game_objects_data, 'Archer move up 3 tiles', session_id='player-1')
+# pool.worker_health()
+# pool.drain(0)   # graceful restart of worker 0
+
+
+class WorkerError(Exception):
+    # an exception raised in a worker process that has no equivalent in the front end
+    def __init__(self, error_type, message):
+        super().__init__(f'{error_type}: {message}')
+        self.error_type = error_type
+
+
+class WorkerCrashed(Exception):
+    def __init__(self, index, retry_after=1):
+        super().__init__(f'worker {index} stopped while running the command, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+def encode_error(error):
+    return {
+        'type': type(error).__name__,
+        'message': str(error),
+        'reason': getattr(error, 'reason', None),
+        'phase': getattr(error, 'phase', None),
+        'retry_after': getattr(error, 'retry_after', None),
+        'session_id': getattr(error, 'session_id', None),
+        'version': getattr(error, 'version', None),
+    }
+
+
+def decode_error(error):
+    if error['type'] == 'DeadlineExceeded':
+        return DeadlineExceeded(error['reason'])
+    if error['type'] == 'QueueFull':
+        return QueueFull(error['retry_after'])
+    if error['type'] == 'NotReady':
+        return NotReady(error['phase'], error['retry_after'])
+    if error['type'] == 'StaleSession':
+        return StaleSession(error['session_id'], error['version'])
+    return WorkerError(error['type'], error['message'])
+
+
+def worker_main(conn, env, service_kwargs, heartbeat_interval, log_path=None):
+    # entry point of a worker process: one InferenceService driven by the messages of the pool
+    os.environ.update(env)  # before torch is imported
+    if log_path is not None:
+        sys.stdout = sys.stderr = open(log_path, 'a', buffering=1)
+    from serving.inference import InferenceService
+
+    service = InferenceService(**service_kwargs)
+    send_lock = threading.Lock()
+    deadlines = {}  # job id -> Deadline, while the job is in this worker
+    stopped = threading.Event()
+
+    def send(message):
+        try:
+            with send_lock:
+                conn.send(message)
+        except OSError:
+            # the pool is gone; the process ends when the main loop notices
+            stopped.set()
+
+    def send_event(job_id, event):
+        send(('event', job_id, event))
+
+    def reply(job_id, future):
+        deadlines.pop(job_id, None)
+        error = future.exception()
+        if error is not None:
+            send(('error', job_id, encode_error(error)))
+        else:
+            send(('result', job_id, future.result()))
+
+    def heartbeat():
+        while not stopped.is_set():
+            send(('health', service.stats(), REGISTRY.snapshot()))
+            stopped.wait(heartbeat_interval)
+
+    service.start()
+    threading.Thread(target=heartbeat, name='heartbeat', daemon=True).start()
+    while not stopped.is_set():
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message[0] == 'submit':
+            _, job_id, game_objects_data, command, timeout, stream = message
+            deadline = deadlines[job_id] = Deadline(timeout)
+            try:
+                if isinstance(game_objects_data, tuple):
+                    # ('session', session id, version, base version, delta, rows), see WorkerPool.session_payload
+                    _, session_id, version, base_version, delta, rows = game_objects_data
+                    game_objects_data = service.sessions.install(session_id, version, rows, base_version, delta)
+                future = service.submit(
+                    game_objects_data, command, deadline=deadline,
+                    event_callback=functools.partial(send_event, job_id) if stream else None,
+                )
+            except (NotReady, QueueFull, StaleSession) as e:
+                deadlines.pop(job_id, None)
+                send(('error', job_id, encode_error(e)))
+                continue
+            future.add_done_callback(functools.partial(reply, job_id))
+        elif message[0] == 'cancel':
+            _, job_id, reason = message
+            deadline = deadlines.get(job_id)
+            if deadline is not None:
+                deadline.cancel(reason)
+        elif message[0] == 'stop':
+            break
+    # finishes the queued jobs (their replies go out before the pipe closes)
+    service.stop()
+    stopped.set()
+    conn.close()
+
+
+class PoolJob:
+    ids = itertools.count()
+
+    def __init__(self, command, event_callback, deadline, session_id, battle_session_id=None):
+        self.id = next(PoolJob.ids)
+        self.command = command
+        self.event_callback = event_callback
+        self.deadline = deadline
+        self.session_id = session_id
+        self.battle_session_id = battle_session_id
+        self.future = Future()
+        self.worker = None
+        self.submitted_at = time.time()
+
+
+class WorkerProcess:
+    # the front end's side of one worker process
+    def __init__(self, index, env):
+        self.index = index
+        self.env = env
+        self.process = None
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.jobs = {}  # job id -> PoolJob sent to the worker and not answered yet
+        self.health = {}  # last InferenceService.stats() of the worker, up to a heartbeat old
+        self.metrics = {}  # last REGISTRY.snapshot() of the worker
+        self.last_heartbeat = 0.0
+        self.started_at = 0.0
+        self.draining = False
+        self.stopping = False
+        self.dispatched = 0
+        self.restarts = 0
+        self.session_versions = {}  # battle session id -> versions its mirror in the worker has
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def accepts_jobs(self):
+        return self.health.get('ready', False) and not self.draining and not self.stopping and self.is_alive()
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def status(self):
+        return {
+            'index': self.index,
+            'pid': self.process.pid if self.process is not None else None,
+            'alive': self.is_alive(),
+            'phase': self.health.get('phase', 'starting'),
+            'ready': self.health.get('ready', False),
+            'draining': self.draining,
+            'in_flight': len(self.jobs),
+            'dispatched': self.dispatched,
+            'completed_jobs': self.health.get('completed_jobs', 0),
+            'restarts': self.restarts,
+            'heartbeat_age_s': round(time.monotonic() - self.last_heartbeat, 3),
+            'error': self.health.get('error'),
+            'env': self.env,
+        }
+
+
+def sum_counts(dicts):
+    total = {}
+    for counts in dicts:
+        for key, value in counts.items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+class WorkerPool:
+    def __init__(self, workers=2, devices=None, max_in_flight=20, request_timeout=60.0, heartbeat_interval=0.5,
+                 heartbeat_timeout=30.0, restart_delay=1.0, drain_timeout=30.0, start_method='spawn', log_path=None,
+                 **service_kwargs):
+        # service_kwargs go to each worker's InferenceService (model_factory, agent_workers, model_tiers, ...)
+        self.devices = devices
+        self.max_in_flight = max_in_flight  # commands per worker, queued there or running
+        self.request_timeout = request_timeout  # seconds, for commands submitted without a deadline
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout  # seconds without a heartbeat before a worker counts as hung
+        self.restart_delay = restart_delay  # minimum seconds between starts of one worker, against crash loops
+        self.drain_timeout = drain_timeout
+        # worker output goes here instead of the server's stdout, e.g. 'logs/worker-{index}.log'
+        self.log_path = log_path
+        # a worker's own queue must hold every job the front end lets in, or it answers QueueFull for admitted jobs
+        service_kwargs.setdefault('max_queue_size', max_in_flight)
+        if service_kwargs['max_queue_size'] < max_in_flight:
+            raise ValueError(f"max_queue_size {service_kwargs['max_queue_size']} is below max_in_flight {max_in_flight}")
+        self.service_kwargs = service_kwargs
+        self.agent_workers = service_kwargs.get('agent_workers', 4)
+        self.context = multiprocessing.get_context(start_method)
+
+        self.workers = [WorkerProcess(i, self.worker_env(i, workers)) for i in range(workers)]
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.monitor = None
+        self.recent_durations = deque(maxlen=50)  # seconds per job, for Retry-After estimates
+        self.completed_jobs = 0
+        self.rejected_jobs = 0
+        self.session_jobs = {}  # session id -> its latest job
+        self.sessions = BattleSessionStore()
+        self.session_workers = {}  # battle session id -> index of the worker that mirrors it
+
+    def worker_env(self, index, workers):
+        env = {'CASTLE_WORKER_INDEX': str(index)}
+        if self.devices:
+            env['CUDA_VISIBLE_DEVICES'] = str(self.devices[index % len(self.devices)])
+        elif 'OMP_NUM_THREADS' not in os.environ:
+            # cpu inference: torch would start a thread per core in every worker
+            env['OMP_NUM_THREADS'] = str(max(1, (os.cpu_count() or 1) // workers))
+        return env
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+        self.monitor = threading.Thread(target=self._monitor_loop, name='worker-monitor', daemon=True)
+        self.monitor.start()
+
+    def _spawn(self, worker):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=worker_main,
+            args=(
+                child_conn, worker.env, self.service_kwargs, self.heartbeat_interval,
+                self.log_path.format(index=worker.index) if self.log_path is not None else None,
+            ),
+            name=f'castle-worker-{worker.index}',
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        worker.process, worker.conn = process, parent_conn
+        worker.health, worker.metrics = {}, {}
+        worker.started_at = worker.last_heartbeat = time.monotonic()
+        worker.draining = worker.stopping = False
+        worker.session_versions = {}
+        threading.Thread(
+            target=self._reader_loop, args=(worker, parent_conn), name=f'worker-{worker.index}-reader', daemon=True,
+        ).start()
+        print(f'started worker {worker.index} (pid {process.pid})')
+
+    def _reader_loop(self, worker, conn):
+        # one per worker process; ends when its pipe closes, the monitor handles the exit
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+            kind = message[0]
+            if kind == 'health':
+                worker.health, worker.metrics = message[1], message[2]
+                worker.last_heartbeat = time.monotonic()
+            elif kind == 'event':
+                job = worker.jobs.get(message[1])
+                if job is not None and job.event_callback is not None:
+                    job.event_callback(message[2])
+            elif kind == 'result':
+                self._finish(worker, message[1], result=message[2])
+            elif kind == 'error':
+                self._finish(worker, message[1], error=decode_error(message[2]))
+
+    def _finish(self, worker, job_id, result=None, error=None):
+        # whoever removes the job from worker.jobs resolves its future
+        with self.lock:
+            job = worker.jobs.pop(job_id, None)
+            if job is None:
+                return
+            self.completed_jobs += 1
+            if job.session_id is not None and self.session_jobs.get(job.session_id) is job:
+                del self.session_jobs[job.session_id]
+            if isinstance(error, StaleSession):
+                worker.session_versions.pop(job.battle_session_id, None)
+        self.recent_durations.append(time.time() - job.submitted_at)
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    def _monitor_loop(self):
+        while not self.closed.wait(self.heartbeat_interval):
+            for worker in self.workers:
+                if worker.stopping or time.monotonic() - worker.started_at < self.restart_delay:
+                    continue
+                if not worker.is_alive():
+                    self._restart(worker, 'crashed')
+                elif time.monotonic() - worker.last_heartbeat > self.heartbeat_timeout:
+                    self._restart(worker, 'unresponsive')
+            WORKERS_READY.set(sum(worker.accepts_jobs() for worker in self.workers))
+
+    def _restart(self, worker, reason):
+        print(f'restarting worker {worker.index} ({reason}, exit code {worker.process.exitcode})')
+        WORKER_RESTARTS.inc(reason=reason)
+        self._kill(worker)
+        worker.restarts += 1
+        self._spawn(worker)
+
+    def _kill(self, worker):
+        # ends the process and fails the commands it still had
+        if worker.is_alive():
+            worker.process.kill()
+        worker.process.join()
+        worker.conn.close()
+        with self.lock:
+            lost = list(worker.jobs)
+        for job_id in lost:
+            self._finish(worker, job_id, error=WorkerCrashed(worker.index))
+
+    def _stop_worker(self, worker, timeout):
+        worker.stopping = True
+        try:
+            worker.send(('stop',))
+        except OSError:
+            pass
+        worker.process.join(timeout)
+        self._kill(worker)
+
+    def drain(self, index, restart=True, timeout=None):
+        # stops dispatching to the worker, lets it finish its commands, then stops it (and starts a fresh one)
+        worker = self.workers[index]
+        worker.draining = True
+        deadline = Deadline(timeout if timeout is not None else self.drain_timeout)
+        while worker.jobs and deadline.stop_reason() is None:
+            time.sleep(0.05)
+        self._stop_worker(worker, timeout=max(1.0, deadline.remaining()))
+        if restart and not self.closed.is_set():
+            self._spawn(worker)
+
+    def rolling_restart(self, timeout=None):
+        # one worker at a time, waiting for each to be ready again, so the pool keeps serving
+        for worker in self.workers:
+            self.drain(worker.index, restart=True, timeout=timeout)
+            while not worker.accepts_jobs() and worker.health.get('phase') != 'failed':
+                time.sleep(0.1)
+
+    def stop(self):
+        self.closed.set()
+        for worker in self.workers:
+            worker.draining = True
+        drain_deadline = Deadline(self.drain_timeout)
+        while any(worker.jobs for worker in self.workers) and drain_deadline.stop_reason() is None:
+            time.sleep(0.05)
+        for worker in self.workers:
+            if worker.process is not None:
+                self._stop_worker(worker, timeout=max(1.0, drain_deadline.remaining()))
+        if self.monitor is not None:
+            self.monitor.join()
+
+    def is_ready(self):
+        return any(worker.accepts_jobs() for worker in self.workers)
+
+    def start_session(self, session_id, game_objects_data):
+        return self.sessions.start(session_id, game_objects_data)
+
+    def update_session(self, session_id, base_version, delta):
+        return self.sessions.update(session_id, base_version, delta)
+
+    def _forget_expired_sessions(self):
+        live = self.sessions.sessions
+        self.session_workers = {key: index for key, index in self.session_workers.items() if key in live}
+        for worker in self.workers:
+            worker.session_versions = {key: known for key, known in worker.session_versions.items() if key in live}
+
+    def session_payload(self, worker, snapshot):
+        # what the worker needs to mirror this version: nothing, the delta from a version it has, or all rows
+        known = worker.session_versions.get(snapshot.session_id, ())
+        if snapshot.version in known:
+            return ('session', snapshot.session_id, snapshot.version, None, None, None)
+        if snapshot.delta is not None and snapshot.base_version in known:
+            return ('session', snapshot.session_id, snapshot.version, snapshot.base_version, snapshot.delta, None)
+        return ('session', snapshot.session_id, snapshot.version, None, None, snapshot.row_dicts())
+
+    def remember_session_version(self, worker, payload):
+        # called once the payload is sent: a version the worker never got must not become a delta base
+        _, session_id, version, _, _, rows = payload
+        with self.lock:
+            known = worker.session_versions.setdefault(session_id, [])
+            if rows is not None:
+                known.clear()  # the worker resets its mirror to these rows
+            if version not in known:
+                known.append(version)
+                del known[:-self.sessions.history]
+
+    def submit(self, game_objects_data, command, event_callback=None, deadline=None, session_id=None) -> Future:
+        # game_objects_data: the gameObjects payload, or a BattleSnapshot from start_session / update_session
+        if deadline is None:
+            deadline = Deadline(self.request_timeout)
+        snapshot = game_objects_data if isinstance(game_objects_data, BattleSnapshot) else None
+        job = PoolJob(command, event_callback, deadline, session_id, snapshot.session_id if snapshot else None)
+        with self.lock:
+            ready = [worker for worker in self.workers if worker.accepts_jobs()]
+            if not ready:
+                raise NotReady(self.load_status()['phase'], retry_after=5)
+            # least loaded; ties go to the worker that got the fewest commands so far
+            worker = min(ready, key=lambda w: (len(w.jobs), w.dispatched))
+            if snapshot is not None:
+                # a session stays on the worker that mirrors it, as long as that worker has room
+                pinned = self.workers[self.session_workers.get(snapshot.session_id, worker.index)]
+                if pinned in ready and len(pinned.jobs) < self.max_in_flight:
+                    worker = pinned
+                self.session_workers[snapshot.session_id] = worker.index
+                if len(self.session_workers) > 2 * self.sessions.max_sessions:
+                    self._forget_expired_sessions()
+            if len(worker.jobs) >= self.max_in_flight:
+                self.rejected_jobs += 1
+                raise QueueFull(self.retry_after())
+            if snapshot is not None:
+                game_objects_data = self.session_payload(worker, snapshot)
+            worker.jobs[job.id] = job
+            worker.dispatched += 1
+            job.worker = worker
+            previous = self.session_jobs.get(session_id) if session_id is not None else None
+            if session_id is not None:
+                self.session_jobs[session_id] = job
+
+        remaining = deadline.remaining()
+        try:
+            worker.send(('submit', job.id, game_objects_data, command,
+                         remaining if remaining != float('inf') else None, event_callback is not None))
+        except OSError:
+            # the worker just died; the monitor fails the job when it restarts it
+            traceback.print_exc()
+        else:
+            if snapshot is not None:
+                self.remember_session_version(worker, game_objects_data)
+        deadline.on_cancel(functools.partial(self._forward_cancel, job))
+        if previous is not None:
+            previous.deadline.cancel('superseded')
+        return job.future
+
+    def _forward_cancel(self, job, reason):
+        if job.id in job.worker.jobs:
+            try:
+                job.worker.send(('cancel', job.id, reason))
+            except OSError:
+                pass
+
+    def retry_after(self):
+        # rough wait in whole seconds: everything in flight drains agent_workers at a time per worker
+        average = sum(self.recent_durations) / len(self.recent_durations) if self.recent_durations else 5.0
+        in_flight = sum(len(worker.jobs) for worker in self.workers)
+        return max(1, math.ceil(average * (in_flight + 1) / (self.agent_workers * len(self.workers))))
+
+    def worker_health(self):
+        return [worker.status() for worker in self.workers]
+
+    def load_status(self):
+        # the most advanced worker; 'ready' as soon as one worker takes commands
+        healths = [worker.health for worker in self.workers if worker.health]
+        if not healths:
+            return {'phase': 'starting', 'progress': 0.0, 'ready': False, 'error': None, 'phase_seconds': {}}
+        phases = LOAD_PHASES + ['failed']
+        best = max(healths, key=lambda health: (health['ready'], phases.index(health['phase'])))
+        errors = [health['error'] for health in healths if health['error']]
+        return {
+            'phase': best['phase'],
+            'progress': best['progress'],
+            'ready': self.is_ready(),
+            'error': errors[0] if errors else None,
+            'phase_seconds': best['phase_seconds'],
+        }
+
+    def stats(self):
+        healths = [worker.health for worker in self.workers if worker.health]
+        return {
+            **self.load_status(),
+            'queue_depth': sum(health['queue_depth'] for health in healths),
+            'queue_capacity': self.max_in_flight * len(self.workers),
+            'active_jobs': sum(len(worker.jobs) for worker in self.workers),
+            'completed_jobs': self.completed_jobs,
+            'rejected_jobs': self.rejected_jobs,
+            'stopped_jobs': sum_counts(health['stopped_jobs'] for health in healths),
+            'served_by': sum_counts(health['served_by'] for health in healths),
+            'served_by_tier': sum_counts(health['served_by_tier'] for health in healths),
+            'sessions': self.sessions.stats(),
+            'workers': self.worker_health(),
+        }
+
+    def render_metrics(self):
+        # this process' metrics plus every worker's last snapshot (a restarted worker starts from zero again)
+        stats = self.stats()
+        QUEUE_DEPTH.set(stats['queue_depth'])
+        ACTIVE_JOBS.set(stats['active_jobs'])
+        WORKERS_READY.set(sum(worker['ready'] and not worker['draining'] for worker in stats['workers']))
+        return REGISTRY.render([worker.metrics for worker in self.workers if worker.metrics])
@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+from benchmarks.battle_states import make_game_objects_data
+from castle.battle_session import BattleSessionStore, StaleSession, parse_rows
+
+
+def moved(obj, position):
+    return {**obj, 'position': position}
+
+
+def test_delta_keeps_the_client_order():
+    # the same battle sent whole and as a delta must give the same rows in the same order
+    data = make_game_objects_data(30)
+    store = BattleSessionStore()
+    snapshot = store.start('s1', data)
+    added = {**data[4], 'id': 'Knight99'}
+    delta = {
+        'moved': [{'id': data[10]['id'], 'position': [7, 7]}, {'id': data[2]['id'], 'position': [1, 8]}],
+        'added': [added],
+        'removed': [data[5]['id']],
+    }
+    snapshot = store.update('s1', snapshot.version, delta)
+
+    full = [moved(obj, [7, 7]) if i == 10 else moved(obj, [1, 8]) if i == 2 else obj
+            for i, obj in enumerate(data) if i != 5] + [added]
+    assert snapshot.to_dicts() == parse_rows(full)
+    assert snapshot.fingerprint == store.start('s2', full).fingerprint
+
+
+def test_unknown_object_is_stale_and_leaves_the_session():
+    data = make_game_objects_data(5)
+    store = BattleSessionStore()
+    snapshot = store.start('s1', data)
+    with pytest.raises(StaleSession):
+        store.update('s1', snapshot.version, {'moved': [{'id': 'Nobody', 'position': [0, 0]}]})
+    with pytest.raises(StaleSession):
+        store.update('missing', 1, {})
+    assert store.sessions['s1'].latest() is snapshot
+    assert store.stats()['stale_updates'] == 2
+
+
+def test_stats_under_concurrent_updates():
+    data = make_game_objects_data(5)
+    store = BattleSessionStore()
+    for i in range(8):
+        store.start(f's{i}', data)
+
+    def update(session_id):
+        for _ in range(200):
+            version = store.sessions[session_id].version
+            store.update(session_id, version, {'moved': [{'id': data[0]['id'], 'position': [1, 1]}]})
+
+    threads = [threading.Thread(target=update, args=(f's{i}',)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = store.stats()
+    assert stats['delta_updates'] == 1600 and stats['changed_objects'] == 1600 and stats['full_updates'] == 8
@@ -0,0 +1,93 @@
+import pytest
+from smolagents.local_python_executor import MAX_WHILE_ITERATIONS, InterpreterError, LocalPythonInterpreter
+
+from custom_agent.compiled_executor import CompiledPythonExecutor
+
+# the compiled executor has to keep LocalPythonInterpreter's contract: same outputs, logs and rejections
+
+PARITY_SNIPPETS = [
+    "x = 3\nx * 2",
+    "values = [i * i for i in range(10)]\nprint(sum(values))\nvalues[-1]",
+    "def double(v):\n    return v * 2\ndouble(21)",
+    "total = 0\nfor i in range(1001):\n    for j in range(1000):\n        total += 1\ntotal",
+    "class Point:\n    def __init__(self, x):\n        self.x = x\n    def __repr__(self):\n        return f'P({self.x})'\nprint(Point(3))\nPoint(4).x",
+    "n = 0\nwhile n < 10:\n    n += 1\n    if n % 2:\n        continue\nn",
+    "import math\nmath.floor(2.5)",
+]
+
+
+def run(executor, code, variables=None):
+    try:
+        return executor(code, variables or {})[:2]
+    except InterpreterError:
+        return 'error'
+
+
+def executors():
+    return LocalPythonInterpreter([], {}), CompiledPythonExecutor([], {})
+
+
+@pytest.mark.parametrize('code', PARITY_SNIPPETS)
+def test_same_output_and_logs(code):
+    interpreter, compiled = executors()
+    assert run(compiled, code) == run(interpreter, code)
+
+
+@pytest.mark.parametrize('code', [
+    "n = 0\nwhile True:\n    n += 1",
+    "import os",
+    "import subprocess",
+    "undefined_name + 1",
+    "import re\nb = re.enum.bltns\nimp = b.vars(b)['__im' + 'port__']\nos = imp('o' + 's')\nos.getcwd()",
+])
+def test_same_rejections(code):
+    interpreter, compiled = executors()
+    assert run(interpreter, code) == 'error'
+    assert run(compiled, code) == 'error'
+
+
+def test_while_counter_is_per_loop():
+    # two loops that together pass the limit, each one below it
+    half = MAX_WHILE_ITERATIONS // 2 + 10
+    code = f"a = 0\nwhile a < {half}:\n    a += 1\nb = 0\nwhile b < {half}:\n    b += 1\na + b"
+    assert CompiledPythonExecutor([], {})(code, {})[0] == 2 * half
+
+
+@pytest.mark.parametrize('code', [
+    "_x = 1",
+    "def _hidden():\n    pass",
+    "def __init__(self):\n    pass",
+    "class Point:\n    def _hidden(self):\n        pass",
+    "class Point:\n    def __init__(self):\n        super().__init__()",
+    "x = (1).__class__",
+    "getattr(1, '__class__')",
+    "'{0.__class__}'.format(1)",
+    "def gen():\n    yield 1",
+    "import _thread",
+    "import re\nre.enum.bltns.getattr(1, '__class__')",
+    "import re\nre.enum.bltns.open('/etc/hostname')",
+    "import re\nlist(map(re.enum.bltns.vars, [1]))",
+])
+def test_compiled_sandbox(code):
+    # object internals the AST walker never exposes, but compiled code could reach
+    with pytest.raises(InterpreterError):
+        CompiledPythonExecutor(['re'], {})(code, {})
+
+
+@pytest.mark.parametrize('code', ["leak()(1)", "@leak()\ndef f():\n    pass"])
+def test_builtins_reached_through_a_tool_are_not_callable(code):
+    executor = CompiledPythonExecutor([], {'leak': lambda: vars})
+    with pytest.raises(InterpreterError, match='not been explicitly added as a tool'):
+        executor(code, {})
+
+
+def test_state_persists_between_calls():
+    executor = CompiledPythonExecutor([], {})
+    executor("def triple(v):\n    return v * 3\nkept = 5", {})
+    assert executor("triple(kept)", {})[0] == 15
+
+
+def test_tools_cannot_be_reassigned():
+    executor = CompiledPythonExecutor([], {'move': lambda *args: None})
+    with pytest.raises(InterpreterError, match='erase the existing tool'):
+        executor("move = 1", {})
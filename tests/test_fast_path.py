@@ -0,0 +1,55 @@
+import pytest
+
+from benchmarks.bench_fast_path import BATTLE, CORPUS
+from castle.battle_session import BattleSessionStore
+from castle.client_adapter import create_game_object
+from custom_agent.fast_path import Unresolved, parse_directions, resolve_command, select_units
+
+
+@pytest.fixture
+def game_objects():
+    return [create_game_object(o) for o in BATTLE]
+
+
+@pytest.mark.parametrize('command,expected', CORPUS)
+def test_corpus(game_objects, command, expected):
+    # None means the command has to go to the model
+    assert resolve_command(game_objects, command) == expected
+
+
+@pytest.mark.parametrize('words,expected', [
+    ('up 3', (0, 3)),
+    ('3 tiles up', (0, 3)),
+    ('up 2 and left 1', (-1, 2)),
+    ('forward', (0, 1)),
+    ('north by 2 squares', (0, 2)),
+    ('to the castle', None),
+])
+def test_parse_directions(words, expected):
+    assert parse_directions(words.split()) == expected
+
+
+@pytest.mark.parametrize('words', ['up 3 quickly', 'left then up', 'up inf', 'up nan', 'up 1e400'])
+def test_parse_directions_rejects_unknown_words(words):
+    with pytest.raises(Unresolved):
+        parse_directions(words.split())
+
+
+def test_non_finite_distance_goes_to_the_model(game_objects):
+    assert resolve_command(game_objects, 'knight move up inf') is None
+
+
+def test_never_selects_enemies(game_objects):
+    with pytest.raises(Unresolved):
+        select_units(game_objects, ['enemy', 'knight'])
+    assert [u.object_id for u in select_units(game_objects, ['everyone'])] == ['Knight1', 'Archer1', 'Archer2']
+
+
+def test_session_rows_resolve_like_game_objects(game_objects):
+    # the fast path also runs on session snapshots (RowView); ordinals must follow the same order after a delta
+    store = BattleSessionStore()
+    snapshot = store.start('s1', BATTLE)
+    snapshot = store.update('s1', snapshot.version, {'moved': [{'id': 'Wall1', 'position': [2, 5]}]})
+    moved = [create_game_object({**o, 'position': [2, 5]} if o['id'] == 'Wall1' else o) for o in BATTLE]
+    for command, _ in CORPUS:
+        assert resolve_command(list(snapshot), command) == resolve_command(moved, command), command
@@ -0,0 +1,37 @@
+from benchmarks.tiny_model import make_tiny_model
+from custom_agent.model_wrapper import ModelWrapper, count_output_tokens
+
+PAD, EOS, OTHER_EOS = 0, 1, 2
+
+
+def test_eos_is_counted_when_pad_is_eos():
+    # qwen: pad == eos, the row's own eos must still count
+    assert count_output_tokens([5, 6, 7, EOS, EOS, EOS], EOS, {EOS}) == 4
+
+
+def test_eos_is_counted_when_pad_differs():
+    assert count_output_tokens([5, 6, EOS, PAD, PAD], PAD, {EOS}) == 3
+    assert count_output_tokens([5, 6, OTHER_EOS, PAD], PAD, {EOS, OTHER_EOS}) == 3
+
+
+def test_rows_stopped_by_the_criteria():
+    # stopped on a stop string after 3 tokens, padded afterwards
+    assert count_output_tokens([5, 6, 7, EOS, EOS], EOS, {EOS}, stopped_length=3) == 3
+    assert count_output_tokens([5, 6, 7, PAD, PAD], PAD, {EOS}, stopped_length=3) == 3
+
+
+def test_row_that_ran_to_the_limit():
+    assert count_output_tokens([5, 6, 7, 8], EOS, {EOS}) == 4
+
+
+def test_generate_batch_counts():
+    model, tokenizer = make_tiny_model()
+    wrapper = ModelWrapper.from_model(model, tokenizer, max_new_tokens=8, prefix_cache_tokens=0)
+    prompts = [
+        wrapper.prepare_prompt([{'role': 'user', 'content': [{'type': 'text', 'text': text}]}])
+        for text in ('Knight move up', 'Archers hold the second wall please')
+    ]
+    results = wrapper.generate_batch(prompts)
+    # random weights never emit eos, every row runs to max_new_tokens
+    assert [result['output_token_count'] for result in results] == [8, 8]
+    assert wrapper.last_output_token_count == 8
@@ -0,0 +1,103 @@
+import torch
+from transformers import DynamicCache
+
+from benchmarks.tiny_model import make_tiny_model
+from custom_agent.model_wrapper import ModelWrapper
+from custom_agent.prefix_cache import PrefixCache
+
+
+def make_cache(length, layers=2, offset=0):
+    # every position holds its own index (+ offset), so slices are easy to check
+    cache = DynamicCache()
+    positions = torch.arange(length, dtype=torch.float32) + offset
+    for layer_idx in range(layers):
+        tensor = positions.view(1, 1, length, 1).expand(1, 2, length, 4).clone()
+        cache.update(tensor, tensor.clone(), layer_idx)
+    return cache
+
+
+def cached_positions(cache):
+    return cache.key_cache[0][0, 0, :, 0].tolist()
+
+
+def test_miss_then_hit_on_extension():
+    cache = PrefixCache(min_prefix_tokens=4)
+    prompt = list(range(20))
+    assert cache.lookup(prompt) == (None, 0)
+    cache.insert(prompt, make_cache(24))  # the kv cache may run past the prompt (generated tokens)
+    past_key_values, reused = cache.lookup(prompt + [100, 101])
+    assert reused == 20
+    assert cached_positions(past_key_values) == list(range(20))
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_exact_prompt_leaves_one_token_to_prefill():
+    cache = PrefixCache(min_prefix_tokens=4)
+    cache.insert(list(range(10)), make_cache(10))
+    _, reused = cache.lookup(list(range(10)))
+    assert reused == 9
+
+
+def test_lookup_returns_a_copy():
+    # generate appends to the cache it gets; the stored entry must stay as it was
+    cache = PrefixCache(min_prefix_tokens=4)
+    cache.insert(list(range(10)), make_cache(10))
+    past_key_values, _ = cache.lookup(list(range(12)))
+    past_key_values.key_cache[0].fill_(-1)
+    past_key_values, _ = cache.lookup(list(range(12)))
+    assert cached_positions(past_key_values) == list(range(10))
+
+
+def test_split_edge_serves_both_branches():
+    cache = PrefixCache(min_prefix_tokens=4)
+    first = list(range(20))
+    second = list(range(12)) + [50, 51, 52, 53]
+    cache.insert(first, make_cache(20))
+    cache.insert(second, make_cache(16, offset=1000))
+    assert len(cache.entries) == 2
+    past_key_values, reused = cache.lookup(first + [99])
+    assert reused == 20 and cached_positions(past_key_values) == list(range(20))
+    past_key_values, reused = cache.lookup(second + [99])
+    assert reused == 16 and cached_positions(past_key_values)[0] == 1000
+    # a prompt that stops in the middle of the shared edge still reuses the common part
+    _, reused = cache.lookup(list(range(8)) + [77, 78])
+    assert reused == 8
+
+
+def test_extension_replaces_its_prefix_entry():
+    cache = PrefixCache(min_prefix_tokens=4)
+    cache.insert(list(range(10)), make_cache(10))
+    cache.insert(list(range(20)), make_cache(20))
+    assert len(cache.entries) == 1 and cache.total_tokens == 20
+
+
+def test_evicts_least_recently_used():
+    cache = PrefixCache(max_entries=2, min_prefix_tokens=4)
+    prompts = [[i] * 10 for i in range(3)]
+    cache.insert(prompts[0], make_cache(10))
+    cache.insert(prompts[1], make_cache(10))
+    cache.lookup(prompts[0] + [9])  # prompts[0] is now the most recent
+    cache.insert(prompts[2], make_cache(10))
+    assert cache.lookup(prompts[1] + [9]) == (None, 0)
+    assert cache.lookup(prompts[0] + [9])[1] == 10
+    # the evicted branch is pruned from the tree
+    assert set(cache.root.children) == {0, 2}
+
+
+def test_evicts_on_token_budget():
+    cache = PrefixCache(max_tokens=25, min_prefix_tokens=4)
+    cache.insert([1] * 10, make_cache(10))
+    cache.insert([2] * 10, make_cache(10))
+    cache.insert([3] * 10, make_cache(10))
+    assert cache.total_tokens <= 25 and len(cache.entries) == 2
+
+
+def test_generation_matches_without_cache():
+    model, tokenizer = make_tiny_model()
+    messages = [{'role': 'user', 'content': [{'type': 'text', 'text': 'Knight move up 3 tiles ' * 4}]}]
+    cached = ModelWrapper.from_model(model, tokenizer, max_new_tokens=16)
+    uncached = ModelWrapper.from_model(model, tokenizer, max_new_tokens=16, prefix_cache_tokens=0)
+    first = cached(messages).content
+    second = cached(messages).content  # served from the prefix cache
+    assert cached.prefix_cache.stats()['hits'] == 1
+    assert first == second == uncached(messages).content
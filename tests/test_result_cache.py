@@ -0,0 +1,91 @@
+from unittest import mock
+
+from benchmarks.battle_states import make_game_objects_data
+from castle.battle_state import BattleState
+from custom_agent.result_cache import (
+    CommandResultCache, fingerprint_battle_state, is_relational_answer, normalize_command,
+)
+
+MOVE_LEFT = [{'name': 'move_in_direction', 'args': {'unit_id': 'Knight1', 'direction': 'left', 'distance': 2}}]
+
+
+def battle_state(n=10):
+    return BattleState.from_payload(make_game_objects_data(n)).to_dicts()
+
+
+def test_normalize_command():
+    assert normalize_command('Knight, move LEFT two tiles!') == 'knight move left 2 tiles'
+    assert normalize_command('  archers   hold\tposition ') == 'archers hold position'
+    assert normalize_command('move -3.5 up') == 'move -3.5 up'
+    assert normalize_command('knight move left 2') != normalize_command('knight move right 2')
+    assert normalize_command('Рыцарь, вперёд на 2!') == 'рыцарь вперёд на 2'
+    assert normalize_command('骑士向左移动') != normalize_command('弓箭手攻击')
+
+
+def test_fingerprint_ignores_row_order_but_not_values():
+    state = battle_state()
+    assert fingerprint_battle_state(state) == fingerprint_battle_state(list(reversed(state)))
+    moved = [{**state[0], 'position': [99, 99]}] + state[1:]
+    assert fingerprint_battle_state(moved) != fingerprint_battle_state(state)
+    assert fingerprint_battle_state(moved, include_positions=False) == fingerprint_battle_state(state, include_positions=False)
+
+
+def test_hit_on_normalised_command_and_copy():
+    cache = CommandResultCache()
+    state = battle_state()
+    cache.put(state, 'Knight move left two', MOVE_LEFT)
+    result = cache.get(state, 'knight, move left 2')
+    assert result == MOVE_LEFT
+    result[0]['args']['distance'] = 5  # callers may change what they get
+    assert cache.get(state, 'knight move left 2') == MOVE_LEFT
+    assert cache.stats()['hits'] == 2
+
+
+def test_non_latin_commands_do_not_collide():
+    cache = CommandResultCache()
+    state = battle_state()
+    cache.put(state, '骑士向左移动', MOVE_LEFT)
+    assert cache.get(state, '弓箭手攻击') is None
+    cache.put(state, '⬅️', MOVE_LEFT)
+    assert cache.get(state, '➡️') is None
+
+
+def test_miss_on_changed_state_and_none_is_not_cached():
+    cache = CommandResultCache()
+    state = battle_state()
+    cache.put(state, 'knight move left 2', MOVE_LEFT)
+    assert cache.get([{**state[0], 'position': [99, 99]}] + state[1:], 'knight move left 2') is None
+    cache.put(state, 'archers attack', None)
+    assert cache.get(state, 'archers attack') is None
+
+
+def test_session_fingerprint_key():
+    cache = CommandResultCache()
+    cache.put(None, 'knight move left 2', MOVE_LEFT, fingerprint='abc')
+    assert cache.get(None, 'Knight move left 2', fingerprint='abc') == MOVE_LEFT
+    assert cache.get(None, 'Knight move left 2', fingerprint='abd') is None
+
+
+def test_relational_answers_ignore_positions():
+    cache = CommandResultCache(relational=True)
+    state = battle_state()
+    moved = [{**state[0], 'position': [99, 99]}] + state[1:]
+    cache.put(state, 'knight move left 2', MOVE_LEFT)
+    assert cache.get(moved, 'knight move left 2') == MOVE_LEFT
+    assert cache.stats()['relational_hits'] == 1
+    # answers that depend on where units are only hit on the exact state
+    assert not is_relational_answer('nearest knight move left 2', MOVE_LEFT)
+    cache.put(state, 'nearest knight move left 2', MOVE_LEFT)
+    assert cache.get(moved, 'nearest knight move left 2') is None
+
+
+def test_ttl_and_size_eviction():
+    cache = CommandResultCache(max_size=2, ttl=10)
+    state = battle_state()
+    with mock.patch('custom_agent.result_cache.time.time', return_value=1000.0):
+        for command in ('a', 'b', 'c'):
+            cache.put(state, command, MOVE_LEFT)
+        assert cache.get(state, 'a') is None and cache.get(state, 'c') == MOVE_LEFT
+    with mock.patch('custom_agent.result_cache.time.time', return_value=1011.0):
+        assert cache.get(state, 'c') is None
+    assert cache.stats()['evictions'] == 2
@@ -0,0 +1,30 @@
+import math
+
+from benchmarks.battle_states import make_game_objects_data
+from castle.battle_state import BattleState
+from castle.spatial import SpatialIndex
+
+
+def battle_state(n=60):
+    return BattleState.from_payload(make_game_objects_data(n)).to_dicts()
+
+
+def test_matches_a_full_scan():
+    state = battle_state()
+    index = SpatialIndex(state)
+    origin = [5, 5]
+    enemies = [obj for obj in state if obj.get('ally') is False]
+    by_distance = sorted(enemies, key=lambda obj: math.dist(origin, obj['position']))
+    assert [o['object_id'] for o in index.nearest_k(origin, 3, ally=False)] == [o['object_id'] for o in by_distance[:3]]
+    inside = [o['object_id'] for o in by_distance if math.dist(origin, o['position']) <= 4]
+    assert [o['object_id'] for o in index.within_radius(origin, 4, ally=False)] == inside
+
+
+def test_unhashable_filter_values_fall_back_to_a_scan():
+    state = battle_state()
+    index = SpatialIndex(state)
+    position = list(state[0]['position'])
+    expected = [obj for obj in state if obj['position'] == position]
+    assert index.filter_objects(position=position) == expected
+    assert index.nearest([0, 0], position=position) in expected
+    assert not index.filtered and not index.grids
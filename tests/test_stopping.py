@@ -0,0 +1,92 @@
+import torch
+
+from benchmarks.tiny_model import make_tiny_tokenizer
+from custom_agent.stopping import StopAutomaton, StopSequenceCriteria, truncate_at_stop_sequences
+
+
+class PieceTokenizer:
+    # token id -> text piece, so tests choose exactly where tokens split the text
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return ''.join(self.pieces[token_id] for token_id in token_ids)
+
+
+def feed(automaton, token_ids):
+    # matched pattern strings after each token
+    state, matches = 0, []
+    for token_id in token_ids:
+        state, matched = automaton.step(state, token_id)
+        matches.append([automaton.patterns[index] for index in matched])
+    return matches
+
+
+def test_overlapping_patterns():
+    tokenizer = PieceTokenizer(list('ushers'))
+    automaton = StopAutomaton(['he', 'she', 'hers'], tokenizer)
+    # u s h e r s
+    assert feed(automaton, range(6)) == [[], [], [], ['she', 'he'], [], ['hers']]
+
+
+def test_stop_split_across_tokens():
+    tokenizer = PieceTokenizer(['print(x)\n', '<en', 'd_co', 'de>', 'Obs', 'ervation:'])
+    automaton = StopAutomaton(['<end_code>', 'Observation:'], tokenizer)
+    assert feed(automaton, [0, 1, 2, 3]) == [[], [], [], ['<end_code>']]
+    assert feed(automaton, [0, 4, 5]) == [[], [], ['Observation:']]
+
+
+def test_stop_ending_inside_a_token():
+    tokenizer = PieceTokenizer(['x = 1<end_', 'code>\nmore text'])
+    automaton = StopAutomaton(['<end_code>'], tokenizer)
+    assert feed(automaton, [0, 1]) == [[], ['<end_code>']]
+
+
+def test_transitions_are_memoised():
+    tokenizer = PieceTokenizer(['a', 'b'])
+    automaton = StopAutomaton(['ab'], tokenizer)
+    assert feed(automaton, [0, 1, 0, 1]) == [[], ['ab'], [], ['ab']]
+    transitions = dict(automaton.transitions)
+    feed(automaton, [0, 1, 0, 1])
+    assert automaton.transitions == transitions and len(transitions) == 3
+
+
+def criteria_for(tokenizer, text_rows, stop_sequences, **kwargs):
+    # runs the criteria over rows of generated text, one token at a time; returns the step each row stopped at
+    automaton = StopAutomaton(sorted({stop for row in stop_sequences for stop in row}) + ['```', 'final_answer('],
+                              tokenizer)
+    rows = [tokenizer(text, add_special_tokens=False)['input_ids'] for text in text_rows]
+    length = max(len(row) for row in rows)
+    rows = [row + [tokenizer.pad_token_id] * (length - len(row)) for row in rows]
+    criteria = StopSequenceCriteria(automaton, stop_sequences, prompt_length=0, **kwargs)
+    stopped_at = [None] * len(rows)
+    for step in range(length):
+        done = criteria(torch.tensor([row[:step + 1] for row in rows]), None)
+        for i, row_done in enumerate(done.tolist()):
+            if row_done and stopped_at[i] is None:
+                stopped_at[i] = step
+    return stopped_at
+
+
+def test_rows_keep_their_own_stop_strings():
+    tokenizer = make_tiny_tokenizer()
+    text = 'Thought: go\nCode:\n```py\nmove()\n```<end_code>Observation: ok'
+    stopped_at = criteria_for(tokenizer, [text, text], [['<end_code>'], ['Observation:']])
+    assert stopped_at == [text.index('<end_code>') + len('<end_code>') - 1, text.index('Observation:') + len('Observation:') - 1]
+
+
+def test_stops_after_final_answer_block():
+    tokenizer = make_tiny_tokenizer()
+    text = 'Code:\n```py\nfinal_answer([])\n```\nand more'
+    assert criteria_for(tokenizer, [text], [['<end_code>']]) == [text.index('```\n') + 2]
+    assert criteria_for(tokenizer, [text], [['<end_code>']], stop_on_final_answer=False) == [None]
+
+
+def test_max_new_tokens_stops_every_row():
+    tokenizer = make_tiny_tokenizer()
+    assert criteria_for(tokenizer, ['abcdefgh', 'xyz'], [[], []], max_new_tokens=4) == [3, 3]
+
+
+def test_truncate_at_first_stop():
+    assert truncate_at_stop_sequences('code<end_code>Observation: x', ['Observation:', '<end_code>']) == 'code'
+    assert truncate_at_stop_sequences('no stop here', ['<end_code>']) == 'no stop here'
@@ -0,0 +1,509 @@
+import argparse
+import json
+import random
+import sys
+import time
+from typing import Dict, Iterable, List, Optional
+
+from castle.game_objects import Archer, Castle, Knight, Wall
+
+# synthetic fine-tuning data for CastleAgent, and sequence packing for training on it
+# generate: random battles built from the castle/game_objects.py classes, a templated command for each and the
+#   reference answer (Thought + code + final_answer) a good model would write. the answer is run through a real
+#   CastleAgent, so the training messages are exactly what PyAgent.get_messages sends the model, and the
+#   commands it produces (checked with validate_commands) become the expected answer
+#   every record also has id/gameObjects/command/expected, so the same file is a dataset for evaluation/batch_eval.py
+# pack: tokenizes the records with the model's chat template (add_generation_prompt=False, like ModelWrapper,
+#   so the model also learns to open its own assistant turn) and packs several examples into each sequence of
+#   max_seq_length tokens instead of padding one example per row
+#   - labels are -100 on the prompt tokens; only the answer is trained on
+#   - every example's position_ids start at 0, which is how flash attention 2 keeps examples apart (varlen);
+#     for sdpa/eager, PackedCollator builds a block-diagonal causal mask instead
+#   - best fit over a window of open sequences, so the input is streamed and never held in memory
+# both steps stream jsonl to disk and run on cpu (--tiny-tokenizer packs with the offline test tokenizer)
+# usage:
+# python -m training.synth_data generate --count 20000 --output castle_sft.jsonl
+# python -m training.synth_data pack castle_sft.jsonl --output castle_packed.jsonl --tokenizer unsloth/Qwen2.5-3B-Instruct-unsloth-bnb-4bit
+# python -m training.synth_data pack castle_sft.jsonl --output /tmp/packed.jsonl --tiny-tokenizer --max-seq-length 8192
+# training (transformers Trainer / unsloth), with attn_implementation='flash_attention_2':
+# dataset = datasets.load_dataset('json', data_files='castle_packed.jsonl', split='train').map(expand_packed)
+# trainer = UnslothTrainer(model=model, train_dataset=dataset, data_collator=PackedCollator(tokenizer.pad_token_id), ...)
+
+NAMES = [
+    'Roland', 'Owen', 'Anton', 'Jake', 'Mira', 'Edric', 'Sable', 'Tristan', 'Gawain', 'Isolde', 'Bran', 'Elaine',
+    'Percival', 'Rowena', 'Cedric', 'Lancel', 'Maud', 'Osric', 'Wynn', 'Alaric', 'Brienne', 'Dunstan', 'Giles',
+    'Hilda', 'Ivo', 'Jocelyn', 'Kay', 'Leofric', 'Morgana', 'Nell', 'Orrin', 'Piers', 'Quenby', 'Rhys', 'Sybil',
+    'Theo', 'Ulric', 'Vivian', 'Wulf', 'Yvain',
+]
+
+# (phrase, filters for filter_objects, thought phrase); only groups with allied units in the battle are used
+GROUPS = [
+    ('All units', {}, 'all of our units'),
+    ('Everyone', {}, 'all of our units'),
+    ('Archers', {'fighter_type': 'archer'}, 'our archers'),
+    ('Knights', {'fighter_type': 'knight'}, 'our knights'),
+    ('Melee units', {'is_ranged': False}, 'our melee units (is_ranged False)'),
+    ('Ranged units', {'is_ranged': True}, 'our ranged units (is_ranged True)'),
+]
+
+DIRECTIONS = [
+    ('move up {n} tiles', 0, 1),
+    ('advance {n} tiles', 0, 1),
+    ('move forward {n} tiles', 0, 1),
+    ('move down {n} tiles', 0, -1),
+    ('retreat {n} tiles', 0, -1),
+    ('move {n} tiles to the left', -1, 0),
+    ('move {n} tiles to the right', 1, 0),
+    ('shift right by {n}', 1, 0),
+]
+
+
+def random_battle(rng: random.Random, min_units=4, max_units=16, max_walls=4):
+    # allies in the bottom half with their castle at the bottom, enemies mirrored at the top; positions are unique
+    width = rng.randint(8, 20)
+    height = rng.randint(10, 30)
+    taken = set()
+
+    def free_position(y_min, y_max):
+        while True:
+            position = (rng.randint(0, width), rng.randint(y_min, y_max))
+            if position not in taken:
+                taken.add(position)
+                return [position[0], position[1]]
+
+    counters = {}
+
+    def next_id(kind):
+        counters[kind] = counters.get(kind, 0) + 1
+        return f'{kind}{counters[kind]}'
+
+    game_objects = [
+        Castle(next_id('Castle'), free_position(0, 0), True),
+        Castle(next_id('Castle'), free_position(height, height), False),
+    ]
+    for _ in range(rng.randint(0, max_walls)):
+        game_objects.append(Wall(next_id('Wall'), free_position(height // 3, 2 * height // 3)))
+    names = rng.sample(NAMES, max_units)
+    for i in range(rng.randint(min_units, max_units)):
+        ally = i % 2 == 0 if i < 2 else rng.random() < 0.5
+        fighter_class = Knight if rng.random() < 0.5 else Archer
+        y_range = (1, height // 2) if ally else (height // 2, height - 1)
+        game_objects.append(fighter_class(next_id(fighter_class.__name__), free_position(*y_range), ally, names[i]))
+    return game_objects
+
+
+def to_payload(game_object) -> Dict:
+    # the gameObjects entry the client would send for this object (see castle/client_adapter.py)
+    data = {'id': game_object.object_id, 'type': game_object.object_type, 'position': list(game_object.position)}
+    if isinstance(game_object, Castle):
+        data['ally'] = game_object.ally
+    elif game_object.object_type == 'unit':
+        data.update({
+            'ally': game_object.ally,
+            'name': game_object.name,
+            'isRanged': game_object.is_ranged,
+            'fighterType': game_object.fighter_type,
+        })
+    return data
+
+
+def _filter_call(filters, **extra):
+    items = {'object_type': 'unit', 'ally': True, **filters, **extra}
+    return 'filter_objects(' + ', '.join(f'{key}={value!r}' for key, value in items.items()) + ')'
+
+
+def _comprehension(filters, **extra):
+    items = {'object_type': 'unit', 'ally': True, **filters, **extra}
+    condition = ' and '.join(f"obj[{key!r}] == {value!r}" for key, value in items.items())
+    return f'[obj for obj in battle_state if {condition}]'
+
+
+def _members(game_objects, filters, ally=True):
+    return [
+        obj for obj in game_objects
+        if obj.object_type == 'unit' and obj.ally == ally and all(getattr(obj, key) == value for key, value in filters.items())
+    ]
+
+
+def _group(rng, game_objects):
+    groups = [group for group in GROUPS if _members(game_objects, group[1])]
+    return rng.choice(groups) if groups else None
+
+
+def _answer(thought, code):
+    return f'Thought: {thought}\nCode:\n```py\n{code}\n```<end_code>'
+
+
+# command templates: fn(rng, game_objects) -> (command, reference answer), or None when the battle does not fit
+
+def move_group(rng, game_objects):
+    group = _group(rng, game_objects)
+    if group is None:
+        return None
+    phrase, filters, described = group
+    direction, dx, dy = rng.choice(DIRECTIONS)
+    n = rng.randint(1, 5)
+    select = _filter_call(filters) if rng.random() < 0.7 else _comprehension(filters)
+    code = f'''units = {select}
+commands = [{{
+    'args': {{'unit_ids': [unit['object_id'] for unit in units], 'x_delta': {dx * n}, 'y_delta': {dy * n}}},
+    'name': 'move_in_direction',
+}}]
+final_answer(commands)'''
+    thought = f'I select {described} and move them with move_in_direction, x_delta={dx * n} and y_delta={dy * n}.'
+    return f'{phrase} {direction.format(n=n)}', _answer(thought, code)
+
+
+def group_to_castle(rng, game_objects):
+    group = _group(rng, game_objects)
+    if group is None:
+        return None
+    phrase, filters, described = group
+    enemy = rng.random() < 0.6
+    verb = rng.choice(['attack the enemy castle', 'charge the enemy castle', 'storm their castle']) if enemy else \
+        rng.choice(['fall back to our castle', 'return to the castle', 'defend our castle'])
+    code = f'''units = {_filter_call(filters)}
+castle = filter_objects(object_type='structure', ally={not enemy})[0]
+commands = [{{
+    'args': {{'unit_ids': [unit['object_id'] for unit in units], 'target_id': castle['object_id']}},
+    'name': 'move_to_target',
+}}]
+final_answer(commands)'''
+    side = 'the enemy castle (ally False)' if enemy else 'our castle (ally True)'
+    thought = f'I select {described} and send them to {side} with move_to_target.'
+    return f'{phrase} {verb}', _answer(thought, code)
+
+
+def attack_nearest_enemy(rng, game_objects):
+    group = _group(rng, game_objects)
+    if group is None or not _members(game_objects, {}, ally=False):
+        return None
+    phrase, filters, described = group
+    verb = rng.choice(['attack the nearest enemy', 'engage the closest enemies', 'each attack the closest enemy unit'])
+    code = f'''commands = []
+for unit in {_filter_call(filters)}:
+    target = nearest(unit, object_type='unit', ally=False)
+    commands.append({{'args': {{'unit_ids': [unit['object_id']], 'target_id': target['object_id']}}, 'name': 'move_to_target'}})
+final_answer(commands)'''
+    thought = f'Every one of {described} needs its own target, so for each unit I look up the nearest enemy unit with nearest() and send one move_to_target command per unit.'
+    return f'{phrase} {verb}', _answer(thought, code)
+
+
+def named_attack(rng, game_objects):
+    allies = _members(game_objects, {})
+    enemies = _members(game_objects, {}, ally=False)
+    if not allies or not enemies:
+        return None
+    attacker, target = rng.choice(allies), rng.choice(enemies)
+    command = rng.choice(['{a} attack {t}', '{a}, go after {t}', 'Send {a} to fight {t}']).format(a=attacker.name, t=target.name)
+    code = f'''attacker = filter_objects(object_type='unit', ally=True, name={attacker.name!r})[0]
+target = filter_objects(object_type='unit', ally=False, name={target.name!r})[0]
+commands = [{{'args': {{'unit_ids': [attacker['object_id']], 'target_id': target['object_id']}}, 'name': 'move_to_target'}}]
+final_answer(commands)'''
+    thought = f'{attacker.name} is our {attacker.fighter_type} and {target.name} is an enemy {target.fighter_type}. I find both by name and use move_to_target.'
+    return command, _answer(thought, code)
+
+
+def near_castle_move(rng, game_objects):
+    castle = next(obj for obj in game_objects if isinstance(obj, Castle) and obj.ally)
+    radius = rng.randint(3, 8)
+    near = [obj for obj in _members(game_objects, {}) if
+            ((obj.position[0] - castle.position[0]) ** 2 + (obj.position[1] - castle.position[1]) ** 2) ** 0.5 <= radius]
+    if not near:
+        return None
+    n = rng.randint(1, 4)
+    command = rng.choice(['Units within {r} tiles of our castle advance {n} tiles', 'Everyone near the castle (radius {r}) move up {n}'])
+    code = f'''castle = filter_objects(object_type='structure', ally=True)[0]
+units = within_radius(castle, {radius}, object_type='unit', ally=True)
+commands = [{{'args': {{'unit_ids': [unit['object_id'] for unit in units], 'x_delta': 0, 'y_delta': {n}}}, 'name': 'move_in_direction'}}]
+final_answer(commands)'''
+    thought = f'I find our castle, select our units within {radius} tiles of it with within_radius and move them up with y_delta={n}.'
+    return command.format(r=radius, n=n), _answer(thought, code)
+
+
+def protect_archers(rng, game_objects):
+    if not _members(game_objects, {'fighter_type': 'knight'}) or not _members(game_objects, {'fighter_type': 'archer'}):
+        return None
+    command = rng.choice(['Knights protect the archers', 'Each knight guard the closest archer', 'Knights, cover our archers'])
+    code = '''commands = []
+for knight in filter_objects(object_type='unit', ally=True, fighter_type='knight'):
+    archer = nearest(knight, object_type='unit', ally=True, fighter_type='archer')
+    commands.append({'args': {'unit_ids': [knight['object_id']], 'target_id': archer['object_id']}, 'name': 'move_to_target'})
+final_answer(commands)'''
+    thought = 'Each of our knights should move to the allied archer closest to it, so I use nearest() per knight and one move_to_target command each.'
+    return command, _answer(thought, code)
+
+
+def take_cover(rng, game_objects):
+    group = _group(rng, game_objects)
+    if group is None or not any(isinstance(obj, Wall) for obj in game_objects):
+        return None
+    phrase, filters, described = group
+    code = f'''commands = []
+for unit in {_filter_call(filters)}:
+    wall = nearest(unit, object_type='structure', ally=None)
+    commands.append({{'args': {{'unit_ids': [unit['object_id']], 'target_id': wall['object_id']}}, 'name': 'move_to_target'}})
+final_answer(commands)'''
+    thought = f'Walls are structures with ally None. For each of {described} I find the nearest wall and move the unit to it.'
+    return f"{phrase} {rng.choice(['take cover behind the nearest wall', 'hide at the closest wall'])}", _answer(thought, code)
+
+
+TEMPLATES = {
+    'move_group': move_group,
+    'group_to_castle': group_to_castle,
+    'attack_nearest_enemy': attack_nearest_enemy,
+    'named_attack': named_attack,
+    'near_castle_move': near_castle_move,
+    'protect_archers': protect_archers,
+    'take_cover': take_cover,
+}
+
+
+class ReferenceModel:
+    # stands in for the model in a CastleAgent and answers with the reference answer
+    model_id = 'reference'
+
+    def __init__(self):
+        self.answer = None
+
+    def __call__(self, messages, **kwargs):
+        from smolagents import ChatMessage
+        return ChatMessage(role='assistant', content=self.answer)
+
+
+class ExampleGenerator:
+    def __init__(self, seed=0, state_encoder='compact', templates=None, **battle_kwargs):
+        from custom_agent.castle_agent import CastleAgent
+        from smolagents.monitoring import LogLevel
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.templates = templates or list(TEMPLATES)
+        self.battle_kwargs = battle_kwargs
+        self.model = ReferenceModel()
+        self.agent = CastleAgent(self.model, debug_mode=False, state_encoder=state_encoder)
+        self.agent.logger.level = LogLevel.OFF
+        # stats
+        self.generated = 0
+        self.skipped = 0  # the template did not fit the battle, or the answer failed
+
+    def example(self, index) -> Optional[Dict]:
+        from smolagents.memory import ActionStep
+        from smolagents.models import get_clean_message_list, tool_role_conversions
+        game_objects = random_battle(self.rng, **self.battle_kwargs)
+        template = self.rng.choice(self.templates)
+        made = TEMPLATES[template](self.rng, game_objects)
+        if made is None:
+            self.skipped += 1
+            return None
+        command, answer = made
+        self.model.answer = answer
+        try:
+            expected = self.agent.run_battle_command(game_objects, command)
+            actions = [step for step in self.agent.memory.steps if isinstance(step, ActionStep)]
+            # one step that answered: the reference code ran and passed validate_commands
+            if expected is None or len(actions) != 1 or not expected or not all(c['args'].get('unit_ids') for c in expected):
+                self.skipped += 1
+                return None
+            # flattened to text like ModelWrapper.prepare_prompt does before the chat template
+            messages = get_clean_message_list(actions[0].model_input_messages, role_conversions=tool_role_conversions,
+                                              flatten_messages_as_text=True)
+        finally:
+            self.agent.reset()
+        self.generated += 1
+        return {
+            'id': f'synth-{self.seed}-{index}',
+            'template': template,
+            'command': command,
+            'gameObjects': [to_payload(obj) for obj in game_objects],
+            'expected': expected,
+            'messages': [{'role': getattr(m['role'], 'value', m['role']), 'content': m['content']} for m in messages]
+                        + [{'role': 'assistant', 'content': answer}],
+        }
+
+    def examples(self, count) -> Iterable[Dict]:
+        index = 0
+        while self.generated < count:
+            example = self.example(index)
+            index += 1
+            if example is not None:
+                yield example
+
+
+def tokenize_example(tokenizer, messages: List[Dict]) -> Dict:
+    # input_ids of the whole conversation and how many of them are prompt (not trained on)
+    prompt_ids = tokenizer.apply_chat_template(messages[:-1], tokenize=True, add_generation_prompt=False)
+    input_ids = tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=False)
+    if input_ids[:len(prompt_ids)] != prompt_ids:
+        raise ValueError('the chat template does not render the prompt as a prefix of the conversation')
+    return {'input_ids': input_ids, 'prompt_length': len(prompt_ids)}
+
+
+class SequencePacker:
+    # best-fit packing of tokenized examples into sequences of at most max_seq_length tokens
+    # up to open_sequences sequences take examples at once; the fullest is written out when one more is needed
+    def __init__(self, max_seq_length=8192, open_sequences=64):
+        self.max_seq_length = max_seq_length
+        self.open_sequences = open_sequences
+        self.open = []  # [free tokens, [examples]]
+        self.min_length = max_seq_length  # shortest example so far; a sequence with less room is done
+        # stats
+        self.examples = 0
+        self.tokens = 0
+        self.sequences = 0
+        self.dropped = 0  # examples longer than max_seq_length
+
+    def add(self, example) -> List[Dict]:
+        # returns the sequences finished by this example
+        length = len(example['input_ids'])
+        if length > self.max_seq_length:
+            self.dropped += 1
+            return []
+        self.examples += 1
+        self.tokens += length
+        self.min_length = min(self.min_length, length)
+        fits = [sequence for sequence in self.open if sequence[0] >= length]
+        if fits:
+            sequence = min(fits, key=lambda s: s[0])
+        else:
+            sequence = [self.max_seq_length, []]
+            self.open.append(sequence)
+        sequence[0] -= length
+        sequence[1].append(example)
+        done = [s for s in self.open if s[0] < self.min_length]
+        if not done and len(self.open) > self.open_sequences:
+            done = [min(self.open, key=lambda s: s[0])]
+        for s in done:
+            self.open.remove(s)
+        return [self._packed(s[1]) for s in done]
+
+    def flush(self) -> List[Dict]:
+        done, self.open = self.open, []
+        return [self._packed(s[1]) for s in done]
+
+    def _packed(self, examples) -> Dict:
+        self.sequences += 1
+        return {
+            'input_ids': [token for example in examples for token in example['input_ids']],
+            'seq_lengths': [len(example['input_ids']) for example in examples],
+            'prompt_lengths': [example['prompt_length'] for example in examples],
+        }
+
+    def stats(self):
+        capacity = self.sequences * self.max_seq_length
+        return {
+            'examples': self.examples,
+            'dropped': self.dropped,
+            'sequences': self.sequences,
+            'tokens': self.tokens,
+            'fill': round(self.tokens / capacity, 4) if capacity else None,
+            # one padded example per row (the old notebook) needs a sequence per example
+            'unpacked_fill': round(self.tokens / (self.examples * self.max_seq_length), 4) if self.examples else None,
+            'examples_per_sequence': round(self.examples / self.sequences, 2) if self.sequences else None,
+        }
+
+
+def expand_packed(record) -> Dict:
+    # packed record -> input_ids, labels and position_ids of one training row
+    labels, position_ids = [], []
+    start = 0
+    for length, prompt_length in zip(record['seq_lengths'], record['prompt_lengths']):
+        # the first token of each example is prompt, so no label crosses from one example into the next
+        labels.extend([-100] * prompt_length + record['input_ids'][start + prompt_length:start + length])
+        position_ids.extend(range(length))
+        start += length
+    return {'input_ids': record['input_ids'], 'labels': labels, 'position_ids': position_ids}
+
+
+class PackedCollator:
+    # batches expanded packed rows for a causal lm
+    # 'flash_attention_2': every row of the batch is concatenated into one row without padding; flash attention
+    #   finds the example boundaries from the position_ids resets
+    # 'sdpa' / 'eager': rows are padded and get a 4d block-diagonal causal mask (batch, 1, length, length),
+    #   which costs length^2 memory per row
+    def __init__(self, pad_token_id, attention='flash_attention_2'):
+        self.pad_token_id = pad_token_id
+        self.attention = attention
+
+    def __call__(self, rows):
+        import torch
+        if self.attention == 'flash_attention_2':
+            return {
+                key: torch.tensor([[value for row in rows for value in row[key]]])
+                for key in ('input_ids', 'labels', 'position_ids')
+            }
+        length = max(len(row['input_ids']) for row in rows)
+        batch = {'input_ids': [], 'labels': [], 'position_ids': []}
+        masks = []
+        for row in rows:
+            padding = length - len(row['input_ids'])
+            batch['input_ids'].append(row['input_ids'] + [self.pad_token_id] * padding)
+            batch['labels'].append(row['labels'] + [-100] * padding)
+            batch['position_ids'].append(row['position_ids'] + list(range(padding)))
+            # example number of each token; the padding is one more example, so no row of the mask is empty
+            segments = torch.cumsum(torch.tensor([int(p == 0) for p in batch['position_ids'][-1]]), 0)
+            allowed = (segments[:, None] == segments[None, :]) & torch.ones(length, length, dtype=torch.bool).tril()
+            masks.append(allowed)
+        batch = {key: torch.tensor(value) for key, value in batch.items()}
+        allowed = torch.stack(masks)[:, None]
+        batch['attention_mask'] = torch.zeros(allowed.shape).masked_fill(~allowed, torch.finfo(torch.float32).min)
+        return batch
+
+
+def load_tokenizer(args):
+    if args.tiny_tokenizer:
+        from benchmarks.tiny_model import make_tiny_tokenizer
+        return make_tiny_tokenizer()
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(args.tokenizer)
+
+
+def generate(args):
+    generator = ExampleGenerator(seed=args.seed, state_encoder=args.state_encoder)
+    ts = time.time()
+    with open(args.output, 'w') as f:
+        for example in generator.examples(args.count):
+            f.write(json.dumps(example) + '\n')
+            if generator.generated % 1000 == 0:
+                print(f'{generator.generated} examples, {generator.generated / (time.time() - ts):.0f}/s', file=sys.stderr)
+    return {'generated': generator.generated, 'skipped': generator.skipped, 'seconds': round(time.time() - ts, 1)}
+
+
+def pack(args):
+    tokenizer = load_tokenizer(args)
+    packer = SequencePacker(args.max_seq_length, args.open_sequences)
+    ts = time.time()
+    with open(args.dataset) as source, open(args.output, 'w') as f:
+        for line in source:
+            if not line.strip():
+                continue
+            for sequence in packer.add(tokenize_example(tokenizer, json.loads(line)['messages'])):
+                f.write(json.dumps(sequence) + '\n')
+        for sequence in packer.flush():
+            f.write(json.dumps(sequence) + '\n')
+    return {**packer.stats(), 'seconds': round(time.time() - ts, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='step', required=True)
+    generate_parser = commands.add_parser('generate', help='write synthetic examples as jsonl')
+    generate_parser.add_argument('--count', type=int, default=1000)
+    generate_parser.add_argument('--output', required=True)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--state-encoder', default='compact', choices=['compact', 'json'],
+                                 help='must match the encoder the fine-tuned agent will run with')
+    pack_parser = commands.add_parser('pack', help='tokenize generated examples and pack them into sequences')
+    pack_parser.add_argument('dataset')
+    pack_parser.add_argument('--output', required=True)
+    pack_parser.add_argument('--tokenizer', default='unsloth/Qwen2.5-3B-Instruct-unsloth-bnb-4bit')
+    pack_parser.add_argument('--tiny-tokenizer', action='store_true', help='offline byte tokenizer, for cpu checks')
+    pack_parser.add_argument('--max-seq-length', type=int, default=8192)
+    pack_parser.add_argument('--open-sequences', type=int, default=64)
+    args = parser.parse_args()
+
+    result = generate(args) if args.step == 'generate' else pack(args)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()